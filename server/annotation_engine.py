@@ -7,19 +7,32 @@ import cv2
 import gabriel_server
 from gabriel_server import cognitive_engine as gb_cognitive_engine
 from gabriel_server import local_engine as gb_local_engine
+from gabriel_server.network_engine import engine_runner
 from gabriel_protocol import gabriel_pb2
 import logging
+import multiprocessing
 import os
+import queue
 import sys
-import numpy as np
 import pyttsx3
 import json
 import time
 from pynput import keyboard
-from threading import Lock
+from threading import Lock, Thread
 
+import annotation_queue
+import annotation_store
 import config
+import feature_backend
+import feature_store
+import features
+import frame_log
+import geo_pager
+import geo_shard
+import ingest
 import match
+import metrics
+import packed_db
 import table
 import zhuocv as zc
 from generated_proto import client_extras_pb2
@@ -35,41 +48,337 @@ def parse_source_name_server_host():
     parser = argparse.ArgumentParser()
     parser.add_argument('source_name', nargs='?', default=DEFAULT_SOURCE_NAME)
     parser.add_argument('server_host', nargs='?', default=DEFAULT_SERVER_HOST)
-    return parser.parse_args()
-
-def engine_factory(image_db):
-    return lambda: ApertureServer(image_db)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run this many engine processes that share the '
+                             'annotations and connect to server.py, instead '
+                             'of one local engine')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='split the annotations by location over this '
+                             'many engine processes, with a local engine '
+                             'that routes each frame to one of them')
+    parser.add_argument('--record', metavar='PATH',
+                        help='append every frame that the local engine '
+                             'receives to a frame log at PATH, for replay.py')
+    args = parser.parse_args()
+    # Only the single local engine records, the workers and the shards
+    # would each append to the log on their own
+    if args.record is not None and (args.workers > 0 or args.shards > 0):
+        parser.error("--record cannot be combined with --workers or --shards")
+    return args
+
+def create_table():
+    store = None
+    if config.USE_ANNOTATION_STORE:
+        store = annotation_store.AnnotationStore(config.ANNOTATION_STORE_DIR)
+    return table.ImageDataTable(store=store)
+
+# The local engine runs the factory in a forked process, so the table is
+# created there instead of being copied into it
+def engine_factory(record_path=None):
+    return lambda: ApertureServer(create_table(), record_path=record_path)
 
 def main():
     # logging.basicConfig(level=VLOG1)
-    image_db = table.ImageDataTable()
     logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
     SERVER_ADDRESS_FORMAT = 'tcp://{}:{}'
     args = parse_source_name_server_host()
     server_address = \
         SERVER_ADDRESS_FORMAT.format(args.server_host, ZMQ_PORT)
-    gb_local_engine.run(engine_factory(image_db), args.source_name,
+    if args.workers > 0:
+        run_shared(create_table(), args.source_name, server_address,
+                   args.workers)
+        return
+    factory = engine_factory(args.record)
+    if args.shards > 0:
+        factory = lambda: ShardRouter(args.shards)
+    gb_local_engine.run(factory, args.source_name,
                         input_queue_maxsize=60, port=8099, num_tokens=2)
 
+def run_shared(image_db, source_name, server_address, workers):
+    '''
+    Loads the annotations in this process, publishes them as a packed
+    database (see packed_db) and starts workers engine processes that attach
+    to it and connect to the server at server_address (server.py). The
+    annotations that they receive are sent back here to be added, and the
+    database is republished after changes.
+    '''
+    # Publishes all of the annotations, so they are loaded up front
+    loader = ApertureServer(image_db, paging=False)
+    adder = loader.annotation_queue
+    if adder is None:
+        adder = annotation_queue.AnnotationQueue(
+            image_db, loader.get_next_annotation_key,
+            config.ANNOTATION_QUEUE_SIZE, config.ANNOTATION_QUEUE_TIMEOUT)
+    published_version = image_db.snapshot().version
+    packed_db.publish(image_db, config.SHARED_DB_DIR)
+    last_publish_time = time.time()
+
+    # Workers start from a fresh interpreter rather than a fork of this
+    # process and its threads
+    context = multiprocessing.get_context('spawn')
+    requests = context.Queue(config.ANNOTATION_QUEUE_SIZE)
+    for worker in range(workers):
+        context.Process(target=run_shared_worker, daemon=True,
+                        args=(worker, source_name, server_address,
+                              requests)).start()
+
+    while True:
+        try:
+            adder.submit(*requests.get(timeout=config.SHARED_DB_PUBLISH_INTERVAL))
+        except queue.Empty:
+            pass
+        version = image_db.snapshot().version
+        if version != published_version and time.time() - last_publish_time \
+                >= config.SHARED_DB_PUBLISH_INTERVAL:
+            packed_db.publish(image_db, config.SHARED_DB_DIR)
+            published_version = version
+            last_publish_time = time.time()
+
+def run_shared_worker(worker, source_name, server_address, requests):
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    shared_db = packed_db.SharedDbClient(config.SHARED_DB_DIR, requests,
+                                         config.ANNOTATION_QUEUE_TIMEOUT)
+    engine = ApertureServer(shared_db.table, shared_db=shared_db,
+                            metrics_offset=1 + worker)
+    engine_runner.run(engine, source_name, server_address)
+
+def run_shard(shard, num_shards, requests, responses, writes, updates,
+              loaded, key_counter):
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    shard_map = geo_shard.ShardMap(num_shards, config.SHARD_CELL_DEGREES,
+                                   config.GPS_FILTER_RADIUS_METERS)
+    store = geo_shard.ShardStore(config.ANNOTATION_STORE_DIR, shard, writes,
+                                 key_counter)
+    engine = ApertureServer(table.ImageDataTable(store=store),
+                            select=shard_map.selector(shard),
+                            metrics_offset=1 + shard)
+    logging.info(f"Shard {shard} of {num_shards} holds "
+                 f"{len(engine.table.get_keys())} annotations")
+    loaded.release()
+    Thread(target=apply_shard_updates, args=(engine.table, updates),
+           daemon=True).start()
+    while True:
+        input_frame = gabriel_pb2.InputFrame()
+        input_frame.ParseFromString(requests.get())
+        result_wrapper = engine.handle(input_frame)
+        responses.put((result_wrapper.SerializeToString(), engine.last_score))
+
+# Applies the changes that other shards made to the annotations that this
+# shard holds, as the router passes them on. They are already stored.
+def apply_shard_updates(image_db, updates):
+    while True:
+        key, record = updates.get()
+        try:
+            if record is None:
+                image_db.remove_annotation(key, persist_to_disk=False)
+            else:
+                image_db.add_annotation(
+                    key, record.kp, record.des, record.hist, record.img,
+                    record.annotation_text, record.latitude, record.longitude,
+                    persist_to_disk=False, dct=record.dct)
+        except Exception:
+            logging.exception(f"Could not apply the change of {key} from "
+                              f"another shard")
+
+class ShardRouter(gb_cognitive_engine.Engine):
+    '''
+    Splits the annotations by location over num_shards shard engine
+    processes (see geo_shard) and sends each frame to the shard that owns
+    the cell of its location, so that the memory and the match cost of each
+    engine depend on the annotations around its cells only. Frames without a
+    location go to the shard of (0, 0), like the location they are matched
+    at. With the GPS filter disabled (the g key, as for ApertureServer), every
+    frame is matched by all the shards in parallel, and the best scored
+    match of any of them is returned.
+
+    The router is the only process that writes the annotation store: it
+    imports db/ before starting the shards and then stores the annotations
+    that the shards send back, and passes each change on to the other shards
+    whose cells or margins it falls in. The store is not compacted until
+    every shard has loaded.
+    '''
+    def __init__(self, num_shards):
+        if not config.USE_ANNOTATION_STORE:
+            raise ValueError("Sharding needs the annotation store, set "
+                             "USE_ANNOTATION_STORE")
+        self.store = annotation_store.AnnotationStore(config.ANNOTATION_STORE_DIR)
+        detector = feature_backend.create_detector()
+        annotation_store.import_db_directory(
+            self.store, os.path.abspath('db/'),
+            lambda img: detector.detectAndCompute(img, None) +
+                        (features.get_image_histogram(img),))
+        self.store.sync()
+        self.shard_map = geo_shard.ShardMap(
+            num_shards, config.SHARD_CELL_DEGREES, config.GPS_FILTER_RADIUS_METERS)
+
+        # Where every stored annotation is, to tell which shards hold it
+        self.coords = {key: (latitude, longitude) for key, latitude, longitude
+                       in self.store.locations()}
+
+        # The shards scan the segments of the store while they load
+        self.store.hold_compaction()
+        context = multiprocessing.get_context('spawn')
+        writes = context.Queue()
+        loaded = context.Semaphore(0)
+        # Kept here, the processes do not hold on to their arguments
+        self.key_counter = context.Value('q', self.store.key_number('annotation'))
+        self.shards = []
+        self.updates = []
+        for shard in range(num_shards):
+            requests = context.Queue()
+            responses = context.Queue()
+            updates = context.Queue()
+            context.Process(target=run_shard, daemon=True,
+                            args=(shard, num_shards, requests, responses,
+                                  writes, updates, loaded,
+                                  self.key_counter)).start()
+            self.shards.append((requests, responses))
+            self.updates.append(updates)
+        Thread(target=self.write_loop, args=(writes,), daemon=True).start()
+        Thread(target=self.wait_for_shards, args=(loaded,), daemon=True).start()
+
+        self.gpsFilterLock = Lock()
+        self.gpsFilterEnabled = True
+        listener = keyboard.Listener(on_press=self.on_press)
+        listener.start()
+
+    # Follows the GPS filter of the shards, which toggle theirs on the same key
+    def on_press(self, key):
+        if getattr(key, 'char', None) == 'g':
+            with self.gpsFilterLock:
+                self.gpsFilterEnabled = not self.gpsFilterEnabled
+
+    def wait_for_shards(self, loaded):
+        for _ in self.shards:
+            loaded.acquire()
+        logging.info(f"All {len(self.shards)} shards have loaded")
+        self.store.release_compaction()
+
+    # Stores the changes that the shards send and passes each of them on to
+    # the other shards that hold the annotation before or after it
+    def write_loop(self, writes):
+        while True:
+            sender, key, record = writes.get()
+            old = self.coords.pop(key, None)
+            old_holders = set() if old is None else self.shard_map.holders(*old)
+            if record is None:
+                self.store.delete(key)
+                holders = set()
+            else:
+                self.store.put(key, record)
+                self.coords[key] = (record.latitude, record.longitude)
+                holders = self.shard_map.holders(record.latitude,
+                                                 record.longitude)
+            for shard in holders - {sender}:
+                self.updates[shard].put((key, record))
+            for shard in old_holders - holders - {sender}:
+                self.updates[shard].put((key, None))
+
+    def handle(self, input_frame):
+        latitude = 0
+        longitude = 0
+        if input_frame.HasField('extras'):
+            extras = client_extras_pb2.Extras()
+            input_frame.extras.Unpack(extras)
+            latitude = extras.current_location.latitude
+            longitude = extras.current_location.longitude
+        owner = self.shard_map.owner(latitude, longitude)
+        with self.gpsFilterLock:
+            useGpsFilter = self.gpsFilterEnabled
+        shards = [owner] if useGpsFilter else range(len(self.shards))
+        logging.log(VLOG1, f"Routing frame at {(latitude, longitude)} to "
+                           f"shards {list(shards)}")
+
+        data = input_frame.SerializeToString()
+        # Only the owner adds an annotation that comes with the frame, the
+        # other shards just match it
+        other_data = data
+        if len(shards) > 1 and input_frame.HasField('extras') and \
+                extras.HasField('annotation_text'):
+            extras.ClearField('annotation_text')
+            other_frame = gabriel_pb2.InputFrame()
+            other_frame.CopyFrom(input_frame)
+            other_frame.extras.Pack(extras)
+            other_data = other_frame.SerializeToString()
+
+        # Sent to every shard before waiting for any, so that they match the
+        # frame in parallel
+        for shard in shards:
+            self.shards[shard][0].put(data if shard == owner else other_data)
+        best = None
+        for shard in shards:
+            response, score = self.shards[shard][1].get()
+            result_wrapper = gabriel_pb2.ResultWrapper()
+            result_wrapper.ParseFromString(response)
+            # Matches that were not scored, such as tracked ones, rank last
+            rank = (len(result_wrapper.results) > 0, score or 0, shard == owner)
+            if best is None or rank > best[0]:
+                best = (rank, result_wrapper)
+        return best[1]
+
 config.setup(is_streaming = True)
 display_list = config.DISPLAY_LIST
 
 class ApertureServer(gb_cognitive_engine.Engine):
-    def __init__(self, image_db):
-        self.feature_extraction_algo = cv2.KAZE_create()
+    # With a shared_db (a packed_db.SharedDbClient), image_db is its table:
+    # the annotations are already loaded, and new ones are sent to the
+    # process that publishes it. select, a function of (latitude, longitude),
+    # limits the stored annotations that are loaded to those it returns True
+    # for. With USE_GEO_PAGING they are loaded on demand, unless paging is
+    # False. Metrics are served on METRICS_PORT + metrics_offset. Frames are
+    # recorded to a frame_log at record_path if given.
+    def __init__(self, image_db, shared_db=None, select=None, paging=True,
+                 metrics_offset=0, record_path=None):
+        self.feature_extraction_algo = feature_backend.create_detector()
         self.table = image_db
         self.matcher = match.ImageMatcher(self.table)
+        self.ingest = ingest.FrameIngest(config.IM_WIDTH, config.IM_HEIGHT)
 
         # initialize database (if any)
         self.db_path = os.path.abspath('db/')
         if not os.path.exists(self.db_path):
             os.makedirs(self.db_path)
 
-        self.add_images_to_table()
+        self.shared_db = shared_db
+        if shared_db is None:
+            if self.table.store is not None:
+                annotation_store.import_db_directory(
+                    self.table.store, self.db_path, self.compute_features)
+                if paging and config.USE_GEO_PAGING:
+                    self.page_store_into_table(select)
+                else:
+                    self.add_store_to_table(select)
+            else:
+                self.add_images_to_table(select)
+        if self.table.vlad_index.needs_training():
+            self.table.vlad_index.train()
+
+        self.annotation_queue = None
+        if shared_db is not None:
+            self.annotation_queue = shared_db
+        elif config.USE_ANNOTATION_QUEUE:
+            self.annotation_queue = annotation_queue.AnnotationQueue(
+                self.table, self.get_next_annotation_key,
+                config.ANNOTATION_QUEUE_SIZE, config.ANNOTATION_QUEUE_TIMEOUT)
 
         self.gpsFilterLock = Lock()
         self.gpsFilterEnabled = True
 
+        self.recorder = None
+        if record_path is not None:
+            self.recorder = frame_log.FrameRecorder(record_path)
+            logging.info(f"Recording frames to {record_path}")
+
+        # Per-stage latencies and frame counters, see metrics
+        if config.METRICS_PORT is not None:
+            port = config.METRICS_PORT + metrics_offset
+            try:
+                metrics.serve(port)
+                logging.info(f"Serving metrics at "
+                             f"http://127.0.0.1:{port}/metrics")
+            except OSError as e:
+                logging.error(f"Could not serve metrics on port {port}: {e}")
+
         listener = keyboard.Listener(on_press=self.on_press)
         listener.start()
 
@@ -113,9 +422,14 @@ class ApertureServer(gb_cognitive_engine.Engine):
         print(f'{next_file_index=}')
         return next_file_index
 
+    def get_next_annotation_key(self):
+        if self.table.store is not None:
+            return self.table.store.next_key('annotation')
+        return 'annotation' + str(self.get_next_annotation_file_index())
+
     @staticmethod
     def get_image_histogram(img):
-        return cv2.calcHist([img], [0], None, [256], [0, 256])  # Grayscale
+        return features.get_image_histogram(img)
 
     @staticmethod
     def get_file_content(filename):
@@ -123,106 +437,234 @@ class ApertureServer(gb_cognitive_engine.Engine):
             content = file.read()
             return content
 
-    def add_images_to_table(self):
+    # Returns (kp, des, hist) of a decoded and resized image
+    def compute_features(self, img):
+        kp, des = self.feature_extraction_algo.detectAndCompute(img, None)
+        return kp, des, self.get_image_histogram(img)
+
+    def add_store_to_table(self, select=None):
+        logging.info("Adding annotations from the store to table")
+        store = self.table.store
+        # Published to matching as one snapshot once all of them are in
+        with self.table.batch():
+            num_computed = self.add_records_to_table(
+                store.items(select, with_image=False))
+
+        logging.info(f"Added {len(self.table.get_keys())} of {len(store)} "
+                     f"annotations to table, computed features for "
+                     f"{num_computed} of them")
+
+    # Adds (key, record, fresh) stored annotations to the table. Returns the
+    # number of them whose features had to be computed. Records that can be
+    # used as they are come without their image (see
+    # annotation_store.decode_record), the table reads it from the store
+    # when it is needed.
+    def add_records_to_table(self, items):
+        num_computed = 0
+        for key, record, fresh in items:
+            img, dct = record.img, record.dct
+            if img is not None and \
+                    img.shape[:2] != (config.IM_HEIGHT, config.IM_WIDTH):
+                img = cv2.resize(img, (config.IM_WIDTH, config.IM_HEIGHT))
+                fresh = False
+                dct = None
+            kp, des, hist = record.kp, record.des, record.hist
+            if not fresh:
+                kp, des, hist = self.compute_features(img)
+                num_computed += 1
+            # Records with stale features or without DCT features are
+            # written back with new ones
+            self.table.add_annotation(key, kp, des, hist, img,
+                                      record.annotation_text,
+                                      record.latitude, record.longitude,
+                                      persist_to_disk=not fresh or dct is None,
+                                      dct=dct)
+        return num_computed
+
+    # Leaves the stored annotations where they are and has the table load
+    # those around each query on demand
+    def page_store_into_table(self, select=None):
+        store = self.table.store
+        locations = store.locations()
+        if select is not None:
+            locations = ((key, latitude, longitude)
+                         for key, latitude, longitude in locations
+                         if select(latitude, longitude))
+
+        def stored_items(keys):
+            for key in keys:
+                stored = store.get(key, with_image=False)
+                if stored is not None:
+                    yield (key,) + stored
+
+        load = lambda keys: self.add_records_to_table(stored_items(keys))
+
+        pager = geo_pager.GeoPager(self.table, locations, load,
+                                   config.GEO_PAGE_DEGREES,
+                                   config.GEO_PAGE_BUDGET_BYTES)
+        self.table.set_pager(pager)
+        logging.info(f"Paging {len(pager)} of {len(store)} annotations into "
+                     f"table by region")
+
+    def add_images_to_table(self, select=None):
         logging.info("Adding images to table")
         image_filter = lambda f : f.lower().endswith("jpg")
         db_filelist = \
             [os.path.join(self.db_path, f) for f in os.listdir(self.db_path) if
                  image_filter(f)]
 
-        for filename in db_filelist:
-            img = cv2.imread(filename, 0)
-            img = cv2.resize(img, (config.IM_WIDTH, config.IM_HEIGHT))
-            annotation_text_filename = filename.replace('jpg', 'txt')
-            annotation_data = self.get_file_content(annotation_text_filename)
-
-            annotation_data_lines = annotation_data.splitlines()
-            if len(annotation_data_lines) != 3:
-                logging.fatal("expected 3 lines in the annotation data file")
-            annotation_text = annotation_data_lines[0]
-            latitude = float(annotation_data_lines[1])
-            longitude = float(annotation_data_lines[2])
-
-            hist = self.get_image_histogram(img)
-            kp, des = self.feature_extraction_algo.detectAndCompute(img, None)
-
-            # Store the keypoints, descriptors, hist, image name, and cv image
-            # in the database
-            key = os.path.splitext(os.path.basename(filename))[0]
-            self.table.add_annotation(key, kp, des, hist, img,
-                                      annotation_text, latitude, longitude,
-                                      persist_to_disk=False)
+        num_computed = 0
+        # Published to matching as one snapshot once all of them are in
+        with self.table.batch():
+            for filename in db_filelist:
+                annotation_text_filename = filename.replace('jpg', 'txt')
+                annotation_data = self.get_file_content(annotation_text_filename)
+
+                annotation_data_lines = annotation_data.splitlines()
+                if len(annotation_data_lines) != 3:
+                    logging.fatal("expected 3 lines in the annotation data file")
+                annotation_text = annotation_data_lines[0]
+                latitude = float(annotation_data_lines[1])
+                longitude = float(annotation_data_lines[2])
+                if select is not None and not select(latitude, longitude):
+                    continue
+
+                img = cv2.imread(filename, 0)
+                img = cv2.resize(img, (config.IM_WIDTH, config.IM_HEIGHT))
+
+                # Only run feature extraction for images whose precomputed
+                # features are missing or stale
+                stored = feature_store.load_features(filename)
+                if stored is None:
+                    hist = self.get_image_histogram(img)
+                    kp, des = self.feature_extraction_algo.detectAndCompute(img, None)
+                    dct = features.compute_dct_features(img)
+                    feature_store.save_features(filename, kp, des, hist, dct)
+                    num_computed += 1
+                else:
+                    kp, des, hist, dct = stored
+
+                # Store the keypoints, descriptors, hist, image name, and cv image
+                # in the database
+                key = os.path.splitext(os.path.basename(filename))[0]
+                self.table.add_annotation(key, kp, des, hist, img,
+                                          annotation_text, latitude, longitude,
+                                          persist_to_disk=False, dct=dct)
+
+        logging.info(f"Added {len(self.table.get_keys())} of "
+                     f"{len(db_filelist)} images to table, computed "
+                     f"features for {num_computed} of them")
 
-    def add_new_annotation(self, extras, frame):
+    def add_new_annotation(self, extras, query):
         '''
         Add a new annotation to the database if the client specifies one.
+        query holds the features of the frame that the annotation corresponds
+        to, as computed by ImageMatcher.prepare_query, so that matching the
+        same frame afterwards can reuse them.
         '''
 
-        # The frame that the annotation corresponds to.
-        annotation_image = \
-            cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE)
-        annotation_image = \
-            cv2.resize(annotation_image, (config.IM_WIDTH, config.IM_HEIGHT))
-
-        kp, des = self.feature_extraction_algo.detectAndCompute(annotation_image, None)
-        hist = self.get_image_histogram(annotation_image)
+        # The ingest buffer is reused for the next frame, so the table gets
+        # its own copy
+        annotation_image = query.img.copy()
 
         # Compute filename to store annotation in.
-        annotation_index = self.get_next_annotation_file_index()
-        annotation_filename = 'annotation' + str(annotation_index)
+        annotation_filename = self.get_next_annotation_key()
 
         latitude = extras.current_location.latitude
         longitude = extras.current_location.longitude
 
         # Add annotation to the database.
         self.table.add_annotation(
-            annotation_filename, kp, des, hist, annotation_image,
-            extras.annotation_text, latitude, longitude)
+            annotation_filename, query.kp, query.des, query.hist,
+            annotation_image, extras.annotation_text, latitude, longitude,
+            dct = query.dct)
 
     def handle(self, input_frame):
+        if self.recorder is not None:
+            self.recorder.write(input_frame)
+        with metrics.timed('total'):
+            return self.handle_frame(input_frame)
+
+    def handle_frame(self, input_frame):
         # Receive data from control VM
         logging.log(VLOG1, "received new image")
         result = {}
+        metrics.count('frames')
+        # Score of the match of this frame, None if there is none or it was
+        # not scored
+        self.last_score = None
 
         status = gabriel_pb2.ResultWrapper.Status.SUCCESS
 
-        frame_bytes = input_frame.payloads[0]
-        frame = np.frombuffer(input_frame.payloads[0], dtype=np.uint8)
+        # Engines that share a packed database switch to its newest
+        # generation between frames
+        if self.shared_db is not None and self.shared_db.table is not self.table:
+            self.table = self.shared_db.table
+            self.matcher.set_table(self.table)
+
+        # Decode and resize the frame once for everything below
+        img = self.ingest.decode(input_frame.payloads[0])
+        if img is None:
+            metrics.count('frames_dropped', reason='undecodable')
+            return gb_cognitive_engine.create_result_wrapper(status)
 
         latitude = 0
         longitude = 0
+        query = None
         if input_frame.HasField('extras'):
             extras = client_extras_pb2.Extras()
-            input_frame.extras.Unpack(extras)
+            with metrics.timed('unpack'):
+                input_frame.extras.Unpack(extras)
             if not extras.HasField('current_location'):
                 logging.error("No current_location field")
             latitude = extras.current_location.latitude
             longitude = extras.current_location.longitude
             if extras.HasField('annotation_text'):
-                self.add_new_annotation(extras, frame)
+                query = self.matcher.prepare_query(img)
+                with metrics.timed('ingest'):
+                    if self.annotation_queue is not None:
+                        # Added in the background, this frame is matched
+                        # against the annotations that are already in the
+                        # table. The features are extracted once for both.
+                        self.annotation_queue.submit(
+                            img, extras.annotation_text, latitude, longitude,
+                            query.kp, query.des, query.hist)
+                    else:
+                        self.add_new_annotation(extras, query)
         else:
             logging.error("Did not receive extras field")
 
-        # Preprocessing of input image
-        img = cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE)
+        # Frames that are too blurred or badly exposed to match anything are
+        # dropped before feature extraction
+        if config.USE_QUALITY_GATE:
+            is_ok, reason, sharpness = zc.check_frame_quality(
+                img, min_sharpness = config.QUALITY_MIN_SHARPNESS,
+                max_clipped_fraction = config.QUALITY_MAX_CLIPPED_FRACTION)
+            if not is_ok:
+                metrics.count('frames_dropped', reason=reason)
+                dropped = metrics.REGISTRY.value('frames_dropped', reason=reason)
+                logging.log(VLOG1, f"Dropping {reason} frame ({sharpness=}), "
+                                   f"{dropped} dropped so far")
+                return gb_cognitive_engine.create_result_wrapper(status)
 
         # Get image match
         query_coords = (latitude, longitude)
-        match_start_time = time.time()
         useGpsFilter = False
         with self.gpsFilterLock:
             useGpsFilter = self.gpsFilterEnabled
         logging.log(VLOG1, f"{useGpsFilter=}")
 
-        match = self.matcher.match(img, query_coords, gps_filtering=useGpsFilter)
-        match_end_time = time.time()
+        with metrics.timed('match') as timer:
+            match = self.matcher.match(img, query_coords,
+                                       gps_filtering=useGpsFilter, query=query)
+        self.last_score = match.get('score')
 
         # Send annotation data to mobile client
         annotation = {}
         if match['key'] is not None:
             num_matches_considered = match['num_matches_considered']
             logging.info(f"Match found: {match['key']}. "
-                         f"It took {match_end_time - match_start_time} seconds"
+                         f"It took {timer.seconds} seconds"
                           " to performing image matching against "
                          f"{num_matches_considered} stored annotations")
             annotated_text = match['annotated_text']
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+from collections import namedtuple
+import logging
+import queue
+from threading import Thread
+
+import feature_backend
+import features
+
+VLOG1 = 15
+
+# A new annotation waiting to be added, with the features of img if the
+# sender has already extracted them
+AnnotationRequest = namedtuple('AnnotationRequest',
+                               'img annotation_text latitude longitude '
+                               'kp des hist', defaults = (None, None, None))
+
+# Adds new annotations to the table on a background thread, so that feature
+# extraction and the disk writes do not hold up the match response of the
+# frame that carried the annotation. The queue is bounded: submit waits for
+# room for at most put_timeout seconds and then gives up, which pushes back on
+# a client that adds annotations faster than they can be stored. next_key is
+# called on the worker thread to name each annotation.
+class AnnotationQueue:
+    def __init__(self, table, next_key, max_size, put_timeout):
+        self.table = table
+        self.next_key = next_key
+        self.put_timeout = put_timeout
+        self.requests = queue.Queue(maxsize = max_size)
+        # Detectors are not thread-safe, so the worker has its own
+        self.detector = feature_backend.create_detector()
+        Thread(target = self.worker_loop, daemon = True).start()
+
+    # Queues an annotation of img, which is copied since the caller may reuse
+    # its buffer. kp, des and hist are the features of img if the caller has
+    # already extracted them, else the worker does. Returns whether it was
+    # queued.
+    def submit(self, img, annotation_text, latitude, longitude,
+               kp = None, des = None, hist = None):
+        request = AnnotationRequest(
+            img = img.copy(), annotation_text = annotation_text,
+            latitude = latitude, longitude = longitude,
+            kp = kp, des = des, hist = hist)
+        try:
+            self.requests.put(request, timeout = self.put_timeout)
+        except queue.Full:
+            logging.error(f"Annotation queue is full, dropping annotation "
+                          f"{annotation_text!r}")
+            return False
+        logging.log(VLOG1, f"Queued annotation {annotation_text!r}, "
+                           f"{self.requests.qsize()} waiting")
+        return True
+
+    def __len__(self):
+        return self.requests.qsize()
+
+    # Blocks until every queued annotation has been added
+    def join(self):
+        self.requests.join()
+
+    def worker_loop(self):
+        while True:
+            request = self.requests.get()
+            try:
+                self.add(request)
+            except Exception:
+                logging.exception(f"Could not add annotation "
+                                  f"{request.annotation_text!r}")
+            finally:
+                self.requests.task_done()
+
+    def add(self, request):
+        img = request.img
+        kp, des, hist = request.kp, request.des, request.hist
+        if kp is None:
+            kp, des = self.detector.detectAndCompute(img, None)
+            hist = features.get_image_histogram(img)
+
+        # The table only publishes the annotation to matching once it is
+        # fully indexed and written to disk
+        key = self.next_key()
+        self.table.add_annotation(key, kp, des, hist, img,
+                                  request.annotation_text, request.latitude,
+                                  request.longitude)
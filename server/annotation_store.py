@@ -0,0 +1,623 @@
+#!/usr/bin/env python
+from collections import namedtuple
+import cv2
+import io
+import logging
+import mmap
+import numpy as np
+import os
+import re
+import struct
+import time
+from threading import Event, Lock, Thread
+import zlib
+
+import config
+import feature_backend
+import feature_store
+import features
+
+VLOG1 = 15
+
+# Bump whenever the layout of a record payload changes
+ANNOTATION_STORE_VERSION = 2
+
+# Every record starts with a header: magic, kind, sequence number, key length,
+# payload length and the CRC32 of key and payload. The sequence number grows
+# with every write, so whichever record of a key has the highest one wins no
+# matter which segment it ends up in after compaction.
+HEADER = struct.Struct('<4sBQIII')
+MAGIC = b'APRT'
+PUT = 1
+DELETE = 2
+
+SEGMENT_NAME = re.compile(r'^segment-(\d+)\.log$')
+IMPORTED_MARKER = 'imported'
+
+# An annotation as kept in the store: the grayscale image, its text and
+# location, and its precomputed features. dct is the features.DctFeatures of
+# the image at IM_WIDTH x IM_HEIGHT, or None if they have to be computed.
+AnnotationRecord = namedtuple('AnnotationRecord',
+                              'img annotation_text latitude longitude kp des hist dct',
+                              defaults = (None,))
+
+# Where the latest record of a key lives
+RecordLocation = namedtuple('RecordLocation', 'segment offset length seq')
+
+def encode_record(record):
+    ok, jpeg = cv2.imencode('.jpg', record.img)
+    if not ok:
+        raise ValueError("Could not encode the annotation image")
+    des = record.des
+    if des is None:
+        des = np.empty((0, 0), dtype=np.uint8)
+    arrays = {}
+    if record.dct is not None:
+        arrays = feature_store.dct_to_arrays(record.dct)
+    buf = io.BytesIO()
+    np.savez(buf,
+             version=ANNOTATION_STORE_VERSION,
+             backend=feature_backend.backend_name(),
+             image=jpeg,
+             image_size=(record.img.shape[1], record.img.shape[0]),
+             annotation_text=record.annotation_text,
+             location=(record.latitude, record.longitude),
+             keypoints=feature_store.keypoints_to_array(record.kp),
+             descriptors=des,
+             hist=record.hist,
+             **arrays)
+    return buf.getvalue()
+
+# Returns the record in a payload and whether its features were extracted by
+# the backend in use. The image is decoded at the size it was stored at and
+# the keypoints are packed (see features.pack_keypoints). Records of version 1
+# are read without their DCT features. Without with_image, the image is only
+# decoded if the record cannot be used as it is: it is stale, was stored at
+# another size than IM_WIDTH x IM_HEIGHT or lacks its DCT features. Otherwise
+# img is None.
+def decode_record(payload, with_image = True):
+    with np.load(io.BytesIO(payload)) as data:
+        version = int(data['version'])
+        if version not in (1, ANNOTATION_STORE_VERSION):
+            raise ValueError(f"Record has version {version}, "
+                             f"expected {ANNOTATION_STORE_VERSION}")
+        fresh = str(data['backend']) == feature_backend.backend_name()
+        dct = feature_store.dct_from_arrays(data)
+        image_size = None
+        if 'image_size' in data:
+            image_size = tuple(int(x) for x in data['image_size'])
+        if image_size != (config.IM_WIDTH, config.IM_HEIGHT):
+            dct = None
+        img = None
+        if with_image or not fresh or dct is None:
+            img = cv2.imdecode(data['image'], cv2.IMREAD_GRAYSCALE)
+        latitude, longitude = data['location']
+        des = data['descriptors']
+        record = AnnotationRecord(
+            img = img, annotation_text = str(data['annotation_text']),
+            latitude = float(latitude), longitude = float(longitude),
+            kp = features.pack_keypoints(data['keypoints']),
+            des = des if des.size > 0 else None, hist = data['hist'],
+            dct = dct)
+    return record, fresh
+
+# Returns the (latitude, longitude) in a payload without decoding the rest of
+# the record
+def decode_location(payload):
+    with np.load(io.BytesIO(payload)) as data:
+        latitude, longitude = data['location']
+    return float(latitude), float(longitude)
+
+# Returns the image in a payload without decoding the rest of the record
+def decode_image(payload):
+    with np.load(io.BytesIO(payload)) as data:
+        return cv2.imdecode(data['image'], cv2.IMREAD_GRAYSCALE)
+
+def segment_path(directory, segment):
+    return os.path.join(directory, f"segment-{segment:06d}.log")
+
+# Segments are read through memory maps, so records are paged in from the
+# page cache on demand. maps holds the map of each segment read so far. The
+# map of a segment that is still being appended to is redone once it no
+# longer covers the record.
+def read_mapped(maps, directory, location):
+    end = location.offset + location.length
+    segment_map = maps.get(location.segment)
+    if segment_map is None or len(segment_map) < end:
+        if segment_map is not None:
+            segment_map.close()
+        with open(segment_path(directory, location.segment), 'rb') as f:
+            segment_map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        maps[location.segment] = segment_map
+    return segment_map[location.offset:end]
+
+# Returns (key, payload) of the record at the start of data
+def split_record(data):
+    _, _, _, key_len, _, _ = HEADER.unpack_from(data)
+    return (data[HEADER.size:HEADER.size + key_len].decode('utf-8'),
+            data[HEADER.size + key_len:])
+
+# An append-only log of annotation records split over segment files, with an
+# in-memory index from each key to its latest record. Puts and deletes are
+# appended to the active segment, which is rolled over once it reaches
+# STORE_SEGMENT_BYTES. Writes are flushed right away but only fsynced every
+# STORE_SYNC_RECORDS records or STORE_SYNC_INTERVAL seconds. Once more than
+# COMPACTION_TOMBSTONE_FRACTION of the bytes of the sealed segments are
+# superseded or deleted, they are rewritten into one segment with only the
+# live records.
+#
+# A store opened read_only is a view of one that another process writes: the
+# index is scanned once on opening and never written to, and records that
+# the writer has compacted away since read as None.
+class AnnotationStore:
+    def __init__(self, directory, read_only = False):
+        self.directory = directory
+        self.read_only = read_only
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = Lock()
+        self.index = {}
+        self.segment_bytes = {}
+        self.live_bytes = {}
+        self.maps = {}
+        self.seq = 0
+        self.key_counters = {}
+        # The latest deletion of every key that is not in the index, and the
+        # lowest sequence number in every segment, to tell whether an older
+        # put of a deleted key can still be in a segment. Segments are not in
+        # write order after a compaction, so while scanning them the
+        # deletions also tell whether a put found later is older.
+        self.tombstones = {}
+        self.first_seq = {}
+        # False if a read-only store missed segments that the writer
+        # deleted while they were being scanned
+        self.complete = True
+
+        segments = sorted(int(m.group(1)) for m in map(SEGMENT_NAME.match,
+                          os.listdir(directory)) if m is not None)
+        for segment in segments:
+            self._scan(segment)
+        if read_only:
+            logging.info(f"Opened annotation store {directory} read-only with "
+                         f"{len(self.index)} annotations")
+            return
+        # Leftovers of a compaction that did not finish
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+
+        # New segments, active or compacted, always get a number higher than
+        # any segment so far. The highest numbered segment may be a compacted
+        # one with records older than those of others, so writes go to a new
+        # segment (or an empty one) and every segment that holds records is
+        # sealed, to be compacted together.
+        self.next_segment = segments[-1] + 1 if len(segments) > 0 else 1
+        if len(segments) > 0 and self.segment_bytes[segments[-1]] == 0:
+            self.active = segments[-1]
+        else:
+            self.active = self._new_segment()
+        self.writer = open(self.segment_path(self.active), 'ab')
+        self.unsynced = 0
+        self.last_sync = time.time()
+        logging.info(f"Opened annotation store {directory} with "
+                     f"{len(self.index)} annotations in {len(segments)} segments")
+
+        # Only one compaction runs at a time, and none while held
+        self.compaction_lock = Lock()
+        self.compaction_holds = 0
+
+        self.closed = False
+        self.wakeup = Event()
+        self._start_maintenance()
+
+    def segment_path(self, segment):
+        return segment_path(self.directory, segment)
+
+    # Reads the headers of a segment into the index. A torn or corrupt record
+    # at the end, as left by a crash, is cut off. Read-only stores leave it,
+    # as it may be a record that the writer is still appending, and skip
+    # segments that the writer has deleted since they were listed.
+    def _scan(self, segment):
+        path = self.segment_path(segment)
+        self.segment_bytes[segment] = 0
+        self.live_bytes.setdefault(segment, 0)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            if not self.read_only:
+                raise
+            self.complete = False
+            return
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            magic, kind, seq, key_len, payload_len, crc = \
+                HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + key_len + payload_len
+            if magic != MAGIC or end > len(data) or \
+                    zlib.crc32(data[offset + HEADER.size:end]) != crc:
+                break
+            key = data[offset + HEADER.size:
+                       offset + HEADER.size + key_len].decode('utf-8')
+            self._apply(key, kind, RecordLocation(segment, offset,
+                                                  end - offset, seq))
+            self.seq = max(self.seq, seq)
+            offset = end
+        if offset < len(data) and not self.read_only:
+            logging.error(f"Cutting off {len(data) - offset} bytes of torn "
+                          f"or corrupt records at the end of {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        self.segment_bytes[segment] = offset
+
+    # Points the index at a new record if it is newer than the one there
+    def _apply(self, key, kind, location):
+        self.first_seq[location.segment] = min(
+            self.first_seq.get(location.segment, location.seq), location.seq)
+        tombstone = self.tombstones.get(key)
+        if tombstone is not None and tombstone.seq > location.seq:
+            return
+        current = self.index.get(key)
+        if current is not None and current.seq > location.seq:
+            return
+        if current is not None:
+            self.live_bytes[current.segment] -= current.length
+        if kind == PUT:
+            self.index[key] = location
+            self.live_bytes[location.segment] += location.length
+            self.tombstones.pop(key, None)
+        else:
+            self.index.pop(key, None)
+            self.tombstones[key] = location
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        with self.lock:
+            return list(self.index.keys())
+
+    def _append(self, key, kind, payload):
+        self.seq += 1
+        key_bytes = key.encode('utf-8')
+        header = HEADER.pack(MAGIC, kind, self.seq, len(key_bytes),
+                             len(payload), zlib.crc32(key_bytes + payload))
+        offset = self.segment_bytes[self.active]
+        self.writer.write(header)
+        self.writer.write(key_bytes)
+        self.writer.write(payload)
+        self.writer.flush()
+        length = HEADER.size + len(key_bytes) + len(payload)
+        self.segment_bytes[self.active] += length
+        self._apply(key, kind, RecordLocation(self.active, offset, length, self.seq))
+
+        self.unsynced += 1
+        if self.unsynced >= config.STORE_SYNC_RECORDS:
+            self._sync()
+        if self.segment_bytes[self.active] >= config.STORE_SEGMENT_BYTES:
+            self._roll()
+        if self.pid != os.getpid():
+            self._start_maintenance()
+        if self.needs_compaction():
+            self.wakeup.set()
+
+    def put(self, key, record):
+        payload = encode_record(record)
+        with self.lock:
+            self._append(key, PUT, payload)
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.index:
+                self._append(key, DELETE, b'')
+
+    def _read(self, location):
+        return read_mapped(self.maps, self.directory, location)
+
+    # Returns where the latest record of a key is, or None
+    def location(self, key):
+        with self.lock:
+            return self.index.get(key)
+
+    # Returns the payload of the latest record of a key, or None
+    def _get_payload(self, key):
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return None
+            try:
+                data = self._read(location)
+            except FileNotFoundError:
+                if not self.read_only:
+                    raise
+                return None
+        return split_record(data)[1]
+
+    # Returns the record of a key and whether its features are fresh, or
+    # None if there is no such key
+    def get(self, key, with_image = True):
+        payload = self._get_payload(key)
+        if payload is None:
+            return None
+        return decode_record(payload, with_image)
+
+    # Returns the image of a key at the size it was stored at, or None
+    def get_image(self, key):
+        payload = self._get_payload(key)
+        if payload is None:
+            return None
+        return decode_image(payload)
+
+    # Yields (key, record, fresh) for every annotation in the store, or only
+    # for those at a (latitude, longitude) that select returns True for. The
+    # location is read before the rest of the record is decoded, see
+    # decode_record for with_image.
+    def items(self, select = None, with_image = True):
+        for key in self.keys():
+            payload = self._get_payload(key)
+            if payload is None:
+                continue
+            if select is not None and not select(*decode_location(payload)):
+                continue
+            yield (key,) + decode_record(payload, with_image)
+
+    # Yields (key, latitude, longitude) for every annotation in the store,
+    # without decoding the rest of the records
+    def locations(self):
+        for key in self.keys():
+            payload = self._get_payload(key)
+            if payload is not None:
+                yield (key,) + decode_location(payload)
+
+    # Returns the highest number that follows prefix in a key, 0 if none does
+    def key_number(self, prefix):
+        with self.lock:
+            return self._key_number(prefix)
+
+    def _key_number(self, prefix):
+        if prefix not in self.key_counters:
+            pattern = re.compile(re.escape(prefix) + r'(\d+)$')
+            numbers = [int(m.group(1)) for m in map(pattern.match, self.index)
+                       if m is not None]
+            self.key_counters[prefix] = max(numbers, default = 0)
+        return self.key_counters[prefix]
+
+    # Returns prefix followed by a number higher than that of any key with
+    # the same prefix
+    def next_key(self, prefix):
+        with self.lock:
+            self.key_counters[prefix] = self._key_number(prefix) + 1
+            return prefix + str(self.key_counters[prefix])
+
+    def _sync(self):
+        if self.unsynced > 0:
+            os.fsync(self.writer.fileno())
+            self.unsynced = 0
+        self.last_sync = time.time()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    # Returns the number of a new, empty segment
+    def _new_segment(self):
+        segment = self.next_segment
+        self.next_segment += 1
+        self.segment_bytes[segment] = 0
+        self.live_bytes[segment] = 0
+        return segment
+
+    def _roll(self):
+        self._sync()
+        self.writer.close()
+        self.active = self._new_segment()
+        self.writer = open(self.segment_path(self.active), 'ab')
+
+    def sealed_segments(self):
+        return [segment for segment in self.segment_bytes if segment != self.active]
+
+    def needs_compaction(self):
+        sealed = self.sealed_segments()
+        total = sum(self.segment_bytes[segment] for segment in sealed)
+        dead = total - sum(self.live_bytes[segment] for segment in sealed)
+        return len(sealed) > 0 and dead > config.COMPACTION_TOMBSTONE_FRACTION * total
+
+    # Rewrites the live records of the sealed segments into a new segment and
+    # deletes the old ones. The new segment is written under a temporary name
+    # and fsynced before it replaces them, so a crash at any point leaves
+    # either the old segments or the new one in place. Records keep their
+    # sequence numbers, so the new segment can take any unused number.
+    #
+    # Sealed segments are never written to, so they are copied without
+    # holding the lock, and only the records that were not superseded
+    # meanwhile are moved over to the new segment. Deletions are dropped,
+    # unless a segment that is not compacted has records older than them
+    # and so may hold a put that they delete.
+    def compact(self):
+        with self.compaction_lock:
+            with self.lock:
+                sealed = set(self.sealed_segments())
+                if len(sealed) == 0 or self.compaction_holds > 0 or \
+                        self.closed:
+                    return
+                self._sync()
+                # Counts towards segment_bytes only once it is written
+                target = self.next_segment
+                self.next_segment += 1
+                oldest_kept = min((self.first_seq[segment]
+                                   for segment in self.segment_bytes
+                                   if segment not in sealed and
+                                   segment in self.first_seq),
+                                  default = self.seq + 1)
+                records = list(self.index.items()) + \
+                    [(key, location) for key, location in self.tombstones.items()
+                     if location.seq > oldest_kept]
+                live = sorted((location.segment, location.offset, key, location)
+                              for key, location in records
+                              if location.segment in sealed)
+
+            tmp_path = self.segment_path(target) + '.tmp'
+            maps = {}
+            moved = {}
+            offset = 0
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for _, _, key, location in live:
+                        f.write(read_mapped(maps, self.directory, location))
+                        moved[key] = (location, location._replace(
+                            segment = target, offset = offset))
+                        offset += location.length
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                for segment_map in maps.values():
+                    segment_map.close()
+            os.replace(tmp_path, self.segment_path(target))
+
+            with self.lock:
+                self.segment_bytes[target] = offset
+                self.live_bytes[target] = 0
+                if len(live) > 0:
+                    self.first_seq[target] = min(location.seq
+                                                 for _, _, _, location in live)
+                for key, (old, new) in moved.items():
+                    if self.index.get(key) == old:
+                        self.index[key] = new
+                        self.live_bytes[target] += new.length
+                    elif self.tombstones.get(key) == old:
+                        self.tombstones[key] = new
+                for key, location in list(self.tombstones.items()):
+                    if location.segment in sealed:
+                        del self.tombstones[key]
+                for segment in sealed:
+                    segment_map = self.maps.pop(segment, None)
+                    if segment_map is not None:
+                        segment_map.close()
+                    os.remove(self.segment_path(segment))
+                    del self.segment_bytes[segment]
+                    del self.live_bytes[segment]
+                    self.first_seq.pop(segment, None)
+            logging.info(f"Compacted {len(sealed)} annotation store segments "
+                         f"into one with {len(moved)} records")
+
+    # Keeps the segments that exist from being compacted away until
+    # release_compaction, for readers in other processes that are scanning
+    # them (such as the shards of geo_shard while they load)
+    def hold_compaction(self):
+        with self.lock:
+            self.compaction_holds += 1
+
+    def release_compaction(self):
+        with self.lock:
+            self.compaction_holds -= 1
+        self.wakeup.set()
+
+    # Stops the maintenance thread once any compaction under way is done and
+    # syncs the pending writes. The store can still be read, but no longer
+    # written to.
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        with self.compaction_lock:
+            with self.lock:
+                self._sync()
+                self.writer.close()
+
+    # Threads do not survive a fork, so a store that was opened before one
+    # starts its maintenance thread again on the first write in the child
+    def _start_maintenance(self):
+        self.pid = os.getpid()
+        Thread(target = self.maintenance_loop, daemon = True).start()
+
+    # Syncs pending writes every STORE_SYNC_INTERVAL seconds and compacts
+    # when needed
+    def maintenance_loop(self):
+        while True:
+            self.wakeup.wait(timeout = config.STORE_SYNC_INTERVAL)
+            self.wakeup.clear()
+            if self.closed:
+                return
+            if time.time() - self.last_sync >= config.STORE_SYNC_INTERVAL:
+                self.sync()
+            with self.lock:
+                needed = self.needs_compaction()
+            if needed:
+                self.compact()
+
+# Reads the images of a store that another process writes, straight from the
+# given location of each key (as published by packed_db), without scanning
+# the segments. Images whose records have been compacted away since read as
+# None.
+class StoreImageReader:
+    def __init__(self, directory, locations):
+        self.directory = directory
+        self.locations = locations
+        self.lock = Lock()
+        self.maps = {}
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def get_image(self, key):
+        location = self.locations.get(key)
+        if location is None:
+            return None
+        try:
+            with self.lock:
+                data = read_mapped(self.maps, self.directory, location)
+            record_key, payload = split_record(data)
+        except (OSError, ValueError, struct.error) as e:
+            logging.log(VLOG1, f"Could not read the image of {key}: {e}")
+            return None
+        if data[:len(MAGIC)] != MAGIC or record_key != key:
+            return None
+        return decode_image(payload)
+
+# Copies the annotations of the old layout, one jpg and txt file per
+# annotation in db_path, into the store. Precomputed feature files are used
+# where they are fresh, otherwise compute_features(img) returns
+# (kp, des, hist) and the DCT features are computed here. Runs once: afterwards the store is marked as imported and
+# db_path is left untouched.
+def import_db_directory(store, db_path, compute_features):
+    marker = os.path.join(store.directory, IMPORTED_MARKER)
+    if os.path.exists(marker) or not os.path.isdir(db_path):
+        return 0
+
+    filenames = sorted(f for f in os.listdir(db_path) if f.lower().endswith('jpg'))
+    logging.info(f"Importing {len(filenames)} annotations from {db_path} into "
+                 f"the annotation store")
+    num_imported = 0
+    for filename in filenames:
+        path = os.path.join(db_path, filename)
+        key = os.path.splitext(filename)[0]
+        if key in store:
+            continue
+        try:
+            with open(os.path.splitext(path)[0] + '.txt', 'r') as f:
+                lines = f.read().splitlines()
+            annotation_text = lines[0]
+            latitude = float(lines[1])
+            longitude = float(lines[2])
+        except (OSError, IndexError, ValueError) as e:
+            logging.error(f"Skipping {path}, could not read its annotation: {e}")
+            continue
+
+        img = cv2.imread(path, 0)
+        img = cv2.resize(img, (config.IM_WIDTH, config.IM_HEIGHT))
+        stored = feature_store.load_features(path)
+        if stored is None:
+            stored = compute_features(img) + (features.compute_dct_features(img),)
+        kp, des, hist, dct = stored
+        store.put(key, AnnotationRecord(
+            img = img, annotation_text = annotation_text, latitude = latitude,
+            longitude = longitude, kp = kp, des = des, hist = hist, dct = dct))
+        num_imported += 1
+
+    store.sync()
+    with open(marker, 'w') as f:
+        f.write(f"{num_imported}\n")
+    logging.info(f"Imported {num_imported} annotations from {db_path}")
+    return num_imported
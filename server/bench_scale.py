@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import json
+import logging
+import math
+import multiprocessing
+import numpy as np
+import os
+import queue
+import resource
+import subprocess
+import time
+
+import cv2
+
+import annotation_store
+import common
+import config
+import feature_backend
+import features
+from geo_index import METERS_PER_DEGREE
+
+# Measures how the engine scales with the number of annotations. For each
+# size, a synthetic annotation store is generated (and kept for later runs)
+# and a fresh process then measures the startup time of an ApertureServer
+# over it, its resident memory, and the latency of ImageMatcher.match with
+# the GPS filter on and off. Results are printed and appended to a CSV with
+# the commit they were measured at, so that runs can be compared across
+# commits.
+#
+# Annotations are spread uniformly over a square sized so that --density of
+# them are within GPS_FILTER_RADIUS_METERS of a point on average. With
+# --mode images each annotation is an augmented copy of one of the source
+# images, with its features extracted; with --mode features (much faster to
+# generate) it stores a source image with a perturbed copy of the source's
+# features as a stand-in. Query frames are fresh augmentations of the image
+# of a random annotation, located within a few meters of it. The correct
+# column counts the frames matched to that very annotation. It is left empty
+# with --mode features, where every annotation of a source image looks the
+# same and any of them is as right as the one the query was made from.
+
+CENTER = (40.4433, -79.9436)
+QUERY_LOCATION_NOISE_METERS = 5
+WARMUP_FRAMES = 3
+
+CSV_FIELDS = ('commit', 'backend', 'mode', 'density', 'annotations',
+              'startup_s', 'rss_mb', 'rss_delta_mb', 'gps_filter', 'frames',
+              'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'matched', 'correct')
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000])
+    parser.add_argument('--mode', choices=('features', 'images'),
+                        default='features',
+                        help='stand-in features perturbed from the source '
+                             'images, or features extracted from augmented '
+                             'copies of them (slow to generate at 100k)')
+    parser.add_argument('--density', type=float, default=10,
+                        help='average number of annotations within the GPS '
+                             'filter radius of a point')
+    parser.add_argument('--images', nargs='+',
+                        help='source images, by default the ones in db/ or '
+                             'else capture.jpg')
+    parser.add_argument('--backend', default=config.FEATURE_BACKEND)
+    parser.add_argument('--frames', type=int, default=20,
+                        help='query frames per size and GPS filter setting')
+    parser.add_argument('--max-gps-off-size', type=int,
+                        help='skip the GPS filter off runs above this many '
+                             'annotations')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default='server_data/bench',
+                        help='where the generated stores are kept')
+    parser.add_argument('--out', default='server_data/bench/results.csv',
+                        help='CSV file that results are appended to')
+    return parser.parse_args()
+
+def source_image_paths(args):
+    if args.images:
+        return args.images
+    if os.path.isdir('db'):
+        paths = sorted(os.path.join('db', f) for f in os.listdir('db')
+                       if f.lower().endswith('jpg'))
+        if len(paths) > 0:
+            return paths
+    return [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         'capture.jpg')]
+
+def load_source_images(paths):
+    images = []
+    for path in paths:
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise ValueError(f"Could not read {path}")
+        images.append(cv2.resize(img, (config.IM_WIDTH, config.IM_HEIGHT)))
+    return images
+
+# Returns img as seen from a slightly different viewpoint, in different
+# light and with sensor noise
+def augment(img, rng):
+    h, w = img.shape
+    corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    shift = 0.04 * min(w, h)
+    moved = corners + rng.uniform(-shift, shift, corners.shape).astype(np.float32)
+    img = cv2.warpPerspective(img, cv2.getPerspectiveTransform(corners, moved),
+                              (w, h), borderMode=cv2.BORDER_REFLECT)
+    img = cv2.convertScaleAbs(img, alpha=rng.uniform(0.8, 1.2),
+                              beta=rng.uniform(-20, 20))
+    noise = rng.normal(0, 3, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+# Returns a copy of (kp, des) with a fifth of the keypoints dropped, the rest
+# moved by about a pixel and their descriptors perturbed
+def perturb_features(kp, des, rng):
+    keep = np.sort(rng.choice(len(kp), int(0.8 * len(kp)), replace=False))
+    kp = kp[keep].copy()
+    kp['x'] += rng.normal(0, 1, len(kp)).astype(np.float32)
+    kp['y'] += rng.normal(0, 1, len(kp)).astype(np.float32)
+    des = des[keep]
+    if feature_backend.is_binary():
+        bits = np.unpackbits(des, axis=1)
+        bits ^= (rng.random(bits.shape) < 0.02).astype(np.uint8)
+        des = np.packbits(bits, axis=1)
+    else:
+        des = (des + rng.normal(0, 0.01, des.shape)).astype(des.dtype)
+    return kp, des
+
+# Returns the (latitude, longitude) of n annotations spread so that density
+# of them are within GPS_FILTER_RADIUS_METERS of a point on average
+def synthetic_locations(n, density, rng):
+    radius = config.GPS_FILTER_RADIUS_METERS
+    side_meters = math.sqrt(n * math.pi * radius * radius / density)
+    lat_span = side_meters / METERS_PER_DEGREE
+    lon_span = lat_span / math.cos(math.radians(CENTER[0]))
+    latitudes = CENTER[0] + rng.uniform(-0.5, 0.5, n) * lat_span
+    longitudes = CENTER[1] + rng.uniform(-0.5, 0.5, n) * lon_span
+    return latitudes, longitudes
+
+def synthetic_key(i):
+    return f"annotation{i + 1}"
+
+# Returns the directory of the synthetic store for n annotations, generating
+# it first unless an earlier run already has
+def synthetic_store(args, n, source_paths):
+    name = f"{args.backend}-{args.mode}-d{args.density:g}-s{args.seed}-{n}"
+    directory = os.path.join(args.work_dir, name)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_path):
+        return directory
+
+    logging.info(f"Generating {n} synthetic annotations in {directory}")
+    start_time = time.time()
+    rng = np.random.default_rng(args.seed)
+    images = load_source_images(source_paths)
+    detector = feature_backend.create_detector()
+    source_features = []
+    for img in images:
+        kp, des = detector.detectAndCompute(img, None)
+        source_features.append((features.pack_keypoints(kp), des,
+                                features.get_image_histogram(img),
+                                features.compute_dct_features(img)))
+
+    store = annotation_store.AnnotationStore(directory)
+    latitudes, longitudes = synthetic_locations(n, args.density, rng)
+    for i in range(n):
+        source = i % len(images)
+        if args.mode == 'images':
+            img = augment(images[source], rng)
+            kp, des = detector.detectAndCompute(img, None)
+            hist = features.get_image_histogram(img)
+            dct = features.compute_dct_features(img)
+        else:
+            img = images[source]
+            kp, des, hist, dct = source_features[source]
+            kp, des = perturb_features(kp, des, rng)
+        store.put(synthetic_key(i), annotation_store.AnnotationRecord(
+            img = img, annotation_text = f"synthetic annotation {i + 1}",
+            latitude = float(latitudes[i]), longitude = float(longitudes[i]),
+            kp = kp, des = des, hist = hist, dct = dct))
+        if (i + 1) % 1000 == 0:
+            logging.info(f"Generated {i + 1} of {n} annotations")
+    store.sync()
+
+    # Keeps the engine from importing db/ into the synthetic store
+    with open(os.path.join(directory, annotation_store.IMPORTED_MARKER), 'w') as f:
+        f.write("0\n")
+    with open(manifest_path, 'w') as f:
+        json.dump({'annotations': n, 'mode': args.mode, 'density': args.density,
+                   'seed': args.seed, 'backend': args.backend,
+                   'sources': [os.path.abspath(p) for p in source_paths]}, f)
+    logging.info(f"Generated {n} annotations in {time.time() - start_time:.1f} s")
+    return directory
+
+# Returns the resident set size of this process in bytes
+def resident_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak rather than current, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Runs in a fresh process per size so that memory is measured from scratch
+def measure(store_dir, n, args, source_paths, results):
+    common.configure_logging()
+    config.FEATURE_BACKEND = args.backend
+    # Every frame is matched in full against every loaded annotation
+    config.USE_RESULT_CACHE = False
+    config.USE_TRACKING = False
+    config.USE_GEO_PAGING = False
+    config.USE_ANNOTATION_QUEUE = False
+    config.METRICS_PORT = None
+
+    import annotation_engine
+    import table
+
+    store_dir = os.path.abspath(store_dir)
+    # The engine creates db/ in the working directory
+    os.chdir(os.path.dirname(store_dir))
+    rss_before = resident_bytes()
+    start_time = time.time()
+    store = annotation_store.AnnotationStore(store_dir)
+    engine = annotation_engine.ApertureServer(table.ImageDataTable(store=store),
+                                              paging=False)
+    startup = time.time() - start_time
+    rss = resident_bytes()
+
+    rng = np.random.default_rng(args.seed + 1)
+    images = load_source_images(source_paths)
+    snapshot = engine.table.snapshot()
+    queries = []
+    for target in rng.choice(n, WARMUP_FRAMES + args.frames):
+        key = synthetic_key(target)
+        data = snapshot.get_all_data(key)
+        meters = rng.normal(0, QUERY_LOCATION_NOISE_METERS, 2)
+        coords = (data.latitude + meters[0] / METERS_PER_DEGREE,
+                  data.longitude + meters[1] / METERS_PER_DEGREE /
+                  math.cos(math.radians(data.latitude)))
+        queries.append((key, augment(images[target % len(images)], rng), coords))
+
+    rows = []
+    for gps_filter in (True, False):
+        if not gps_filter and args.max_gps_off_size is not None and \
+                n > args.max_gps_off_size:
+            continue
+        latencies = []
+        matched = 0
+        correct = 0
+        for i, (key, img, coords) in enumerate(queries):
+            frame_start_time = time.perf_counter()
+            response = engine.matcher.match(img, coords, gps_filtering=gps_filter,
+                                            display_match=False)
+            if i < WARMUP_FRAMES:
+                continue
+            latencies.append(time.perf_counter() - frame_start_time)
+            if response['key'] is not None:
+                matched += 1
+                correct += response['key'] == key
+        if args.mode == 'features':
+            correct = ''
+        latencies = 1000 * np.array(latencies)
+        p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+        rows.append({
+            'annotations': n, 'startup_s': round(startup, 3),
+            'rss_mb': round(rss / 2**20, 1),
+            'rss_delta_mb': round((rss - rss_before) / 2**20, 1),
+            'gps_filter': 'on' if gps_filter else 'off',
+            'frames': len(latencies), 'p50_ms': round(p50, 2),
+            'p95_ms': round(p95, 2), 'p99_ms': round(p99, 2),
+            'mean_ms': round(latencies.mean(), 2),
+            'matched': matched, 'correct': correct})
+    results.put(rows)
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def write_rows(path, rows):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        if is_new:
+            writer.writeheader()
+        writer.writerows(rows)
+
+def print_rows(rows):
+    columns = ('annotations', 'startup_s', 'rss_mb', 'gps_filter', 'p50_ms',
+               'p95_ms', 'p99_ms', 'mean_ms', 'matched', 'correct')
+    print(''.join(f"{column:>13}" for column in columns))
+    for row in rows:
+        print(''.join(f"{row[column]:>13}" for column in columns))
+
+def main():
+    common.configure_logging()
+    args = parse_args()
+    config.FEATURE_BACKEND = args.backend
+    # Measurements run from the directory of the store
+    source_paths = [os.path.abspath(p) for p in source_image_paths(args)]
+    commit = current_commit()
+
+    # Each size is measured in a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    all_rows = []
+    for n in args.sizes:
+        store_dir = synthetic_store(args, n, source_paths)
+        results = context.Queue()
+        process = context.Process(target=measure,
+                                  args=(store_dir, n, args, source_paths, results))
+        process.start()
+        rows = None
+        while rows is None:
+            try:
+                rows = results.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"Measuring {n} annotations failed "
+                                       f"with exit code {process.exitcode}")
+        process.join()
+        for row in rows:
+            row.update(commit=commit, backend=args.backend, mode=args.mode,
+                       density=args.density)
+        write_rows(args.out, rows)
+        all_rows += rows
+        print_rows(rows)
+
+    print(f"Results for {commit or 'this tree'} appended to {args.out}")
+    print_rows(all_rows)
+
+if __name__ == '__main__':
+    main()
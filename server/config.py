@@ -41,25 +41,186 @@ DISPLAY_LIST_TEST = []
 DISPLAY_LIST_STREAM = []
 DISPLAY_LIST_TASK = []
 
+# Where to show match visualizations for debugging: None to run headless,
+# 'window' for an on-screen window or 'file' to cycle through
+# DISPLAY_MAX_FILES images in DISPLAY_DIR. At most DISPLAY_MAX_FPS frames per
+# second are drawn.
+DISPLAY_SINK = None
+DISPLAY_MAX_FPS = 2
+DISPLAY_DIR = 'server_data/matches'
+DISPLAY_MAX_FILES = 20
+
 # Used for cvWaitKey
 DISPLAY_WAIT_TIME = 1 if IS_STREAMING else 500
 
+# Frames whose Laplacian variance is below QUALITY_MIN_SHARPNESS (blurred), or
+# with more than QUALITY_MAX_CLIPPED_FRACTION of their pixels nearly black or
+# white (badly exposed), are dropped without matching
+USE_QUALITY_GATE = True
+QUALITY_MIN_SHARPNESS = 3.0
+QUALITY_MAX_CLIPPED_FRACTION = 0.6
+
 # Minimum number of matches
 MIN_SCORE = 160
 
 # Distance threshold for the ratio test
 DISTANCE_THRESH = 0.75
 
+# An annotation is only a candidate if at least this fraction of the
+# keypoints of the frame or of the annotation, whichever has more, match
+MIN_MATCH_FRACTION = 0.07
+
 # Histogram comparison thresholds
 CORREL_TH = 50
 MWN_TH = 30
 DCT_TH = 90
 
+# Side of the low frequency DCT block kept for each image. The DCT
+# correlation is estimated from it and only computed over the full image when
+# the estimate is too close to DCT_TH to decide.
+DCT_BLOCK_SIZE = 64
+
+# Annotations farther than this from the query location are skipped when the
+# GPS filter is enabled
+GPS_FILTER_RADIUS_METERS = 50
+# Size of the latitude/longitude grid cells of the spatial index
+GEO_CELL_DEGREES = 0.001
+
+# Feature detector: KAZE (float descriptors), or AKAZE, ORB or BRISK (binary
+# descriptors, much cheaper to extract and match)
+FEATURE_BACKEND = 'KAZE'
+ORB_N_FEATURES = 2000
+# Matcher for binary descriptors: 'lsh' for FLANN LSH or 'bf' for brute-force
+# Hamming
+BINARY_MATCHER = 'lsh'
+
 # FLANN parameters
 FLANN_INDEX_KDTREE = 1
 INDEX_PARAMS = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
+FLANN_INDEX_LSH = 6
+LSH_INDEX_PARAMS = dict(algorithm = FLANN_INDEX_LSH, table_number = 6,
+                        key_size = 12, multi_probe_level = 1)
 SEARCH_PARAMS = dict(checks = 50)
 
+# Match every frame against one FLANN index built over the descriptors of all
+# stored annotations instead of calling knnMatch once per annotation
+USE_GLOBAL_INDEX = True
+# Number of neighbours fetched per query descriptor from the global index.
+# The ratio test of a neighbour whose annotation has no second neighbour
+# among them is settled by a knnMatch against that annotation alone, so a
+# larger K trades a slower query for fewer of those.
+GLOBAL_INDEX_KNN = 8
+
+# Number of threads that verify the candidates of a frame in parallel, 1 to
+# verify them on the calling thread. Each thread gets at least
+# MATCH_MIN_CHUNK_SIZE candidates.
+MATCH_THREADS = 1
+MATCH_MIN_CHUNK_SIZE = 8
+
+# Cache of recent match responses keyed by a perceptual hash of the frame and
+# its GPS cell. A frame within RESULT_CACHE_MAX_HASH_DISTANCE bits of a cached
+# frame gets its response. Entries expire after RESULT_CACHE_TTL seconds.
+USE_RESULT_CACHE = True
+RESULT_CACHE_SIZE = 64
+RESULT_CACHE_TTL = 2.0
+RESULT_CACHE_MAX_HASH_DISTANCE = 4
+
+# Tracking mode: after a match, later frames are first checked against the
+# matched annotation only, and a full search runs only once it is lost. With
+# TRACKING_USE_FLOW the matched points are followed with optical flow without
+# extracting features, for up to TRACKING_MAX_FLOW_FRAMES frames in a row.
+USE_TRACKING = False
+TRACKING_USE_FLOW = True
+TRACKING_MAX_FLOW_FRAMES = 30
+# The flow is lost when fewer than this many points, or this fraction of the
+# points it started with, are still tracked
+TRACKING_MIN_POINTS = 20
+TRACKING_MIN_POINT_RATIO = 0.5
+# Maximum forward-backward flow error in pixels for a point to count as tracked
+TRACKING_MAX_FB_ERROR = 1.0
+
+# Only match against the annotations whose VLAD vectors are most similar to
+# the query's
+USE_SHORTLIST = False
+SHORTLIST_TOP_K = 20
+# Number of visual words, and number of stored descriptors sampled to train
+# them
+VOCABULARY_SIZE = 64
+VOCABULARY_SAMPLE_SIZE = 100000
+# Retrain the vocabulary once the table has grown by this factor
+VOCABULARY_RETRAIN_GROWTH = 2
+
+# Changes to the table are kept apart from the bulk of it (e.g. in a small
+# delta descriptor index) so that they are cheap to apply. Once more than
+# delta_limit annotations have changed, DELTA_MAX_FRACTION of the bulk but at
+# least DELTA_MAX_ANNOTATIONS, or more than COMPACTION_TOMBSTONE_FRACTION of
+# the stored rows belong to removed or replaced annotations, the table is
+# compacted in the background. The descriptor index seals its delta into a
+# segment of its own every DELTA_MAX_ANNOTATIONS changes in between.
+DELTA_MAX_ANNOTATIONS = 32
+DELTA_MAX_FRACTION = 0.1
+COMPACTION_TOMBSTONE_FRACTION = 0.25
+
+def delta_limit(size):
+    return max(DELTA_MAX_ANNOTATIONS, DELTA_MAX_FRACTION * size)
+
+# Annotations are persisted in an append-only log of segment files in
+# ANNOTATION_STORE_DIR instead of one jpg and txt file each in db/, which is
+# imported once. Segments are rolled over at STORE_SEGMENT_BYTES, and writes
+# are fsynced every STORE_SYNC_RECORDS records or STORE_SYNC_INTERVAL seconds.
+USE_ANNOTATION_STORE = True
+ANNOTATION_STORE_DIR = 'server_data/store'
+STORE_SEGMENT_BYTES = 64 * 1024 * 1024
+STORE_SYNC_RECORDS = 16
+STORE_SYNC_INTERVAL = 1.0
+
+# Annotation images are read back from disk when needed (for display and the
+# exact DCT correlation) instead of being kept in memory. This many of the
+# most recently read ones are cached.
+IMAGE_CACHE_SIZE = 8
+
+# New annotations are extracted, written to disk and indexed on a background
+# thread. At most ANNOTATION_QUEUE_SIZE of them wait in the queue; once it is
+# full, handle waits up to ANNOTATION_QUEUE_TIMEOUT seconds for room and then
+# drops the annotation.
+USE_ANNOTATION_QUEUE = True
+ANNOTATION_QUEUE_SIZE = 8
+ANNOTATION_QUEUE_TIMEOUT = 0.5
+
+# With --workers N, annotation_engine.py loads the annotations in one process
+# and publishes them as a packed database of memory-mapped files in
+# SHARED_DB_DIR (see packed_db), then starts N engine processes that attach to
+# it read-only and connect to server.py. Annotations sent to the engines are
+# added by the loading process, which republishes at most every
+# SHARED_DB_PUBLISH_INTERVAL seconds and keeps the last
+# SHARED_DB_KEEP_GENERATIONS generations on disk.
+SHARED_DB_DIR = 'server_data/shared_db'
+SHARED_DB_PUBLISH_INTERVAL = 10.0
+SHARED_DB_KEEP_GENERATIONS = 3
+
+# annotation_engine.py --shards N splits the annotations over N engine
+# processes by location, in cells of SHARD_CELL_DEGREES, and routes each frame
+# to the engine of its cell. Each engine also holds the annotations within
+# GPS_FILTER_RADIUS_METERS of its cells. Needs USE_ANNOTATION_STORE.
+SHARD_CELL_DEGREES = 0.01
+
+# Instead of loading every stored annotation at startup, the engine loads the
+# regions of GEO_PAGE_DEGREES around each GPS-filtered query the first time a
+# query lands near them, and evicts the least recently queried regions once
+# the loaded annotations take more than GEO_PAGE_BUDGET_BYTES. Frames matched
+# without the GPS filter only see the loaded regions. Needs
+# USE_ANNOTATION_STORE.
+USE_GEO_PAGING = False
+GEO_PAGE_DEGREES = 0.01
+GEO_PAGE_BUDGET_BYTES = 1024 * 1024 * 1024
+
+# Per-stage latencies (p50/p95/p99 over the last METRICS_WINDOW frames) and
+# frame counters are served in the Prometheus text format at
+# http://127.0.0.1:METRICS_PORT/metrics, or not at all if None. Engines
+# started with --workers or --shards serve theirs on the ports after it.
+METRICS_PORT = 9108
+METRICS_WINDOW = 1024
+
 # NOTE: TEST CODE
 
 ANNOTATION_INDEX = {'view.jpg' : "What a great view!",
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+from collections import Counter, namedtuple
+import cv2
+import logging
+import numpy as np
+from threading import Lock
+
+import config
+import feature_backend
+
+VLOG1 = 15
+
+# A kNN index over the stacked descriptors of a group of annotations. Every
+# version of an annotation gets its own slot number: owners maps each row of
+# the index to its slot, offsets to the first row of that slot, and des holds
+# the descriptors of each slot as a view into the stacked matrix.
+Segment = namedtuple('Segment', 'index owners offsets des')
+
+# What queries read, swapped in as a whole: the main segment (or None), the
+# tiers, the delta segment (or None), the key of every slot, whether each
+# slot is still live and the number of rows of live slots
+IndexState = namedtuple('IndexState',
+                        'main tiers delta slot_keys live num_live_rows')
+
+def build_segment(slots, des_list):
+    if len(slots) == 0:
+        return None
+    return stacked_segment(slots, np.vstack(des_list),
+                           [len(des) for des in des_list])
+
+# Same as build_segment over descriptors that are already stacked, slots[i]
+# owning the next counts[i] rows of data. The index is built on data itself
+# when it already has the dtype of the backend.
+def stacked_segment(slots, data, counts):
+    if len(slots) == 0:
+        return None
+    counts = np.array(counts, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    index = feature_backend.KnnIndex(data)
+    return Segment(index = index,
+                   owners = np.repeat(np.array(slots, dtype=np.int32), counts),
+                   offsets = np.repeat(starts.astype(np.int32), counts),
+                   des = {slot: index.data[start:start + count] for slot, start, count
+                          in zip(slots, starts.tolist(), counts.tolist())})
+
+# Returns the (slots, local indices, distances) of the k nearest rows of a
+# segment, padded with -1 and infinite distances, and for each query
+# descriptor a lower bound on the distance of the rows that were not returned:
+# infinite if there are none, 0 if it is unknown
+def search_segment(segment, query_des, k):
+    slots = np.full((len(query_des), k), -1, dtype=np.int64)
+    local = np.full((len(query_des), k), -1, dtype=np.int64)
+    dists = np.full((len(query_des), k), np.inf)
+    bound = np.full(len(query_des), np.inf)
+    if segment is None:
+        return slots, local, dists, bound
+    k_found = min(k, len(segment.index))
+    idx, found = segment.index.search(query_des, k_found)
+    valid = idx >= 0
+    slots[:, :k_found] = np.where(valid, segment.owners[idx], -1)
+    local[:, :k_found] = np.where(valid, idx - segment.offsets[idx], -1)
+    dists[:, :k_found] = found
+    if len(segment.index) > k_found:
+        last = found[:, -1]
+        bound = np.where(np.isinf(last), 0, last)
+    return slots, local, dists, bound
+
+# Returns the descriptors of a slot in the segments of an IndexState, None if
+# it is in none of them
+def slot_descriptors(state, slot):
+    for segment in (state.main,) + state.tiers + (state.delta,):
+        if segment is not None and slot in segment.des:
+            return segment.des[slot]
+    return None
+
+# A single kNN index over the descriptors of every annotation in the table.
+# Each row of the stacked descriptor matrix is mapped back to the annotation
+# it came from, so one kNN query per frame yields the ratio-tested matches for
+# every annotation at once instead of one knnMatch call per annotation.
+#
+# The annotations are split over a main segment, tiers and a delta. The
+# delta holds the annotations added since the last compaction and is rebuilt
+# by the writer on refresh after its changes, so compaction keeps it to about DELTA_MAX_ANNOTATIONS
+# by sealing it into a tier of its own. A new tier is merged with the last
+# tiers that are no larger than it, so there are only a logarithmic number
+# of them and every annotation is copied a logarithmic number of times. The
+# main segment is only rebuilt over every annotation once the tiers and delta
+# together grow past config.delta_limit of it, so the cost of rebuilding it
+# is spread over a number of changes that grows with it.
+#
+# Removed and replaced annotations are tombstoned and skipped until
+# compaction drops their rows. Once an annotation is in the main segment or a
+# tier, its descriptors are a view into the stacked matrix of that segment
+# rather than a copy of their own.
+class DescriptorIndex:
+    def __init__(self):
+        self.lock = Lock()
+        self.compact_lock = Lock()
+        self.descriptors = {}
+        self.slots = {}
+        self.slot_keys = []
+        self.live = np.zeros(0, dtype=bool)
+        self.main = None
+        self.main_slots = set()
+        self.main_tombstones = 0
+        # Sealed segments, largest first
+        self.tiers = []
+        self.delta_slots = []
+        self.num_live_rows = 0
+        self.dirty = False
+        self.state = IndexState(None, (), None, self.slot_keys, self.live, 0)
+
+    # Returns the slot of the descriptors, None if there are none
+    def add(self, key, des):
+        with self.lock:
+            self._remove(key)
+            if des is None or len(des) == 0:
+                return None
+            slot = len(self.slot_keys)
+            self.slot_keys.append(key)
+            if slot == len(self.live):
+                self.live = np.concatenate(
+                    (self.live, np.zeros(max(16, slot), dtype=bool)))
+            self.live[slot] = True
+            self.slots[key] = slot
+            self.descriptors[key] = des
+            self.num_live_rows += len(des)
+            self.delta_slots.append(slot)
+            return slot
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        self.dirty = True
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        self.num_live_rows -= len(self.descriptors.pop(key))
+        self.live[slot] = False
+        if slot in self.main_slots:
+            self.main_tombstones += 1
+        elif slot in self.delta_slots:
+            self.delta_slots.remove(slot)
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    # Fills an empty index with descriptors that are already stacked, such as
+    # the memory-mapped ones of a packed_db: keys[i] owns the next counts[i]
+    # rows of data. They go straight into the main segment, which keeps
+    # views into data rather than copies. Returns the slot of each key, None
+    # for those without descriptors.
+    def load(self, keys, data, counts):
+        with self.lock:
+            slots = []
+            for key, count in zip(keys, counts):
+                if count == 0:
+                    slots.append(None)
+                    continue
+                slots.append(len(self.slot_keys))
+                self.slots[key] = slots[-1]
+                self.slot_keys.append(key)
+            main_slots = [slot for slot in slots if slot is not None]
+            self.live = np.ones(len(self.slot_keys), dtype=bool)
+            self.main = stacked_segment(main_slots, data,
+                                        [count for count in counts if count > 0])
+            self.main_slots = set(main_slots)
+            for slot in main_slots:
+                self.descriptors[self.slot_keys[slot]] = self.main.des[slot]
+            self.num_live_rows = int(sum(counts))
+            self.dirty = True
+            return slots
+
+    # Returns the descriptors of a key, a view into the main segment once it
+    # has been compacted into it
+    def get_descriptors(self, key):
+        with self.lock:
+            return self.descriptors.get(key)
+
+    # Returns whether the delta should be sealed into a tier or the main
+    # segment rebuilt
+    def needs_compaction(self):
+        return len(self.delta_slots) > config.DELTA_MAX_ANNOTATIONS or \
+            self._needs_rebuild()
+
+    # Returns whether the main segment should be rebuilt, because the
+    # annotations outside of it have grown too many or too many of its rows
+    # are tombstoned
+    def _needs_rebuild(self):
+        outside = len(self.delta_slots) + \
+            sum(len(tier.des) for tier in self.tiers)
+        return outside > config.delta_limit(len(self.main_slots)) or \
+            self.main_tombstones > \
+            config.COMPACTION_TOMBSTONE_FRACTION * len(self.main_slots)
+
+    # Rebuilds the main segment over every live annotation if needed, else
+    # seals the delta into a tier. The build runs without holding the lock,
+    # annotations added meanwhile stay in the delta. The descriptors of the
+    # annotations built over are replaced by their views into the new
+    # segment, and their keys returned, so that callers holding on to the old
+    # arrays (such as the table) can swap them for the views and let the
+    # copies go.
+    def compact(self):
+        with self.compact_lock:
+            with self.lock:
+                rebuild = self._needs_rebuild()
+                tiers = list(self.tiers)
+                if rebuild:
+                    slots = list(self.slots.values())
+                else:
+                    merged = [self.delta_slots]
+                    size = len(self.delta_slots)
+                    while len(tiers) > 0 and len(tiers[-1].des) <= size:
+                        size += len(tiers[-1].des)
+                        merged.append(list(tiers.pop().des))
+                    slots = [slot for group in merged for slot in group
+                             if self.slots.get(self.slot_keys[slot]) == slot]
+                des_list = [self.descriptors[self.slot_keys[slot]]
+                            for slot in slots]
+            segment = build_segment(slots, des_list)
+            with self.lock:
+                moved = []
+                for slot in slots:
+                    key = self.slot_keys[slot]
+                    if self.slots.get(key) == slot:
+                        self.descriptors[key] = segment.des[slot]
+                        moved.append(key)
+                if rebuild:
+                    self.main = segment
+                    self.main_slots = set(slots)
+                    self.main_tombstones = \
+                        sum(1 for slot in slots if not self.live[slot])
+                    self.tiers = []
+                else:
+                    self.tiers = tiers if segment is None else tiers + [segment]
+                built = set(slots)
+                self.delta_slots = [slot for slot in self.delta_slots
+                                    if slot not in built]
+                self.dirty = True
+            logging.log(VLOG1, f"Built descriptor index "
+                               f"{'main segment' if rebuild else 'tier'} over "
+                               f"{sum(len(des) for des in des_list)} "
+                               f"descriptors from {len(slots)} annotations")
+            return moved
+
+    # Rebuilds the delta segment and publishes the new state, if there have
+    # been changes since the last time. Changes and compactions only show up
+    # in queries once a writer calls it, which the table does whenever it
+    # publishes a snapshot.
+    def refresh(self):
+        if self.dirty:
+            with self.lock:
+                if self.dirty:
+                    self._refresh()
+
+    def _refresh(self):
+        delta = build_segment(
+            self.delta_slots,
+            [self.descriptors[self.slot_keys[slot]] for slot in self.delta_slots])
+        self.state = IndexState(self.main, tuple(self.tiers), delta,
+                                self.slot_keys, self.live.copy(),
+                                self.num_live_rows)
+        self.dirty = False
+
+    # Returns a dict mapping each annotation key to the list of its matches
+    # that pass the ratio test. The trainIdx of every match is local to the
+    # annotation's own descriptors, as if knnMatch had been called on it alone.
+    # If a table snapshot is given, only the annotations that it holds with
+    # the same descriptors (the same slot) are returned. The state of the last
+    # refresh is searched, queries never build a segment themselves.
+    def query(self, query_des, snapshot = None):
+        state = self.state
+
+        candidates = {}
+        if query_des is None or len(query_des) == 0:
+            return candidates
+
+        k = min(config.GLOBAL_INDEX_KNN, state.num_live_rows)
+        if k < 2:
+            return candidates
+
+        # The k nearest live rows overall are among the nearest rows of each
+        # segment. Each segment is searched a bit deeper than k to make up for
+        # tombstoned rows, which belong to no annotation and are dropped.
+        results = [search_segment(segment, query_des, 2 * k)
+                   for segment in (state.main,) + state.tiers + (state.delta,)]
+        slots, local, dists = (np.hstack([result[i] for result in results])
+                               for i in range(3))
+        alive = (slots >= 0) & state.live[np.maximum(slots, 0)]
+        dists = np.where(alive, dists, np.inf)
+        order = np.argsort(dists, axis=1, kind='stable')[:, :k]
+        slots = np.take_along_axis(slots, order, axis=1)
+        local = np.take_along_axis(local, order, axis=1)
+        dists = np.take_along_axis(dists, order, axis=1)
+        alive = np.take_along_axis(alive, order, axis=1)
+        neighbour_owners = np.where(alive, slots, -1)
+
+        # Rows that were not returned are at least as far as the k-th live
+        # row, if there are k of them, and as the last row of each segment
+        bound = np.minimum.reduce([result[3] for result in results] +
+                                  [dists[:, -1]])[:, np.newaxis]
+
+        # For every neighbour that is the closest one from its annotation, the
+        # second closest from the same annotation plays the role of n in the
+        # ratio test. If it was not among the k kept, the bound above is a
+        # lower bound on it: a neighbour that passes against it passes
+        # against n too, the others are settled by refine.
+        first = np.ones(slots.shape, dtype=bool)
+        second = np.repeat(np.where(np.isinf(bound), 0, bound), k, axis=1)
+        found = np.zeros(slots.shape, dtype=bool)
+        for j in range(k):
+            for i in range(j):
+                same = neighbour_owners[:, i] == neighbour_owners[:, j]
+                first[:, j] &= ~same
+                take = same & first[:, i] & ~found[:, i]
+                second[take, i] = dists[take, j]
+                found[:, i] |= take
+
+        good = first & alive & (dists < config.DISTANCE_THRESH * second)
+        query_idx, column = np.nonzero(good)
+        matches = {}
+        for q, slot, row, d in zip(query_idx.tolist(),
+                                   slots[query_idx, column].tolist(),
+                                   local[query_idx, column].tolist(),
+                                   dists[query_idx, column].tolist()):
+            matches.setdefault(slot, []).append(cv2.DMatch(q, row, d))
+
+        def wanted(slot):
+            key = state.slot_keys[slot]
+            return snapshot is None or (key in snapshot and
+                snapshot.get_all_data(key).descriptor_slot == slot)
+
+        unresolved = first & alive & ~found & ~good
+        if unresolved.any():
+            votes = Counter(slots[first & alive].tolist())
+            for slot, slot_matches in self.refine(state, query_des, slots,
+                                                  unresolved, votes, wanted):
+                matches.setdefault(slot, []).extend(slot_matches)
+
+        for slot, slot_matches in matches.items():
+            if wanted(slot):
+                candidates[state.slot_keys[slot]] = slot_matches
+        return candidates
+
+    # Settles the ratio test of the unresolved neighbours, those whose
+    # annotation had no second neighbour among the k kept and that failed
+    # against the lower bound on it, by running knnMatch against the
+    # descriptors of their annotation alone, the way match.py does without
+    # the global index. Only annotations with enough votes (neighbours that
+    # were the closest from them) to reach the MIN_MATCH_FRACTION threshold
+    # of match.py are matched. Yields (slot, matches that pass).
+    def refine(self, state, query_des, slots, unresolved, votes, wanted):
+        query_rows = {}
+        for q, column in zip(*np.nonzero(unresolved)):
+            query_rows.setdefault(int(slots[q, column]), []).append(int(q))
+
+        query_des = feature_backend.prepare_descriptors(query_des)
+        matcher = None
+        for slot, rows in query_rows.items():
+            train_des = slot_descriptors(state, slot)
+            if train_des is None or not wanted(slot) or votes[slot] < \
+                    config.MIN_MATCH_FRACTION * max(len(query_des), len(train_des)):
+                continue
+            if matcher is None:
+                matcher = cv2.BFMatcher(cv2.NORM_HAMMING if
+                    feature_backend.is_binary() else cv2.NORM_L2)
+            slot_matches = []
+            for q, neighbours in zip(rows, matcher.knnMatch(query_des[rows],
+                                                            train_des, k = 2)):
+                if len(neighbours) < 2:
+                    continue
+                m, n = neighbours
+                if m.distance < config.DISTANCE_THRESH * n.distance:
+                    slot_matches.append(cv2.DMatch(q, m.trainIdx, m.distance))
+            if len(slot_matches) > 0:
+                yield slot, slot_matches
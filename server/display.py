@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+from abc import ABC, abstractmethod
+import cv2
+import logging
+import os
+import queue
+import time
+from threading import Thread
+
+import config
+
+# Debug output for match visualizations. A sink renders frames on its own
+# thread only when a new one is published, and accepts at most max_fps frames
+# per second so that callers can skip drawing frames it would not show.
+# Subclasses implement render, and idle if they have to do work between
+# frames.
+class DisplaySink(ABC):
+    # Seconds between calls to idle while no frame comes in, None to wait
+    # for frames without calling it
+    idle_interval = None
+
+    def __init__(self, max_fps):
+        self.min_interval = 1.0 / max_fps
+        self.last_publish_time = 0
+        # Only the latest frame is kept, older unrendered ones are dropped
+        self.frames = queue.Queue(maxsize = 1)
+        Thread(target = self.render_loop, daemon = True).start()
+
+    # Returns whether a frame published now would be accepted
+    def ready(self):
+        return time.time() - self.last_publish_time >= self.min_interval
+
+    def publish(self, img):
+        if not self.ready():
+            return
+        self.last_publish_time = time.time()
+        try:
+            self.frames.get_nowait()
+        except queue.Empty:
+            pass
+        self.frames.put_nowait(img)
+
+    def render_loop(self):
+        while True:
+            try:
+                img = self.frames.get(timeout = self.idle_interval)
+                self.render(img)
+            except queue.Empty:
+                pass
+            if self.idle_interval is not None and not self.idle():
+                return
+
+    @abstractmethod
+    def render(self, img):
+        pass
+
+    # Called after every frame and every idle_interval seconds without one.
+    # Returns whether to keep rendering.
+    def idle(self):
+        return True
+
+# Shows the frames in a window. Needs a display server.
+class WindowDisplaySink(DisplaySink):
+    # Keeps the window responsive while no frame comes in
+    idle_interval = 0.1
+
+    def render(self, img):
+        cv2.imshow("Match", img)
+
+    # Closes the window when q is pressed in it
+    def idle(self):
+        k = cv2.waitKey(1) & 0xFF
+        if k == ord('q'):
+            cv2.destroyWindow("Match")
+            return False
+        return True
+
+# Writes the frames to a directory, cycling through max_files file names
+class FileDisplaySink(DisplaySink):
+    def __init__(self, max_fps, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+        self.next_index = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        super().__init__(max_fps)
+
+    def render(self, img):
+        filename = os.path.join(self.directory, f"match{self.next_index}.jpg")
+        self.next_index = (self.next_index + 1) % self.max_files
+        if not cv2.imwrite(filename, img):
+            logging.error(f"Could not write match display to {filename}")
+
+# Returns the sink selected by config.DISPLAY_SINK, or None when running
+# headless
+def create_display_sink():
+    if config.DISPLAY_SINK is None:
+        return None
+    if config.DISPLAY_SINK == 'window':
+        return WindowDisplaySink(config.DISPLAY_MAX_FPS)
+    if config.DISPLAY_SINK == 'file':
+        return FileDisplaySink(config.DISPLAY_MAX_FPS, config.DISPLAY_DIR,
+                               config.DISPLAY_MAX_FILES)
+    raise ValueError(f"Unknown display sink {config.DISPLAY_SINK}, "
+                     "expected None, 'window' or 'file'")
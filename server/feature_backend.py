@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+import cv2
+import numpy as np
+
+import config
+
+# The feature detectors that can be selected with config.FEATURE_BACKEND.
+# KAZE produces float descriptors matched with a KD-tree, the others produce
+# binary descriptors matched by Hamming distance, either with FLANN LSH or by
+# brute force (config.BINARY_MATCHER).
+DETECTORS = {
+    'KAZE': lambda: cv2.KAZE_create(),
+    'AKAZE': lambda: cv2.AKAZE_create(),
+    'ORB': lambda: cv2.ORB_create(nfeatures = config.ORB_N_FEATURES),
+    'BRISK': lambda: cv2.BRISK_create(),
+}
+BINARY_BACKENDS = {'AKAZE', 'ORB', 'BRISK'}
+
+def backend_name():
+    if config.FEATURE_BACKEND not in DETECTORS:
+        raise ValueError(f"Unknown feature backend {config.FEATURE_BACKEND}, "
+                         f"expected one of {list(DETECTORS.keys())}")
+    return config.FEATURE_BACKEND
+
+def is_binary():
+    return backend_name() in BINARY_BACKENDS
+
+def create_detector():
+    return DETECTORS[backend_name()]()
+
+# Returns the index parameters for FLANN matching of the backend's descriptors
+def index_params():
+    if is_binary():
+        return config.LSH_INDEX_PARAMS
+    return config.INDEX_PARAMS
+
+# Returns a matcher for knnMatch between two descriptor sets
+def create_matcher():
+    if is_binary() and config.BINARY_MATCHER == 'bf':
+        return cv2.BFMatcher(cv2.NORM_HAMMING)
+    return cv2.FlannBasedMatcher(index_params(), config.SEARCH_PARAMS)
+
+# Returns the descriptors in the dtype that the backend's matchers expect
+def prepare_descriptors(des):
+    return np.ascontiguousarray(des, dtype=np.uint8 if is_binary() else np.float32)
+
+# Returns the descriptors as float vectors, unpacking binary descriptors into
+# one 0/1 component per bit, for use in vector space (e.g. VLAD)
+def as_float(des):
+    if des.dtype == np.uint8:
+        return np.unpackbits(des, axis=1).astype(np.float32)
+    return des.astype(np.float32)
+
+# A kNN index over a descriptor matrix. search returns (indices, distances)
+# arrays of shape (n_query, k), with an index of -1 and an infinite distance
+# where fewer than k neighbours were found.
+class KnnIndex:
+    def __init__(self, data):
+        self.data = prepare_descriptors(data)
+        self.binary = is_binary()
+        self.brute_force = self.binary and config.BINARY_MATCHER == 'bf'
+        if self.brute_force:
+            self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        else:
+            # FLANN keeps a pointer into self.data, so it has to stay alive
+            self.index = cv2.flann_Index(self.data, index_params())
+
+    def __len__(self):
+        return len(self.data)
+
+    def search(self, query_des, k):
+        query_des = prepare_descriptors(query_des)
+        if self.brute_force:
+            idx = np.full((len(query_des), k), -1, dtype=np.int64)
+            dists = np.full((len(query_des), k), np.inf)
+            for i, neighbours in enumerate(self.matcher.knnMatch(query_des, self.data, k = k)):
+                for j, m in enumerate(neighbours):
+                    idx[i, j] = m.trainIdx
+                    dists[i, j] = m.distance
+            return idx, dists
+
+        idx, dists = self.index.knnSearch(query_des, k, params = config.SEARCH_PARAMS)
+        idx = idx.astype(np.int64)
+        dists = dists.astype(np.float64)
+        if not self.binary:
+            # FLANN reports squared L2 distances
+            dists = np.sqrt(np.maximum(dists, 0))
+        missing = (idx < 0) | (idx >= len(self.data))
+        idx[missing] = -1
+        dists[missing] = np.inf
+        return idx, dists
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+import cv2
+import logging
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+import os
+
+import config
+import feature_backend
+import features
+
+VLOG1 = 15
+
+# Bump whenever the contents or the meaning of the stored arrays change, so
+# that features written by an older server are recomputed instead of loaded.
+FEATURE_STORE_VERSION = 3
+
+# Returns the path of the precomputed feature file stored next to an image
+def feature_path(image_path):
+    return os.path.splitext(image_path)[0] + '.npz'
+
+# cv2.KeyPoint objects cannot be saved directly, so they are packed into an
+# (N, 7) array of x, y, size, angle, response, octave, class_id. kp may also
+# be a features.KEYPOINT_DTYPE array.
+def keypoints_to_array(kp):
+    if isinstance(kp, np.ndarray):
+        return structured_to_unstructured(kp, dtype=np.float64).reshape(-1, 7)
+    arr = np.empty((len(kp), 7), dtype=np.float64)
+    for i, k in enumerate(kp):
+        arr[i] = (k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave,
+                  k.class_id)
+    return arr
+
+def array_to_keypoints(arr):
+    return [cv2.KeyPoint(float(x), float(y), float(size), float(angle),
+                         float(response), int(octave), int(class_id))
+            for x, y, size, angle, response, octave, class_id in arr]
+
+# A features.DctFeatures is saved as its block and a float64 array of its
+# total, total_sq and block_sq
+def dct_to_arrays(dct):
+    return {'dct_block': dct.block,
+            'dct_sums': np.array((dct.total, dct.total_sq, dct.block_sq),
+                                 dtype=np.float64)}
+
+# Returns the features.DctFeatures saved in data by dct_to_arrays, or None if
+# there are none or their block is not DCT_BLOCK_SIZE x DCT_BLOCK_SIZE
+def dct_from_arrays(data):
+    if 'dct_block' not in data or 'dct_sums' not in data:
+        return None
+    block = data['dct_block']
+    if block.shape != (config.DCT_BLOCK_SIZE * config.DCT_BLOCK_SIZE,):
+        return None
+    total, total_sq, block_sq = (float(x) for x in data['dct_sums'])
+    return features.DctFeatures(block = block, total = total,
+                                total_sq = total_sq, block_sq = block_sq)
+
+# Saves the features of an image next to it. The file is written to a
+# temporary name first so that a crash never leaves a truncated store behind.
+def save_features(image_path, kp, des, hist, dct):
+    path = feature_path(image_path)
+    tmp_path = path + '.tmp'
+    if des is None:
+        des = np.empty((0, 0), dtype=np.uint8)
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 version=FEATURE_STORE_VERSION,
+                 backend=feature_backend.backend_name(),
+                 image_size=(config.IM_WIDTH, config.IM_HEIGHT),
+                 keypoints=keypoints_to_array(kp),
+                 descriptors=des,
+                 hist=hist,
+                 **dct_to_arrays(dct))
+    os.replace(tmp_path, path)
+
+# Returns (kp, des, hist, dct) for an image, or None if there is no feature
+# file or it is stale: older than the image, written by a different store
+# version, extracted by a different feature backend or computed at a different
+# image size.
+def load_features(image_path):
+    path = feature_path(image_path)
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(image_path):
+            logging.log(VLOG1, f"Feature file {path} is older than the image")
+            return None
+        with np.load(path) as data:
+            if int(data['version']) != FEATURE_STORE_VERSION:
+                logging.log(VLOG1, f"Feature file {path} has version "
+                                   f"{int(data['version'])}, expected "
+                                   f"{FEATURE_STORE_VERSION}")
+                return None
+            if str(data['backend']) != feature_backend.backend_name():
+                logging.info(f"Feature file {path} holds {data['backend']} "
+                             f"features but the server uses "
+                             f"{feature_backend.backend_name()}, recomputing")
+                return None
+            if tuple(data['image_size']) != (config.IM_WIDTH, config.IM_HEIGHT):
+                logging.log(VLOG1, f"Feature file {path} was computed at "
+                                   f"{tuple(data['image_size'])}")
+                return None
+            kp = array_to_keypoints(data['keypoints'])
+            des = data['descriptors']
+            hist = data['hist']
+            dct = dct_from_arrays(data)
+            if dct is None:
+                logging.log(VLOG1, f"Feature file {path} has no valid DCT "
+                                   f"features")
+                return None
+    except (OSError, KeyError, ValueError) as e:
+        logging.log(VLOG1, f"Could not load feature file {path}: {e}")
+        return None
+
+    if des.size == 0:
+        des = None
+    return kp, des, hist, dct
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+from collections import namedtuple
+import cv2
+import numpy as np
+from numpy.lib.recfunctions import unstructured_to_structured
+
+import config
+
+# The low frequency DCT block of an image, flattened, together with the sum
+# and the sum of squares of all of its DCT coefficients. The full sums keep the
+# DCT correlation computed from the block close to the one over the full DCT,
+# see photometric_index.
+DctFeatures = namedtuple('DctFeatures', 'block total total_sq block_sq')
+
+# Stored keypoints are kept as one structured array per annotation instead of
+# a list of cv2.KeyPoint objects, which take several times the memory. The
+# fields are those of cv2.KeyPoint.
+KEYPOINT_DTYPE = np.dtype([('x', np.float32), ('y', np.float32),
+                           ('size', np.float32), ('angle', np.float32),
+                           ('response', np.float32), ('octave', np.int32),
+                           ('class_id', np.int32)])
+
+# Returns kp as a KEYPOINT_DTYPE array. kp may be a list of cv2.KeyPoint, an
+# (N, 7) array as written by feature_store, or already packed.
+def pack_keypoints(kp):
+    if isinstance(kp, np.ndarray):
+        if kp.dtype == KEYPOINT_DTYPE:
+            return kp
+        return unstructured_to_structured(kp.reshape(-1, 7), dtype=KEYPOINT_DTYPE)
+    return np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave,
+                      k.class_id) for k in kp], dtype=KEYPOINT_DTYPE)
+
+# Returns packed keypoints as a list of cv2.KeyPoint, for the few places
+# that need them (e.g. cv2.drawMatches)
+def unpack_keypoints(packed):
+    return [cv2.KeyPoint(float(x), float(y), float(size), float(angle),
+                         float(response), int(octave), int(class_id))
+            for x, y, size, angle, response, octave, class_id in packed.tolist()]
+
+# Photometric features used to verify a descriptor match. They depend on one
+# image only, so they are computed once per query frame and once per stored
+# annotation rather than once per comparison.
+
+def get_image_histogram(img):
+    return cv2.calcHist([img], [0], None, [256], [0, 256])  # Grayscale
+
+# Returns a copy of the histogram with the high and low intensity bins
+# flattened out
+def clip_histogram(hist):
+    hist = hist.copy()
+    # Filter out high intensity pixel values
+    hist[245:] = hist[244]
+    # Filter out low intensity pixel values
+    hist[:10] = hist[10]
+    return hist
+
+# Finds the median bin of a histogram, defaulting to the middle bin for an
+# empty histogram
+def hist_median(hist):
+    cumulative = np.cumsum(hist.ravel())
+    half_samples = cumulative[-1] / 2
+    i = int(np.searchsorted(cumulative, half_samples, side='right'))
+    if i >= len(cumulative):
+        return 128
+    return i
+
+def compute_dct(img):
+    imf = np.float32(img) / 255.0  # Float conversion/scale
+    return cv2.dct(imf)
+
+def compute_dct_features(img):
+    dct = compute_dct(img)
+    block = dct[:config.DCT_BLOCK_SIZE, :config.DCT_BLOCK_SIZE].flatten()
+    return DctFeatures(block = block,
+                       total = dct.sum(dtype=np.float64),
+                       total_sq = np.square(dct, dtype=np.float64).sum(),
+                       block_sq = np.square(block, dtype=np.float64).sum())
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import logging
+import os
+import struct
+import time
+from threading import Lock
+
+from gabriel_protocol import gabriel_pb2
+
+# A frame log holds the InputFrames that an engine received, JPEG payload and
+# packed Extras included, so that they can be replayed offline (see
+# replay.py). It starts with a header of magic and version, followed by one
+# record per frame: the time it was received, the length of the serialized
+# InputFrame and the InputFrame itself.
+FILE_HEADER = struct.Struct('<4sI')
+MAGIC = b'APFL'
+FRAME_LOG_VERSION = 1
+FRAME_HEADER = struct.Struct('<dI')
+
+# Appends every frame passed to write to the log at path. Frames are flushed
+# as they come, so a log cut short by a crash loses at most the last one.
+class FrameRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if is_new:
+            self.file.write(FILE_HEADER.pack(MAGIC, FRAME_LOG_VERSION))
+        self.num_frames = 0
+
+    def write(self, input_frame):
+        data = input_frame.SerializeToString()
+        with self.lock:
+            self.file.write(FRAME_HEADER.pack(time.time(), len(data)))
+            self.file.write(data)
+            self.file.flush()
+            self.num_frames += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+# Yields (receive time, InputFrame) for every frame in the log at path.
+# Raises ValueError if path is not a frame log.
+def read_frames(path):
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            raise ValueError(f"{path} is not a frame log")
+        magic, version = FILE_HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a frame log")
+        if version != FRAME_LOG_VERSION:
+            raise ValueError(f"{path} has version {version}, expected "
+                             f"{FRAME_LOG_VERSION}")
+        while True:
+            frame_header = f.read(FRAME_HEADER.size)
+            if len(frame_header) == 0:
+                return
+            if len(frame_header) < FRAME_HEADER.size:
+                break
+            receive_time, length = FRAME_HEADER.unpack(frame_header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            input_frame = gabriel_pb2.InputFrame()
+            input_frame.ParseFromString(data)
+            yield receive_time, input_frame
+    logging.warning(f"{path} ends with a partly written frame, ignoring it")
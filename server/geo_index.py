@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import math
+import numpy as np
+from threading import Lock
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_METERS / 180
+
+# Returns the great-circle distance in meters from one point to an array of
+# points, all given in degrees
+def haversine_meters(lat, lon, lats, lons):
+    lat1 = math.radians(lat)
+    lat2 = np.radians(lats)
+    dlat = lat2 - lat1
+    dlon = np.radians(lons) - math.radians(lon)
+    a = np.sin(dlat / 2) ** 2 + \
+        math.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+# Buckets annotation coordinates into a fixed grid of latitude/longitude
+# cells, so that a radius query only visits the cells overlapping the radius
+# and then runs one vectorized haversine check over the keys found there.
+# Writers never modify a bucket in place but replace it with an updated copy,
+# so queries can read the buckets without taking the lock.
+class GeoIndex:
+    def __init__(self, cell_degrees):
+        self.cell_degrees = cell_degrees
+        self.n_lon_cells = int(math.ceil(360 / cell_degrees))
+        self.cells = {}
+        self.locations = {}
+        self.lock = Lock()
+
+    def cell_of(self, lat, lon):
+        return (int(math.floor(lat / self.cell_degrees)),
+                int(math.floor(lon / self.cell_degrees)) % self.n_lon_cells)
+
+    def add(self, key, lat, lon):
+        with self.lock:
+            self._remove(key)
+            cell = self.cell_of(lat, lon)
+            bucket = dict(self.cells.get(cell, {}))
+            bucket[key] = (lat, lon)
+            self.cells[cell] = bucket
+            self.locations[key] = cell
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        cell = self.locations.pop(key, None)
+        if cell is None:
+            return
+        bucket = dict(self.cells[cell])
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.cells[cell]
+        else:
+            self.cells[cell] = bucket
+
+    def __len__(self):
+        return len(self.locations)
+
+    # Returns the cells that may hold points within radius_meters of (lat, lon),
+    # or None if that would be more cells than are occupied
+    def cells_near(self, lat, lon, radius_meters, num_cells):
+        dlat = radius_meters / METERS_PER_DEGREE
+        # Widen the longitude span as meridians converge towards the poles
+        cos_lat = max(math.cos(math.radians(min(abs(lat) + dlat, 90))), 1e-6)
+        dlon = min(dlat / cos_lat, 180)
+
+        lat_cells = range(int(math.floor((lat - dlat) / self.cell_degrees)),
+                          int(math.floor((lat + dlat) / self.cell_degrees)) + 1)
+        first_lon = int(math.floor((lon - dlon) / self.cell_degrees))
+        last_lon = int(math.floor((lon + dlon) / self.cell_degrees))
+        if len(lat_cells) * (last_lon - first_lon + 1) > num_cells:
+            return None
+        lon_cells = {c % self.n_lon_cells for c in range(first_lon, last_lon + 1)}
+        return [(i, j) for i in lat_cells for j in lon_cells]
+
+    # Returns the keys whose coordinates lie within radius_meters of coords
+    def query(self, coords, radius_meters):
+        lat, lon = coords
+        keys = []
+        points = []
+        # Single dict reads and copies are atomic, and the buckets they return
+        # are never changed
+        occupied = self.cells
+        cells = self.cells_near(lat, lon, radius_meters, len(occupied))
+        if cells is None:
+            buckets = list(occupied.values())
+        else:
+            buckets = [occupied.get(c) for c in cells]
+        for bucket in buckets:
+            if bucket is None:
+                continue
+            keys.extend(bucket.keys())
+            points.extend(bucket.values())
+        if len(keys) == 0:
+            return []
+
+        points = np.asarray(points, dtype=np.float64)
+        d = haversine_meters(lat, lon, points[:, 0], points[:, 1])
+        return [keys[i] for i in np.flatnonzero(d < radius_meters)]
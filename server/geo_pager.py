@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+import logging
+import math
+import time
+from threading import Lock
+
+from geo_index import GeoIndex
+
+# Keeps only the annotations around recent queries in an ImageDataTable. The
+# annotations are split into pages, the cells of a grid of page_degrees, and
+# only the keys and locations of all of them are held here. The first query
+# within a radius of a page that is not in the table loads it through load,
+# a function that adds the annotations of a list of keys to the table. Loaded
+# pages are kept in LRU order, and once the annotations in the table take
+# more than budget_bytes, the least recently queried pages are evicted from
+# it (but not from where they are stored).
+#
+# The size of an annotation is estimated from the arrays that the table keeps
+# for it, the kNN and VLAD indexes over them come on top.
+class GeoPager:
+    # locations yields (key, latitude, longitude) for every stored annotation
+    def __init__(self, table, locations, load, page_degrees, budget_bytes):
+        self.table = table
+        self.load = load
+        self.budget_bytes = budget_bytes
+        self.grid = GeoIndex(page_degrees)
+        # Guards the fields below. Taken after table.lock when both are.
+        self.lock = Lock()
+        self.page_keys = {}
+        self.page_of = {}
+        for key, latitude, longitude in locations:
+            page = self.grid.cell_of(latitude, longitude)
+            self.page_keys.setdefault(page, set()).add(key)
+            self.page_of[key] = page
+        # Loaded pages, least recently queried first
+        self.resident = OrderedDict()
+        # Estimated size of every annotation in the table
+        self.nbytes = {}
+        self.total_bytes = 0
+        self.num_loaded = 0
+        self.num_evicted = 0
+
+    def __contains__(self, key):
+        return key in self.page_of
+
+    def __len__(self):
+        return len(self.page_of)
+
+    # Makes sure that every page within radius_meters of coords is in the
+    # table. Returns right away if they already are.
+    def page_in(self, coords, radius_meters):
+        pages = self.grid.cells_near(coords[0], coords[1], radius_meters, math.inf)
+        with self.lock:
+            missing = []
+            for page in pages:
+                if page in self.resident:
+                    self.resident.move_to_end(page)
+                elif page in self.page_keys:
+                    missing.append(page)
+        if len(missing) == 0:
+            return
+
+        start_time = time.time()
+        # The regions go into the delta of the table, folding them into the
+        # rest of it is left to its compaction thread
+        with self.table.batch(compact = False):
+            for page in missing:
+                with self.lock:
+                    if page in self.resident:
+                        continue
+                    keys = [key for key in self.page_keys.get(page, ())
+                            if key not in self.nbytes]
+                self.load(keys)
+                with self.lock:
+                    self.resident[page] = None
+                    self.num_loaded += 1
+            self.evict(set(pages))
+        logging.info(f"Paged in {len(missing)} regions around {coords} in "
+                     f"{(time.time() - start_time) * 1000:.0f} ms, "
+                     f"{self.total_bytes / 2**20:.1f} MiB in "
+                     f"{len(self.resident)} regions resident")
+
+    # Evicts the least recently queried pages, except those in keep, until
+    # the table fits in the budget
+    def evict(self, keep):
+        with self.table.lock:
+            with self.lock:
+                victims = []
+                total_bytes = self.total_bytes
+                for page in self.resident:
+                    if total_bytes <= self.budget_bytes:
+                        break
+                    if page in keep:
+                        continue
+                    victims.append(page)
+                    total_bytes -= sum(self.nbytes.get(key, 0)
+                                       for key in self.page_keys.get(page, ()))
+                keys = []
+                for page in victims:
+                    del self.resident[page]
+                    keys += [key for key in self.page_keys.get(page, ())
+                             if key in self.nbytes]
+                self.num_evicted += len(victims)
+            if len(keys) == 0:
+                return
+            self.table.evict(keys)
+            with self.lock:
+                for key in keys:
+                    self.total_bytes -= self.nbytes.pop(key, 0)
+
+    # Loads key into the table on its own if it is stored but not loaded, so
+    # that it can be changed or removed. Called with table.lock held.
+    def fetch(self, key):
+        with self.lock:
+            if key not in self.page_of or key in self.nbytes:
+                return
+        self.load([key])
+
+    ## Called by the table whenever an annotation is put in it or removed
+    # from it for good. An annotation put in a page that is not loaded stays
+    # in the table until that page is loaded and evicted again.
+    def added(self, key, latitude, longitude, nbytes):
+        page = self.grid.cell_of(latitude, longitude)
+        with self.lock:
+            self._forget(key)
+            self.page_keys.setdefault(page, set()).add(key)
+            self.page_of[key] = page
+            self.nbytes[key] = nbytes
+            self.total_bytes += nbytes
+
+    def removed(self, key):
+        with self.lock:
+            self._forget(key)
+
+    def _forget(self, key):
+        page = self.page_of.pop(key, None)
+        if page is not None:
+            keys = self.page_keys[page]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.page_keys[page]
+                self.resident.pop(page, None)
+        self.total_bytes -= self.nbytes.pop(key, 0)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import hashlib
+import math
+
+from annotation_store import AnnotationStore
+from geo_index import GeoIndex
+
+# Times that a shard scans the store again to find a record that compaction
+# moved, see ShardStore._read
+RESCAN_ATTEMPTS = 5
+
+# Splits the world into a grid of cells of cell_degrees and hands every cell
+# to one of num_shards engines. Cells are spread over the shards by a hash of
+# their coordinates rather than in stripes, so that a busy area does not end
+# up on one shard. Besides the annotations in its cells, a shard holds those
+# within margin_meters of them, so that a frame anywhere in its cells sees
+# every annotation that the GPS filter would let through.
+class ShardMap:
+    def __init__(self, num_shards, cell_degrees, margin_meters):
+        self.num_shards = num_shards
+        self.grid = GeoIndex(cell_degrees)
+        self.margin_meters = margin_meters
+
+    # CRC32 would be cheaper, but being linear it maps neighbouring cells to
+    # the same few shards
+    def owner_of_cell(self, cell):
+        digest = hashlib.blake2b(f"{cell[0]},{cell[1]}".encode('ascii'),
+                                 digest_size = 8).digest()
+        return int.from_bytes(digest, 'little') % self.num_shards
+
+    # Returns the shard that frames at (lat, lon) go to
+    def owner(self, lat, lon):
+        return self.owner_of_cell(self.grid.cell_of(lat, lon))
+
+    # Returns the shards that hold an annotation at (lat, lon)
+    def holders(self, lat, lon):
+        cells = self.grid.cells_near(lat, lon, self.margin_meters, math.inf)
+        return {self.owner_of_cell(cell) for cell in cells}
+
+    # Returns a function of (lat, lon) telling whether shard holds an
+    # annotation there, for AnnotationStore.items
+    def selector(self, shard):
+        return lambda lat, lon: shard in self.holders(lat, lon)
+
+# The annotation store as seen by shard number shard. The store has a single
+# writer, the router process: the shard reads a read-only view of it that was
+# scanned when the shard started, and forwards its puts and deletes to the
+# router through the writes queue, which passes them on to the other shards
+# that hold the annotation. New keys are numbered from key_counter (a
+# multiprocessing.Value), which all the shards share.
+#
+# The router does not compact the store until every shard has loaded. A
+# record that it compacts away later is read again from a fresh view.
+class ShardStore:
+    def __init__(self, directory, shard, writes, key_counter):
+        self.directory = directory
+        self.shard = shard
+        self.store = AnnotationStore(directory, read_only = True)
+        self.writes = writes
+        self.key_counter = key_counter
+
+    def __len__(self):
+        return len(self.store)
+
+    # Only annotations that were stored when the shard started are found
+    # here, the images of those added since are kept by the shard itself
+    def __contains__(self, key):
+        return key in self.store
+
+    def get(self, key, with_image = True):
+        return self._read(
+            lambda store, key: store.get(key, with_image), key)
+
+    def items(self, select = None, with_image = True):
+        return self.store.items(select, with_image)
+
+    def locations(self):
+        return self.store.locations()
+
+    def get_image(self, key):
+        return self._read(AnnotationStore.get_image, key)
+
+    # Returns read(store, key), scanning the store again if the record of a
+    # key that it holds has been compacted away. A scan that runs while the
+    # router compacts may miss records, so it is repeated until the key is
+    # found or a complete scan no longer has it.
+    def _read(self, read, key):
+        store = self.store
+        value = read(store, key)
+        if value is None and key in store:
+            for _ in range(RESCAN_ATTEMPTS):
+                store = AnnotationStore(self.directory, read_only = True)
+                value = read(store, key)
+                if value is not None or (key not in store and store.complete):
+                    break
+            self.store = store
+        return value
+
+    def put(self, key, record):
+        self.writes.put((self.shard, key, record))
+
+    def delete(self, key):
+        self.writes.put((self.shard, key, None))
+
+    def next_key(self, prefix):
+        with self.key_counter.get_lock():
+            self.key_counter.value += 1
+            return prefix + str(self.key_counter.value)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+import cv2
+import os
+from threading import Lock
+
+import config
+
+# Annotation images are not kept in memory with the rest of the table. They
+# are read back on demand from where they are persisted: the memory-mapped
+# segments of the annotation store, or the jpg files in db_path. Only the
+# images of annotations that are not persisted anywhere stay resident, and
+# the IMAGE_CACHE_SIZE most recently read ones are kept decoded.
+#
+# Images read back went through JPEG, so they can differ slightly from the
+# ones that the features of annotations added since startup were computed on.
+# They are only used for display and for the few candidates whose DCT
+# correlation cannot be decided from the low frequency block.
+class ImageCache:
+    def __init__(self, store = None, db_path = 'db/'):
+        self.store = store
+        self.db_path = db_path
+        self.lock = Lock()
+        self.resident = {}
+        self.recent = OrderedDict()
+        # Bumped on every change, so that an image read from disk while the
+        # key changed is not cached
+        self.generation = 0
+
+    def db_image_path(self, key):
+        return os.path.join(self.db_path, key + '.jpg')
+
+    def is_persisted(self, key):
+        if self.store is not None:
+            return key in self.store
+        return os.path.exists(self.db_image_path(key))
+
+    # Called whenever the image of key changes, after it has been persisted.
+    # img is kept in memory if it cannot be read back.
+    def add(self, key, img):
+        persisted = self.is_persisted(key)
+        with self.lock:
+            self.generation += 1
+            self.recent.pop(key, None)
+            if persisted:
+                self.resident.pop(key, None)
+            else:
+                self.resident[key] = img
+
+    def remove(self, key):
+        with self.lock:
+            self.generation += 1
+            self.recent.pop(key, None)
+            self.resident.pop(key, None)
+
+    # Returns the latest image of key at IM_WIDTH x IM_HEIGHT, or None if it
+    # has been removed. The image may be shared and must not be modified.
+    def get(self, key):
+        with self.lock:
+            img = self.resident.get(key)
+            if img is not None:
+                return img
+            img = self.recent.get(key)
+            if img is not None:
+                self.recent.move_to_end(key)
+                return img
+            generation = self.generation
+
+        if self.store is not None:
+            img = self.store.get_image(key)
+        elif os.path.exists(self.db_image_path(key)):
+            img = cv2.imread(self.db_image_path(key), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            return None
+        if img.shape[:2] != (config.IM_HEIGHT, config.IM_WIDTH):
+            img = cv2.resize(img, (config.IM_WIDTH, config.IM_HEIGHT))
+
+        with self.lock:
+            if self.generation == generation:
+                self.recent[key] = img
+                while len(self.recent) > config.IMAGE_CACHE_SIZE:
+                    self.recent.popitem(last = False)
+        return img
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import cv2
+import logging
+import numpy as np
+
+import metrics
+
+# Start of frame markers that carry the image size. C4 (DHT), C8 (JPG) and
+# CC (DAC) share the range but are not frame headers.
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Returns the (width, height) of a JPEG from its frame header without decoding
+# it, or None if the data is not a JPEG or the header cannot be found
+def jpeg_size(data):
+    data = memoryview(data)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # Markers without a length field
+            i += 2
+            continue
+        length = (data[i + 2] << 8) | data[i + 3]
+        if marker in SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height
+        i += 2 + length
+    return None
+
+# Returns the imdecode flag that decodes a src_size image at the largest
+# reduction (1/2, 1/4 or 1/8) that still leaves it at least dst_size
+def reduced_decode_flag(src_size, dst_size):
+    if src_size is not None:
+        for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                             (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                             (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if src_size[0] // factor >= dst_size[0] and \
+                    src_size[1] // factor >= dst_size[1]:
+                return flag
+    return cv2.IMREAD_GRAYSCALE
+
+# Decodes each incoming frame once, at reduced resolution when the source is
+# much larger than needed, and resizes it to (width, height) into a buffer
+# that is reused across frames. The returned image is only valid until the
+# next call to decode, so anything that keeps it longer must copy it.
+class FrameIngest:
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.buffer = np.empty((height, width), dtype=np.uint8)
+
+    def decode(self, payload):
+        with metrics.timed('decode'):
+            frame = np.frombuffer(payload, dtype=np.uint8)
+            flag = reduced_decode_flag(jpeg_size(payload), self.size)
+            img = cv2.imdecode(frame, flag)
+        if img is None:
+            logging.error("Could not decode the incoming frame")
+            return None
+        if img.shape[1] == self.size[0] and img.shape[0] == self.size[1]:
+            return img
+        with metrics.timed('resize'):
+            return cv2.resize(img, self.size, dst = self.buffer)
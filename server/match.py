@@ -1,15 +1,20 @@
 #!/usr/bin/env python
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import logging
 import numpy as np
 import os
-from scipy import stats
 import sys
-import time
-from threading import Thread, Lock
-from geopy import distance
+from threading import local
 
 import config
+import display
+import feature_backend
+import features
+import geo_index
+import metrics
+import result_cache
 import table
 
 sys.path.insert(0, "..")
@@ -19,108 +24,100 @@ VLOG1 = 15
 VLOG2 = 14
 VLOG3 = 13
 
+# Per-frame features of the query image, see ImageMatcher.prepare_query
+QueryData = namedtuple('QueryData', 'kp des hist hist_median dct img')
+
+# What the tracking mode remembers about the last match: its key, the frame
+# it was last seen in, the points of that frame that matched it, how many
+# points it started with and for how many frames in a row it has been followed
+# by optical flow alone
+TrackingState = namedtuple('TrackingState', 'key img points initial_points flow_frames')
+
 class ImageMatcher:
     def __init__(self, table):
-        # Initialize SURF feature detector, FLANN matcher, and image database
-        self.surf = cv2.KAZE_create()
-        self.flann = cv2.FlannBasedMatcher(config.INDEX_PARAMS, config.SEARCH_PARAMS)
+        # Initialize feature detector, matcher, and image database
+        self.surf = feature_backend.create_detector()
+        self.flann = feature_backend.create_matcher()
+        self.table = table
+
+        # Candidates are verified on a thread pool if more than one thread is
+        # configured. Matchers are not thread-safe, so each thread has its own.
+        self.thread_local = local()
+        self.pool = None
+        if config.MATCH_THREADS > 1:
+            self.pool = ThreadPoolExecutor(max_workers = config.MATCH_THREADS,
+                                           thread_name_prefix = 'match')
+        self.tracking = None
+        self.result_cache = None
+        if config.USE_RESULT_CACHE:
+            self.result_cache = result_cache.ResultCache(
+                config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL,
+                config.RESULT_CACHE_MAX_HASH_DISTANCE)
+        # Headless unless a debug display sink is configured
+        self.display_sink = display.create_display_sink()
+
+    # Switches to another table, such as a newer generation of a packed_db.
+    # Cached results and the tracked annotation belong to the old one.
+    def set_table(self, table):
         self.table = table
-        self.current_frame = np.zeros((100,100,1))
-        self.current_frame_lock = Lock()
-
-        Thread(target=self.display_match_loop, args=()).start()
-
-    def display_match_loop(self):
-        while True:
-            match = None
-            with self.current_frame_lock:
-                match = self.current_frame
-            cv2.imshow("Match", match)
-            k = cv2.waitKey(1) & 0xFF
-            if k == ord('q'):
-                return
-
-    # Finds the median bin of a histogram
-    def hist_median(self, hist):
-        total_samples = hist.sum()
-        half_samples = total_samples / 2
-        s = 0
-        for i in range(len(hist)):
-            s += hist[i]
-            if s > half_samples:
-                return i
-
-    # Filters out poor quality matches using the ratio test
+        self.tracking = None
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    # Returns the descriptor matcher for the calling thread
+    def get_matcher(self):
+        if self.pool is None:
+            return self.flann
+        matcher = getattr(self.thread_local, 'matcher', None)
+        if matcher is None:
+            matcher = feature_backend.create_matcher()
+            self.thread_local.matcher = matcher
+        return matcher
+
+    # Filters out poor quality matches using the ratio test. LSH matching may
+    # find fewer than two neighbours for a descriptor, which then cannot pass.
     def extract_good_matches(self, matches):
         good = []
-        for i, (m, n) in enumerate(matches):
+        for neighbours in matches:
+            if len(neighbours) < 2:
+                continue
+            m, n = neighbours[:2]
             if m.distance < (config.DISTANCE_THRESH * n.distance):
                 good.append(m)
         return good
 
-    # Returns a match score between two images
-    def compute_match_score(self, query_data, train_data):
-        query_kp, query_des, query_hist, query_img = query_data
-        train_kp, train_des, train_hist, train_img = train_data
-
-        score = 0
-
-        matches = self.extract_good_matches(self.flann.knnMatch(query_des, train_des, k = 2))
-
-        # Filter out high intensity pixel values
-        train_hist[245:] = train_hist[244]
-        query_hist[245:] = query_hist[244]
-
-        # Filter out low intensity pixel values
-        train_hist[:10] = train_hist[10]
-        query_hist[:10] = query_hist[10]
-
-        # Shift histograms based on median bin to match score
-        train_hist_median = self.hist_median(train_hist)
-        if train_hist_median is None:
-            train_hist_median = 128
-        query_hist_median = self.hist_median(query_hist)
-        if query_hist_median is None:
-            query_hist_median = 128
-        if query_hist_median > train_hist_median:
-            n_shift = query_hist_median - train_hist_median
-            hist_new = train_hist.copy()
-            hist_new[:] = 0
-            hist_new[n_shift:255] = train_hist[:255 - n_shift]
-            train_hist = hist_new
-        else:
-            n_shift = train_hist_median - query_hist_median
-            hist_new = query_hist.copy()
-            hist_new[:] = 0
-            hist_new[n_shift:255] = query_hist[:255 - n_shift]
-            query_hist = hist_new
-
-        # Find histogram correlation
-        hist_correlation = cv2.compareHist(train_hist, query_hist, cv2.HISTCMP_CORREL) * 100
+    # Computes everything about the query frame that the comparison against
+    # a stored annotation needs, so it is done once per frame instead of once
+    # per candidate
+    def prepare_query(self, query_img):
+        hist = features.clip_histogram(features.get_image_histogram(query_img))
 
-        # Find Mann-Whitney U Test score
-        hist_mwn = stats.mannwhitneyu(query_hist.flatten(), train_hist.flatten(), use_continuity = True, alternative = "two-sided").pvalue * 100
-
-        # Find DCT correlation
-        imf = np.float32(query_img) / 255.0  # Float conversion/scale
-        dst = cv2.dct(imf)           # Calculate the dct
-        img1 = dst
-
-        imf = np.float32(train_img) / 255.0  # Float conversion/scale
-        dst = cv2.dct(imf)           # Calculate the dct
-        img2 = dst
+        # Extract image features
+        with metrics.timed('extract') as timer:
+            kp, des = self.surf.detectAndCompute(query_img, None)
+        logging.log(VLOG1, f"It took {timer.seconds} seconds"
+                            " to extract features for the incoming frame")
 
-        dct_diff = img1 - img2
-        dct_correl = cv2.compareHist(img1.flatten(), img2.flatten(), cv2.HISTCMP_CORREL) * 100
+        return QueryData(kp = kp, des = des, hist = hist,
+                         hist_median = features.hist_median(hist),
+                         dct = features.compute_dct_features(query_img),
+                         img = query_img)
+
+    # Returns the ratio-tested matches between the prepared query and a
+    # stored annotation if there are enough of them for the annotation to be
+    # a candidate, otherwise None. If the matches are already known (e.g.
+    # from the global descriptor index) they are used instead of running
+    # knnMatch against the train descriptors.
+    def match_descriptors(self, query, train_data, matches = None):
+        if matches is None:
+            with metrics.timed('knn'):
+                matches = self.extract_good_matches(self.get_matcher().knnMatch(query.des, train_data.des, k = 2))
 
         logging.debug("NUMBER OF GOOD MATCHES: {0}".format(len(matches)))
-        logging.debug("HISTORGRAM CORRELATION: {0}".format(hist_correlation))
-        logging.debug("MWN CORRELATION: {0}".format(hist_mwn))
-        logging.debug("DCT CORRELATION: {0}".format(dct_correl))
 
         # Calculate match threshold based on the number of keypoints detected in the database image and the query image
-        train_threshold = 0.07 * len(train_kp)
-        query_threshold = 0.07 * len(query_kp)
+        train_threshold = config.MIN_MATCH_FRACTION * len(train_data.kp)
+        query_threshold = config.MIN_MATCH_FRACTION * len(query.kp)
         threshold = max(train_threshold, query_threshold)
 
         logging.debug("THRESHOLD: {0}".format(threshold))
@@ -128,82 +125,246 @@ class ImageMatcher:
         # Reject match if number of detected matches is less than the threshold
         if len(matches) < threshold:
             logging.log(VLOG1, f"{len(matches)=} is less than {threshold=}, did not match")
-            return None, None, None
-        else:
-            score += len(matches)
-
-        # calculate the relative displacement between two group of key points
-        # shift_xs = []
-        # shift_ys = []
-        # for m in matches:
-        #     k_q = query_kp[m.queryIdx]
-        #     k_t = train_kp[m.trainIdx]
-        #     shift_xs.append(k_q.pt[0] - k_t.pt[0])
-        #     shift_ys.append(k_q.pt[1] - k_t.pt[1])
-
-        # shift_x1 = sum(shift_xs) / len(shift_xs)
-        # shift_y1 = sum(shift_ys) / len(shift_ys)
-        # shift_x2 = np.median(np.array(shift_xs))
-        # shift_y2 = np.median(np.array(shift_ys))
-        # shift_x = (shift_x1 + shift_x2) / 2
-        # shift_y = (shift_y1 + shift_y2) / 2
-
-        hist_test_passes = 0
-        if hist_correlation > config.CORREL_TH:
-            hist_test_passes += 1
-        else:
-            logging.log(VLOG1, f"{hist_correlation=} < {config.CORREL_TH=}")
-
-        if dct_correl > config.DCT_TH:
-            hist_test_passes += 1
-        else:
-            logging.log(VLOG1, f"{dct_correl=} < {config.DCT_TH=}")
-
-        if hist_mwn > config.MWN_TH:
-            hist_test_passes += 1
-        else:
-            logging.log(VLOG1, f"{hist_mwn=} < {config.MWN_TH=}")
+            return None
+        return matches
+
+    # Runs the histogram and DCT tests against all (key, matches) candidates
+    # at once and returns (score, key, matches) for the ones that pass
+    def score_candidates(self, query, candidates, snapshot):
+        keys = [key for key, _ in candidates]
+        with metrics.timed('photometric'):
+            hist_correlations, hist_mwns, dct_correls = \
+                snapshot.score_photometric(query, keys)
+
+        scored = []
+        for (key, matches), hist_correlation, hist_mwn, dct_correl in \
+                zip(candidates, hist_correlations, hist_mwns, dct_correls):
+            logging.debug("NOW SCORING: %s" % key)
+            logging.debug("HISTORGRAM CORRELATION: {0}".format(hist_correlation))
+            logging.debug("MWN CORRELATION: {0}".format(hist_mwn))
+            logging.debug("DCT CORRELATION: {0}".format(dct_correl))
+
+            hist_test_passes = 0
+            if hist_correlation > config.CORREL_TH:
+                hist_test_passes += 1
+            else:
+                logging.log(VLOG1, f"{hist_correlation=} < {config.CORREL_TH=}")
+
+            if dct_correl > config.DCT_TH:
+                hist_test_passes += 1
+            else:
+                logging.log(VLOG1, f"{dct_correl=} < {config.DCT_TH=}")
+
+            if hist_mwn > config.MWN_TH:
+                hist_test_passes += 1
+            else:
+                logging.log(VLOG1, f"{hist_mwn=} < {config.MWN_TH=}")
+
+            # Reject match if less than 2 hist tests pass
+            if hist_test_passes >= 1:
+                score = len(matches) + hist_correlation + dct_correl + hist_mwn
+                logging.debug("SCORE IS {0}".format(score))
+                scored.append((score, key, matches))
+            else:
+                logging.log(VLOG1, f"{hist_test_passes=} tests passed, did not match")
+        return scored
+
+    # Runs descriptor matching and the photometric tests against the given
+    # keys of the table snapshot and returns (score, key, matches) for the
+    # ones that pass. candidate_matches holds the matches from the global
+    # index, if used.
+    def verify_candidates(self, query, keys, snapshot, candidate_matches = None):
+        candidates = []
+        for key in keys:
+            logging.debug("NOW COMPARING WITH: %s" % key)
 
-        # Reject match if less than 2 hist tests pass
-        if hist_test_passes >= 1:
-            score += hist_correlation + dct_correl + hist_mwn
-        else:
-            logging.log(VLOG1, f"{hist_test_passes=} tests passed, did not match")
+            train_data = snapshot.get_all_data(key)
+
+            matches = None
+            if candidate_matches is not None:
+                matches = candidate_matches[key]
+
+            matches = self.match_descriptors(query, train_data, matches)
+            if matches is not None:
+                candidates.append((key, matches))
+        return self.score_candidates(query, candidates, snapshot)
+
+    # Splits the keys into one chunk per thread and verifies the chunks on the
+    # thread pool, or all keys on the calling thread if there is no pool
+    def verify_candidates_parallel(self, query, keys, snapshot,
+                                   candidate_matches = None):
+        keys = list(keys)
+        chunk_size = max(config.MATCH_MIN_CHUNK_SIZE,
+                         -(-len(keys) // config.MATCH_THREADS))
+        if self.pool is None or len(keys) <= chunk_size:
+            return self.verify_candidates(query, keys, snapshot, candidate_matches)
+
+        futures = [
+            self.pool.submit(self.verify_candidates, query,
+                             keys[i:i + chunk_size], snapshot, candidate_matches)
+            for i in range(0, len(keys), chunk_size)]
+        scored = []
+        for future in futures:
+            scored.extend(future.result())
+        return scored
+
+    # Returns a match score between the prepared query and a single stored
+    # annotation
+    def compute_match_score(self, query, key, snapshot, matches = None):
+        matches = self.match_descriptors(query, snapshot.get_all_data(key), matches)
+        if matches is None:
             return None, None, None
-
-        logging.debug("SCORE IS {0}".format(score))
+        scored = self.score_candidates(query, [(key, matches)], snapshot)
+        if len(scored) == 0:
+            return None, None, None
+        score, _, matches = scored[0]
         return score, None, matches
 
+    # Draws the matches for the display sink, unless there is none or it
+    # would not accept a frame right now
     def display_match(self, query_img, query_kp, train_img, train_kp, best_matches):
+        if self.display_sink is None or not self.display_sink.ready():
+            return
         match_img = \
             cv2.drawMatches(
                 query_img, query_kp, train_img, train_kp, best_matches, None,
                 flags=cv2.DrawMatchesFlags_NOT_DRAW_SINGLE_POINTS)
-        with self.current_frame_lock:
-            self.current_frame = match_img
+        self.display_sink.publish(match_img)
 
-    @staticmethod
-    def coordinates_in_proximity(coord1, coord2, thresh_meters):
-        d = distance.distance(coord1, coord2).meters
-        return d < thresh_meters
+    # score is that of the match, None if it was not scored (e.g. tracked
+    # with optical flow)
+    def build_response(self, key, num_matches_considered, snapshot, score = None):
+        response = {'status' : 'success'}
+        response['num_matches_considered'] = num_matches_considered
+        response['key'] = key
+        response['score'] = score
+        if key is not None:
+            annotated_text = snapshot.get_annotation_text(key)
+            if annotated_text is not None:
+                response['annotated_text'] = annotated_text
+        return response
 
+    # Starts tracking key from the query points that matched it
+    def start_tracking(self, key, query, matches):
+        points = np.float32([query.kp[m.queryIdx].pt for m in matches])
+        # The query image may be a reused ingest buffer, so keep a copy
+        self.tracking = TrackingState(
+            key = key, img = query.img.copy(), points = points.reshape(-1, 1, 2),
+            initial_points = len(points), flow_frames = 0)
+
+    # Follows the tracked points into the new frame with sparse optical flow.
+    # Points that do not flow back to where they came from are dropped.
+    # Returns the tracked points, or None if too few of them survive.
+    def track_points(self, query_img):
+        tracking = self.tracking
+        if len(tracking.points) == 0:
+            return None
+        lk_params = dict(winSize = (21, 21), maxLevel = 3)
+        points, status, _ = cv2.calcOpticalFlowPyrLK(
+            tracking.img, query_img, tracking.points, None, **lk_params)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(
+            query_img, tracking.img, points, None, **lk_params)
+        fb_error = np.linalg.norm(
+            (tracking.points - back_points).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & \
+            (fb_error < config.TRACKING_MAX_FB_ERROR)
+
+        num_tracked = np.count_nonzero(good)
+        min_points = max(config.TRACKING_MIN_POINTS,
+                         config.TRACKING_MIN_POINT_RATIO * tracking.initial_points)
+        logging.log(VLOG1, f"Tracked {num_tracked} of {len(good)} points "
+                           f"of {tracking.key}, need {min_points}")
+        if num_tracked < min_points:
+            return None
+        return points[good]
+
+    # Returns whether the tracked annotation may still be reported for a
+    # query at query_coords
+    def tracked_in_proximity(self, query_coords, snapshot):
+        train_data = snapshot.get_all_data(self.tracking.key)
+        d = geo_index.haversine_meters(
+            query_coords[0], query_coords[1],
+            np.array([train_data.latitude]), np.array([train_data.longitude]))
+        return d[0] < config.GPS_FILTER_RADIUS_METERS
+
+    # Returns the match response for a frame. Near-duplicates of a recent
+    # frame from the same GPS cell get its response from the result cache
+    # without any feature extraction. If the caller has already run
+    # prepare_query on the frame, its result can be passed as query.
     def match(self, query_img, query_coords, gps_filtering = True,
-              display_match = True):
-        response = {}
-
-        query_img = cv2.resize(query_img, (config.IM_WIDTH, config.IM_HEIGHT))
-
-        # Calculate color hist
-        query_hist = cv2.calcHist([query_img], [0], None, [256], [0, 256])
+              display_match = True, query = None):
+        # The regions around the query are loaded first when the table pages
+        if gps_filtering:
+            self.table.page_in(query_coords, config.GPS_FILTER_RADIUS_METERS)
+        # The whole frame is matched against the table as it is now
+        snapshot = self.table.snapshot()
+        if self.result_cache is None:
+            return self.match_frame(query_img, query_coords, gps_filtering,
+                                    display_match, query, snapshot)
+
+        frame_hash = result_cache.perceptual_hash(query_img)
+        cell = (self.table.geo_index.cell_of(*query_coords), gps_filtering)
+        table_version = snapshot.version
+        response = self.result_cache.get(frame_hash, cell, table_version)
+        if response is not None:
+            metrics.count('result_cache_hits')
+            logging.log(VLOG1, f"Returning the cached response for a "
+                               f"near-duplicate frame: {response.get('key')}")
+            return response
 
-        # Extract image features
-        match_start_time = time.time()
-        query_kp, query_des = self.surf.detectAndCompute(query_img, None)
-        match_end_time = time.time()
-        logging.log(VLOG1, f"It took {match_end_time - match_start_time} seconds"
-                            " to extract features for the incoming frame")
+        response = self.match_frame(query_img, query_coords, gps_filtering,
+                                    display_match, query, snapshot)
+        self.result_cache.put(frame_hash, cell, table_version, response)
+        return response
 
-        if len(query_kp) is None:
+    def match_frame(self, query_img, query_coords, gps_filtering = True,
+                    display_match = True, query = None, snapshot = None):
+        response = {}
+        if snapshot is None:
+            snapshot = self.table.snapshot()
+
+        if query is not None:
+            query_img = query.img
+        elif query_img.shape[:2] != (config.IM_HEIGHT, config.IM_WIDTH):
+            query_img = cv2.resize(query_img, (config.IM_WIDTH, config.IM_HEIGHT))
+
+        # Stop tracking an annotation that has been removed, or that is out
+        # of range of the query when the GPS filter is on
+        if not config.USE_TRACKING or (self.tracking is not None and (
+                self.tracking.key not in snapshot or (gps_filtering and
+                not self.tracked_in_proximity(query_coords, snapshot)))):
+            self.tracking = None
+
+        # While the camera stays on the last match, follow its points with
+        # optical flow without extracting features. Every
+        # TRACKING_MAX_FLOW_FRAMES frames, or once the flow is lost, verify
+        # against the last match only before falling back to a full search.
+        if self.tracking is not None:
+            tracking = self.tracking
+            if config.TRACKING_USE_FLOW and \
+                    tracking.flow_frames < config.TRACKING_MAX_FLOW_FRAMES:
+                points = self.track_points(query_img)
+                if points is not None:
+                    self.tracking = tracking._replace(
+                        img = query_img.copy(), points = points,
+                        flow_frames = tracking.flow_frames + 1)
+                    logging.log(VLOG1, f"Tracked {tracking.key} with optical flow")
+                    return self.build_response(tracking.key, 0, snapshot)
+
+            if query is None:
+                query = self.prepare_query(query_img)
+            score, _, matches = self.compute_match_score(query, tracking.key, snapshot)
+            if score is not None:
+                logging.log(VLOG1, f"Verified tracked match {tracking.key}")
+                self.start_tracking(tracking.key, query, matches)
+                return self.build_response(tracking.key, 1, snapshot, score)
+            logging.log(VLOG1, f"Lost track of {tracking.key}")
+            self.tracking = None
+
+        if query is None:
+            query = self.prepare_query(query_img)
+
+        if len(query.kp) is None:
             response['key'] = None
             return response
 
@@ -213,54 +374,80 @@ class ImageMatcher:
         best_shift = None
         best_matches = None
 
-        num_matches_considered = 0
-
         logging.log(
             VLOG1,
             f"Finding best match for location {query_coords=} "
-            f"from {len(self.table.get_keys())} files")
-        for key in self.table.get_keys():
-            logging.debug("NOW COMPARING WITH: %s" % key)
-
-            train_data = self.table.get_all_data(key)
-            train_coords = (train_data.latitude, train_data.longitude)
-
-            if gps_filtering and \
-                not self.coordinates_in_proximity(train_coords, query_coords, 50):
-                logging.log(
-                    VLOG2,
-                    f"Skip matching against {key=} because its "
-                    f"location {train_coords=} is not "
-                    f"in proximity of current coords {query_coords=}: ")
-                continue
-
-            num_matches_considered += 1
-
-            score, shift, matches = \
-                self.compute_match_score(
-                    (query_kp, query_des, query_hist, query_img),
-                    (train_data.kp, train_data.des, train_data.hist, train_data.img))
-            if score is not None and score > best_score:
+            f"from {len(snapshot)} files")
+
+        # Fetch only the annotations near the query from the spatial index.
+        # The indexes may already hold annotations added after the snapshot
+        # was taken, those are left for the next frame.
+        nearby_keys = None
+        if gps_filtering:
+            with metrics.timed('gps_filter') as timer:
+                nearby_keys = {key for key in self.table.get_keys_near(
+                    query_coords, config.GPS_FILTER_RADIUS_METERS) if key in snapshot}
+            logging.log(VLOG1, f"It took {timer.seconds} "
+                               f"seconds to find {len(nearby_keys)} annotations "
+                               f"in proximity of {query_coords=}")
+
+        keys = snapshot.get_keys() if nearby_keys is None else nearby_keys
+
+        # Only keep the annotations that look most like the query overall
+        if config.USE_SHORTLIST:
+            with metrics.timed('shortlist') as timer:
+                keys = self.table.shortlist(query.des, keys, config.SHORTLIST_TOP_K)
+            logging.log(VLOG1, f"It took {timer.seconds} "
+                               "seconds to shortlist the candidates")
+
+        # With the global index, a single kNN query gives the good matches
+        # for every annotation. Annotations that got no votes cannot pass the
+        # match threshold, so only the ones that did are considered.
+        candidate_matches = None
+        if config.USE_GLOBAL_INDEX:
+            with metrics.timed('global_index') as timer:
+                candidate_matches = self.table.descriptor_index.query(query.des, snapshot)
+            logging.log(VLOG1, f"It took {timer.seconds} "
+                               "seconds to query the global descriptor index, "
+                               f"{len(candidate_matches)} annotations got votes")
+            if nearby_keys is not None or config.USE_SHORTLIST:
+                keys = set(keys)
+                keys = [key for key in candidate_matches if key in keys]
+            else:
+                keys = list(candidate_matches.keys())
+
+        keys = list(keys)
+        num_matches_considered = len(keys)
+        metrics.count('candidates', num_matches_considered)
+        scored = self.verify_candidates_parallel(query, keys, snapshot,
+                                                 candidate_matches)
+
+        # Highest score wins, ties go to the smallest key so that the result
+        # does not depend on the order in which candidates were verified
+        for score, key, matches in scored:
+            if score > best_score or \
+                    (score == best_score and best_fit is not None and key < best_fit):
                 best_score = score
-                best_shift = shift
                 best_fit = key
                 best_matches = matches
 
-        response = {'status' : 'success'}
-        response['num_matches_considered'] = num_matches_considered
-
         # Send response to server
         if best_fit == None:
             logging.debug("BEST FIT IS: {0}".format(best_fit))
-            response['key'] = None
         else:
-            if display_match:
-                train_data = self.table.get_all_data(best_fit)
-                self.display_match(query_img, query_kp, train_data.img, train_data.kp, best_matches)
+            # The stored image is read back from disk, so only when it will
+            # be drawn
+            if display_match and self.display_sink is not None and \
+                    self.display_sink.ready():
+                train_data = snapshot.get_all_data(best_fit)
+                train_img = snapshot.get_image(best_fit)
+                if train_img is not None:
+                    self.display_match(query_img, query.kp, train_img,
+                                       features.unpack_keypoints(train_data.kp),
+                                       best_matches)
 
             logging.log(VLOG1, "BEST FIT IS: {0}".format(best_fit))
-            response['key'] = best_fit
-            annotated_text = self.table.get_annotation_text(best_fit)
-            if annotated_text is not None:
-                response['annotated_text'] = annotated_text
-        return response
+            if config.USE_TRACKING:
+                self.start_tracking(best_fit, query, best_matches)
+        return self.build_response(best_fit, num_matches_considered, snapshot,
+                                   best_score if best_fit is not None else None)
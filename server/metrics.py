@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import time
+from threading import Lock, Thread
+
+import config
+
+# Per-stage latencies and counters of the frames handled by this process,
+# served in the Prometheus text format by serve. Each stage keeps its count
+# and total time since startup, and its last METRICS_WINDOW samples for the
+# p50/p95/p99 quantiles. Recording a sample takes a lock and an array store,
+# so timers can stay on in production.
+#
+# The stages of a frame are:
+#   total          handle, from receiving the frame to returning the result
+#   unpack         unpacking the extras of the frame
+#   decode         decoding the JPEG payload
+#   resize         resizing it to IM_WIDTH x IM_HEIGHT
+#   ingest         adding or queueing a new annotation sent with the frame
+#   match          the whole of ImageMatcher.match
+#   extract        feature extraction on the frame
+#   gps_filter     finding the annotations near the frame
+#   shortlist      VLAD shortlisting of the candidates
+#   global_index   the kNN query against the global descriptor index
+#   knn            kNN matching against a single candidate
+#   photometric    the histogram and DCT tests of a frame's candidates
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Help text of the counters, which are exported as aperture_<name>_total
+COUNTERS = {
+    'frames': "Frames received",
+    'frames_dropped': "Frames dropped before matching, by reason",
+    'candidates': "Annotations considered as matches for frames",
+    'result_cache_hits': "Frames answered from the result cache",
+}
+
+class StageStats:
+    def __init__(self, window):
+        self.samples = np.zeros(window, dtype=np.float64)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count += 1
+        self.total += seconds
+
+    # Returns the QUANTILES of the samples in the window, None if empty
+    def quantiles(self):
+        num_samples = min(self.count, len(self.samples))
+        if num_samples == 0:
+            return None
+        return np.quantile(self.samples[:num_samples], QUANTILES)
+
+# Times a with block and records it as a sample of stage. The elapsed time is
+# left in seconds for the caller to log.
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.seconds = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start_time
+        self.metrics.observe(self.stage, self.seconds)
+        return False
+
+class Metrics:
+    def __init__(self, window):
+        self.window = window
+        self.lock = Lock()
+        self.stages = {}
+        # Keyed by (name, sorted label items)
+        self.counters = Counter()
+
+    def timed(self, stage):
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats(self.window)
+            stats.observe(seconds)
+
+    def count(self, name, n = 1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += n
+
+    def value(self, name, **labels):
+        with self.lock:
+            return self.counters[(name, tuple(sorted(labels.items())))]
+
+    # Returns {labels: value} for every set of labels that name was counted
+    # with, labels being a tuple of (label, value) pairs
+    def counts(self, name):
+        with self.lock:
+            return {labels: value for (counter, labels), value
+                    in self.counters.items() if counter == name}
+
+    # Returns {stage: (count, total seconds, quantiles or None)}
+    def stage_summary(self):
+        with self.lock:
+            return {stage: (stats.count, stats.total, stats.quantiles())
+                    for stage, stats in self.stages.items()}
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = Counter()
+
+    # Returns all the metrics in the Prometheus text exposition format
+    def render(self):
+        lines = [
+            "# HELP aperture_stage_seconds Time spent in each stage of "
+            "handling a frame",
+            "# TYPE aperture_stage_seconds summary",
+        ]
+        for stage, (count, total, quantiles) in sorted(self.stage_summary().items()):
+            if quantiles is not None:
+                for q, seconds in zip(QUANTILES, quantiles):
+                    lines.append(f'aperture_stage_seconds{{stage="{stage}",'
+                                 f'quantile="{q}"}} {seconds:.9g}')
+            lines.append(f'aperture_stage_seconds_sum{{stage="{stage}"}} {total:.9g}')
+            lines.append(f'aperture_stage_seconds_count{{stage="{stage}"}} {count}')
+
+        for name, help_text in COUNTERS.items():
+            metric = f"aperture_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            values = sorted(self.counts(name).items())
+            if len(values) == 0:
+                values = [((), 0)]
+            for labels, value in values:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append(f"{metric}{label_text} {value}")
+        return '\n'.join(lines) + '\n'
+
+# The metrics of this process
+REGISTRY = Metrics(config.METRICS_WINDOW)
+
+def timed(stage):
+    return REGISTRY.timed(stage)
+
+def observe(stage, seconds):
+    REGISTRY.observe(stage, seconds)
+
+def count(name, n = 1, **labels):
+    REGISTRY.count(name, n, **labels)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not worth a log line each
+    def log_message(self, format, *args):
+        pass
+
+# Serves REGISTRY at http://host:port/metrics from a background thread.
+# Raises OSError if the port is taken.
+def serve(port, host = '127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target = server.serve_forever, daemon = True).start()
+    return server
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+import json
+import logging
+import numpy as np
+import os
+import queue
+import shutil
+import time
+from threading import Thread
+
+import config
+import feature_backend
+import features
+from annotation_queue import AnnotationRequest
+from annotation_store import RecordLocation, StoreImageReader
+from image_cache import ImageCache
+import table
+
+VLOG1 = 15
+
+# Bump whenever the layout of a packed database changes
+PACKED_DB_VERSION = 1
+
+CURRENT = 'current'
+METADATA = 'annotations.json'
+
+# The PhotometricIndex arrays, in the order of PhotometricIndex._arrays
+PHOTOMETRIC_ARRAYS = ('hists', 'hist_medians', 'dct_blocks', 'dct_totals',
+                      'dct_total_sqs', 'dct_block_sqs')
+
+# A packed database is a snapshot of an ImageDataTable written as one .npy
+# file per array, with every annotation's descriptors and keypoints stacked
+# into a single matrix, plus a JSON file with the keys, texts, locations and
+# where each image is in the annotation store. Engine processes memory-map
+# the arrays read-only, so they share one copy of them in the page cache
+# however many processes there are. Only what cannot be shared (such as the
+# FLANN trees built over the descriptors) is per process. Images are not
+# part of it, engines read them from the annotation store (or db/) like the
+# publishing process does.
+#
+# Each publish writes a new generation directory and then points the current
+# file at it, so a process attaching meanwhile reads either the old or the
+# new generation in full. Old generations are deleted once there are more
+# than SHARED_DB_KEEP_GENERATIONS; processes that still have their files
+# mapped keep reading them until they attach to a newer one.
+
+def save(path, name, array):
+    np.save(os.path.join(path, name + '.npy'), array)
+
+def load(path, name):
+    return np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r')
+
+def current_generation(directory):
+    try:
+        with open(os.path.join(directory, CURRENT), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+# Writes the current snapshot of image_db as a new generation and makes it
+# the current one. Returns the name of the generation.
+def publish(image_db, directory):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    snapshot = image_db.snapshot()
+    keys = list(snapshot.get_keys())
+    entries = [snapshot.get_all_data(key) for key in keys]
+
+    generation = f"generation-{time.time_ns()}"
+    path = os.path.join(directory, generation)
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path)
+
+    des_list = [data.des for data in entries
+                if data.des is not None and len(data.des) > 0]
+    if len(des_list) > 0:
+        descriptors = feature_backend.prepare_descriptors(np.vstack(des_list))
+    else:
+        descriptors = np.empty((0, 0), dtype=np.uint8)
+    save(tmp_path, 'descriptors', descriptors)
+    save(tmp_path, 'keypoints', np.concatenate(
+        [data.kp for data in entries] +
+        [np.empty(0, dtype=features.KEYPOINT_DTYPE)]))
+
+    rows = np.array([snapshot.photometric.row(key) for key in keys],
+                    dtype=np.int64)
+    for name in PHOTOMETRIC_ARRAYS:
+        save(tmp_path, name, getattr(snapshot.photometric, name)[rows])
+
+    locations = None
+    if image_db.store is not None:
+        locations = {}
+        for key in keys:
+            location = image_db.store.location(key)
+            if location is not None:
+                locations[key] = list(location)
+
+    metadata = {
+        'version': PACKED_DB_VERSION,
+        'backend': feature_backend.backend_name(),
+        'image_size': [config.IM_WIDTH, config.IM_HEIGHT],
+        'table_version': snapshot.version,
+        'keys': keys,
+        'descriptor_counts': [0 if data.des is None else len(data.des)
+                              for data in entries],
+        'keypoint_counts': [len(data.kp) for data in entries],
+        'annotation_text': [data.annotation_text for data in entries],
+        'latitude': [data.latitude for data in entries],
+        'longitude': [data.longitude for data in entries],
+        'store_directory': None if image_db.store is None else
+                           os.path.abspath(image_db.store.directory),
+        'locations': locations,
+    }
+    with open(os.path.join(tmp_path, METADATA), 'w') as f:
+        json.dump(metadata, f)
+    os.rename(tmp_path, path)
+
+    current_path = os.path.join(directory, CURRENT)
+    with open(current_path + '.tmp', 'w') as f:
+        f.write(generation)
+    os.replace(current_path + '.tmp', current_path)
+    logging.info(f"Published {len(keys)} annotations to {path}")
+
+    generations = sorted(name for name in os.listdir(directory)
+                         if name.startswith('generation-'))
+    for name in generations[:-config.SHARED_DB_KEEP_GENERATIONS]:
+        if name != generation:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors = True)
+    return generation
+
+# Returns an ImageDataTable over a generation of a packed database, the
+# current one if not given. Its arrays are the read-only memory maps of the
+# files, changes to the table are only ever made in this process.
+def attach(directory, generation = None):
+    if generation is None:
+        generation = current_generation(directory)
+    if generation is None:
+        raise FileNotFoundError(f"Nothing has been published to {directory}")
+    path = os.path.join(directory, generation)
+    with open(os.path.join(path, METADATA), 'r') as f:
+        metadata = json.load(f)
+    if metadata['version'] != PACKED_DB_VERSION:
+        raise ValueError(f"{path} has version {metadata['version']}, "
+                         f"expected {PACKED_DB_VERSION}")
+    if metadata['backend'] != feature_backend.backend_name() or \
+            tuple(metadata['image_size']) != (config.IM_WIDTH, config.IM_HEIGHT):
+        raise ValueError(f"{path} holds {metadata['backend']} features at "
+                         f"{tuple(metadata['image_size'])}, the engine uses "
+                         f"{feature_backend.backend_name()} at "
+                         f"{(config.IM_WIDTH, config.IM_HEIGHT)}")
+
+    store = None
+    if metadata['locations'] is not None:
+        store = StoreImageReader(
+            metadata['store_directory'],
+            {key: RecordLocation(*location)
+             for key, location in metadata['locations'].items()})
+    image_db = table.ImageDataTable(images = ImageCache(store))
+
+    keys = metadata['keys']
+    keypoints = load(path, 'keypoints')
+    starts = np.cumsum([0] + metadata['keypoint_counts'])
+    photometric = [load(path, name) for name in PHOTOMETRIC_ARRAYS]
+    hists, hist_medians = photometric[:2]
+    entries = [table.ImageData(
+                   kp = keypoints[starts[i]:starts[i + 1]], des = None,
+                   descriptor_slot = None, hist = hists[i],
+                   hist_median = int(hist_medians[i]),
+                   annotation_text = metadata['annotation_text'][i],
+                   latitude = metadata['latitude'][i],
+                   longitude = metadata['longitude'][i])
+               for i in range(len(keys))]
+    image_db.load_packed(keys, entries, load(path, 'descriptors'),
+                         metadata['descriptor_counts'], photometric)
+    logging.info(f"Attached to {len(keys)} annotations in {path}")
+    return image_db
+
+# What an engine process uses to follow a packed database: table is the
+# table of the newest generation, which a background thread attaches to
+# within a second of it being published, and submit sends new annotations to
+# the process that publishes it through the requests multiprocessing queue,
+# the same way as AnnotationQueue.submit.
+class SharedDbClient:
+    def __init__(self, directory, requests, put_timeout):
+        self.directory = directory
+        self.requests = requests
+        self.put_timeout = put_timeout
+        self.generation = current_generation(directory)
+        self.table = attach(directory, self.generation)
+        Thread(target = self.watch_loop, daemon = True).start()
+
+    def watch_loop(self):
+        while True:
+            time.sleep(1.0)
+            generation = current_generation(self.directory)
+            if generation == self.generation:
+                continue
+            try:
+                table = attach(self.directory, generation)
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not attach to {generation}: {e}")
+            else:
+                # Engines swap to the new table on their next frame
+                old_table, self.table = self.table, table
+                old_table.close()
+            self.generation = generation
+
+    # The multiprocessing queue pickles requests later on its feeder thread,
+    # so img is copied since the caller may reuse its buffer by then.
+    # Keypoints are sent packed, cv2.KeyPoint cannot be pickled.
+    def submit(self, img, annotation_text, latitude, longitude,
+               kp = None, des = None, hist = None):
+        if kp is not None:
+            kp = features.pack_keypoints(kp)
+        request = AnnotationRequest(
+            img = img.copy(), annotation_text = annotation_text,
+            latitude = latitude, longitude = longitude,
+            kp = kp, des = des, hist = hist)
+        try:
+            self.requests.put(request, timeout = self.put_timeout)
+        except queue.Full:
+            logging.error(f"Annotation queue is full, dropping annotation "
+                          f"{annotation_text!r}")
+            return False
+        logging.log(VLOG1, f"Sent annotation {annotation_text!r} to the loader")
+        return True
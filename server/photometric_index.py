@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+import logging
+import numpy as np
+from scipy import stats
+from threading import Lock
+
+import config
+import features
+
+VLOG1 = 15
+
+HIST_BINS = 256
+
+# Returns the Pearson correlation computed from the sums of two samples of
+# size n, their squares and their products, following cv2.compareHist with
+# HISTCMP_CORREL (a correlation of 1 when either sample is constant)
+def correlation_from_sums(n, s1, s2, s11, s22, s12):
+    num = s12 - s1 * s2 / n
+    denom2 = (s11 - s1 * s1 / n) * (s22 - s2 * s2 / n)
+    defined = np.abs(denom2) > np.finfo(np.float64).eps
+    return np.where(defined, num / np.sqrt(np.where(defined, denom2, 1)), 1.0)
+
+# Returns the correlation between each row of a and the same row of b
+def correlate_rows(a, b):
+    return correlation_from_sums(a.shape[1], a.sum(axis=1), b.sum(axis=1),
+                                 np.square(a).sum(axis=1),
+                                 np.square(b).sum(axis=1),
+                                 (a * b).sum(axis=1))
+
+# Returns the two-sided p-value of the Mann-Whitney U test between each row of
+# x and the same row of y, using the normal approximation with tie and
+# continuity corrections that scipy.stats.mannwhitneyu uses for samples of
+# this size
+def mannwhitneyu_rows(x, y):
+    n1 = x.shape[1]
+    n2 = y.shape[1]
+    n = n1 + n2
+    pooled = np.concatenate((x, y), axis=1)
+
+    r1 = stats.rankdata(pooled, axis=1)[:, :n1].sum(axis=1)
+    u1 = r1 - n1 * (n1 + 1) / 2
+    u = np.maximum(u1, n1 * n2 - u1)
+
+    # Size of every group of tied values, found by labelling the runs of
+    # each sorted row with ids that are unique across rows
+    s = np.sort(pooled, axis=1)
+    run_starts = np.ones(s.shape, dtype=bool)
+    run_starts[:, 1:] = s[:, 1:] != s[:, :-1]
+    run_ids = np.cumsum(run_starts, axis=1) - 1 + \
+        n * np.arange(len(s))[:, np.newaxis]
+    t = np.bincount(run_ids.ravel(), minlength=len(s) * n).reshape(len(s), n)
+    t = t.astype(np.float64)
+    tie_term = (t ** 3 - t).sum(axis=1)
+
+    sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (u - n1 * n2 / 2 - 0.5) / sigma
+    return np.clip(2 * stats.norm.sf(z), 0, 1)
+
+# Returns each histogram row moved shifts[i] bins towards the high end. The
+# last bin is left empty and what moves past it is dropped.
+def shift_rows(hists, shifts):
+    bins = np.arange(hists.shape[1])
+    src = bins[np.newaxis, :] - shifts[:, np.newaxis]
+    valid = (src >= 0) & (bins[np.newaxis, :] < HIST_BINS - 1)
+    shifted = np.take_along_axis(hists, np.clip(src, 0, HIST_BINS - 1), axis=1)
+    return np.where(valid, shifted, 0)
+
+# Keeps the clipped histograms, their medians and the low frequency DCT
+# features of every annotation stacked in NumPy matrices, so that the
+# photometric tests for a query run against all candidates at once. Rows are
+# only ever appended, an annotation that is added again gets a new row, so a
+# PhotometricSnapshot taken earlier keeps seeing the rows it was taken with.
+#
+# The row of each key is looked up in new_rows, which holds the changes since
+# the last compaction (None for a removed key), and then in rows, which is
+# never modified so that snapshots can share it. compact folds new_rows into
+# a fresh rows dict, and once enough rows are dead copies the live ones into
+# new matrices.
+class PhotometricIndex:
+    def __init__(self):
+        self.lock = Lock()
+        self.rows = {}
+        self.new_rows = {}
+        self.size = 0
+        self.num_live = 0
+        self._allocate(0)
+
+    def _allocate(self, capacity):
+        block_len = config.DCT_BLOCK_SIZE * config.DCT_BLOCK_SIZE
+        # Pixel counts, which float32 holds exactly
+        self.hists = np.zeros((capacity, HIST_BINS), dtype=np.float32)
+        self.hist_medians = np.zeros(capacity, dtype=np.int64)
+        self.dct_blocks = np.zeros((capacity, block_len), dtype=np.float32)
+        self.dct_totals = np.zeros(capacity, dtype=np.float64)
+        self.dct_total_sqs = np.zeros(capacity, dtype=np.float64)
+        self.dct_block_sqs = np.zeros(capacity, dtype=np.float64)
+
+    def _arrays(self):
+        return (self.hists, self.hist_medians, self.dct_blocks, self.dct_totals,
+                self.dct_total_sqs, self.dct_block_sqs)
+
+    # Grows by a quarter rather than doubling, since a row holds a DCT block
+    # of several KB and doubling would leave up to half of them unused
+    def _grow(self):
+        old = self._arrays()
+        self._allocate(max(16, len(self.hists) + len(self.hists) // 4))
+        for src, dst in zip(old, self._arrays()):
+            dst[:self.size] = src[:self.size]
+
+    def _is_live(self, key):
+        return self.new_rows.get(key, self.rows.get(key)) is not None
+
+    def add(self, key, hist, hist_median, dct):
+        with self.lock:
+            if not self._is_live(key):
+                self.num_live += 1
+            if self.size == len(self.hists):
+                self._grow()
+            row = self.size
+            self.new_rows[key] = row
+            self.size += 1
+            self.hists[row] = hist.ravel()
+            self.hist_medians[row] = hist_median
+            self.dct_blocks[row] = dct.block
+            self.dct_totals[row] = dct.total
+            self.dct_total_sqs[row] = dct.total_sq
+            self.dct_block_sqs[row] = dct.block_sq
+
+    # Makes an empty index use arrays that are kept elsewhere, such as the
+    # memory-mapped ones of a packed_db, with row i holding keys[i]. arrays
+    # are in the order of _arrays and are only read: the first add copies
+    # them into arrays of its own.
+    def load(self, keys, arrays):
+        with self.lock:
+            (self.hists, self.hist_medians, self.dct_blocks, self.dct_totals,
+             self.dct_total_sqs, self.dct_block_sqs) = arrays
+            self.rows = {key: row for row, key in enumerate(keys)}
+            self.new_rows = {}
+            self.size = len(keys)
+            self.num_live = len(keys)
+
+    # Returns the features.DctFeatures of key, or None if it is not in the
+    # index
+    def dct(self, key):
+        with self.lock:
+            row = self.new_rows.get(key, self.rows.get(key))
+            if row is None:
+                return None
+            return features.DctFeatures(
+                block = self.dct_blocks[row].copy(),
+                total = float(self.dct_totals[row]),
+                total_sq = float(self.dct_total_sqs[row]),
+                block_sq = float(self.dct_block_sqs[row]))
+
+    def remove(self, key):
+        with self.lock:
+            if self._is_live(key):
+                self.num_live -= 1
+                self.new_rows[key] = None
+
+    # Returns whether there are enough changes to fold into rows, or enough
+    # dead rows to drop
+    def needs_compaction(self):
+        return len(self.new_rows) > config.delta_limit(len(self.rows)) or \
+            self.size - self.num_live > \
+            config.COMPACTION_TOMBSTONE_FRACTION * self.size
+
+    def compact(self):
+        with self.lock:
+            rows = dict(self.rows)
+            for key, row in self.new_rows.items():
+                if row is None:
+                    rows.pop(key, None)
+                else:
+                    rows[key] = row
+
+            # Also gives back the room left over from growing, such as after
+            # a bulk load
+            if self.size - len(rows) > \
+                    config.COMPACTION_TOMBSTONE_FRACTION * self.size or \
+                    len(self.hists) - len(rows) > max(16, len(rows) // 4):
+                keys = list(rows.keys())
+                live = np.array([rows[key] for key in keys], dtype=np.int64)
+                old = self._arrays()
+                self._allocate(max(16, len(keys)))
+                for src, dst in zip(old, self._arrays()):
+                    dst[:len(keys)] = src[live]
+                logging.log(VLOG1, f"Dropped {self.size - len(keys)} "
+                                   "photometric rows")
+                rows = {key: row for row, key in enumerate(keys)}
+                self.size = len(keys)
+
+            self.rows = rows
+            self.new_rows = {}
+
+    # Returns the number of bytes that a row takes in the arrays
+    def row_nbytes(self):
+        return sum(array.itemsize * int(np.prod(array.shape[1:]))
+                   for array in self._arrays())
+
+    # Returns a read-only view of the current rows that later changes do not
+    # affect
+    def snapshot(self):
+        with self.lock:
+            size = self.size
+            return PhotometricSnapshot(
+                self.rows, dict(self.new_rows), self.hists[:size],
+                self.hist_medians[:size], self.dct_blocks[:size],
+                self.dct_totals[:size], self.dct_total_sqs[:size],
+                self.dct_block_sqs[:size])
+
+class PhotometricSnapshot:
+    def __init__(self, rows, new_rows, hists, hist_medians, dct_blocks,
+                 dct_totals, dct_total_sqs, dct_block_sqs):
+        self.rows = rows
+        self.new_rows = new_rows
+        self.hists = hists
+        self.hist_medians = hist_medians
+        self.dct_blocks = dct_blocks
+        self.dct_totals = dct_totals
+        self.dct_total_sqs = dct_total_sqs
+        self.dct_block_sqs = dct_block_sqs
+
+    def row(self, key):
+        row = self.new_rows.get(key, self.rows.get(key))
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    # Returns the histogram correlation, the Mann-Whitney U test p-value and
+    # the DCT correlation (all times 100, as in ImageMatcher) between the
+    # query and the annotation of each key. get_image returns the stored
+    # image of a key (None if it is gone), and is only called for the few
+    # candidates whose DCT correlation cannot be decided from the low
+    # frequency block. Those without an image keep the estimate.
+    def score(self, query, keys, get_image):
+        if len(keys) == 0:
+            empty = np.zeros(0)
+            return empty, empty, empty
+
+        rows = np.array([self.row(key) for key in keys], dtype=np.int64)
+        hists = self.hists[rows].astype(np.float64)
+        hist_medians = self.hist_medians[rows]
+        dct_blocks = self.dct_blocks[rows]
+        dct_totals = self.dct_totals[rows]
+        dct_total_sqs = self.dct_total_sqs[rows]
+        dct_block_sqs = self.dct_block_sqs[rows]
+
+        # Shift histograms based on median bin, moving whichever of the two
+        # has the lower median
+        query_hist = np.broadcast_to(
+            query.hist.ravel().astype(np.float64), hists.shape)
+        shift_train = query.hist_median > hist_medians
+        train_side = np.where(
+            shift_train[:, np.newaxis],
+            shift_rows(hists, np.maximum(query.hist_median - hist_medians, 0)),
+            hists)
+        query_side = np.where(
+            shift_train[:, np.newaxis],
+            query_hist,
+            shift_rows(query_hist, np.maximum(hist_medians - query.hist_median, 0)))
+
+        hist_correlation = correlate_rows(train_side, query_side) * 100
+        hist_mwn = mannwhitneyu_rows(query_side, train_side) * 100
+
+        # The DCT is orthonormal, so the full sums of both images are exact
+        # and only the cross term needs the coefficients outside the block.
+        # By Cauchy-Schwarz that remainder is bounded by the energy left
+        # outside each block, which gives an interval for the correlation.
+        n = config.IM_WIDTH * config.IM_HEIGHT
+        q = query.dct
+        cross = dct_blocks.astype(np.float64) @ q.block.astype(np.float64)
+        remainder = np.sqrt(np.maximum(q.total_sq - q.block_sq, 0) *
+                            np.maximum(dct_total_sqs - dct_block_sqs, 0))
+        correl = lambda s12, rows = slice(None): correlation_from_sums(
+            n, q.total, dct_totals[rows], q.total_sq, dct_total_sqs[rows],
+            s12) * 100
+        dct_correl = correl(cross)
+        undecided = (correl(cross - remainder) <= config.DCT_TH) & \
+                    (correl(cross + remainder) > config.DCT_TH)
+
+        # Parseval: the DCT cross term equals the one between the images
+        if np.any(undecided):
+            query_pixels = query.img.ravel().astype(np.float64) / 255.0
+            for i in np.flatnonzero(undecided):
+                train_img = get_image(keys[i])
+                if train_img is None:
+                    continue
+                train_pixels = train_img.ravel().astype(np.float64) / 255.0
+                dct_correl[i] = correl(np.dot(query_pixels, train_pixels), i)
+            logging.log(VLOG1, f"Computed the full DCT correlation for "
+                               f"{np.count_nonzero(undecided)} of "
+                               f"{len(keys)} candidates")
+
+        return hist_correlation, hist_mwn, dct_correl
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+from collections import Counter, deque
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.request
+
+from gabriel_client.websocket_client import ProducerWrapper, WebsocketClient
+
+import common
+import config
+import frame_log
+import metrics
+from generated_proto import client_extras_pb2
+
+# Replays a frame log recorded with annotation_engine.py --record, either by
+# calling ApertureServer.handle directly (--engine direct) or by sending the
+# frames to a running Gabriel server (--engine gabriel), and reports the
+# frames per second, the latency percentiles of each stage and the match
+# outcomes. Frames are sent --fps frames per second, or as fast as the engine
+# takes them with --fps 0.
+#
+# The direct engine loads the annotations like annotation_engine.py does.
+# Frames that carried a new annotation are replayed without it unless
+# --with-annotations is given, in which case the annotations are added again
+# to the store in --store-dir, or to a temporary copy of the annotation store
+# that is removed afterwards. The store of the server is never written.
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='frame log to replay')
+    parser.add_argument('--engine', choices=('direct', 'gabriel'),
+                        default='direct')
+    parser.add_argument('--fps', type=float, default=0,
+                        help='frames per second to send, 0 for as fast as '
+                             'possible')
+    parser.add_argument('--loops', type=int, default=1,
+                        help='number of times to replay the log')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='number of frames to leave out of the report')
+    parser.add_argument('--with-annotations', action='store_true')
+    parser.add_argument('--store-dir',
+                        help='annotation store of the direct engine, '
+                             'created if missing; by default the server\'s '
+                             'store, or a temporary copy of it with '
+                             '--with-annotations')
+    parser.add_argument('--server-host', default=common.DEFAULT_SERVER_HOST)
+    parser.add_argument('--port', type=int, default=8099,
+                        help='websocket port of the Gabriel server, 8099 for '
+                             'the local engine of annotation_engine.py')
+    parser.add_argument('--source-name', default=common.DEFAULT_SOURCE_NAME)
+    parser.add_argument('--idle-timeout', type=float, default=10.0,
+                        help='seconds to wait for outstanding results from '
+                             'the Gabriel server')
+    args = parser.parse_args()
+    if args.engine == 'gabriel' and args.store_dir is not None:
+        parser.error("--store-dir only applies to --engine direct")
+    if args.engine == 'direct' and args.with_annotations and \
+            not config.USE_ANNOTATION_STORE:
+        parser.error("--with-annotations needs USE_ANNOTATION_STORE, the "
+                     "annotations would be written to db/")
+    return args
+
+def load_frames(path, with_annotations):
+    frames = [input_frame for _, input_frame in frame_log.read_frames(path)]
+    if not with_annotations:
+        for input_frame in frames:
+            if not input_frame.HasField('extras'):
+                continue
+            extras = client_extras_pb2.Extras()
+            input_frame.extras.Unpack(extras)
+            if extras.HasField('annotation_text'):
+                extras.ClearField('annotation_text')
+                input_frame.extras.Pack(extras)
+    return frames
+
+# Returns the number of seconds until frame index is due, at most 0 if it
+# already is
+def seconds_until_due(start_time, index, fps):
+    if fps <= 0:
+        return 0
+    return start_time + index / fps - time.time()
+
+# Returns the text of the match in a result wrapper, or None
+def match_outcome(result_wrapper):
+    if len(result_wrapper.results) == 0:
+        return None
+    return result_wrapper.results[0].payload.decode('utf-8')
+
+def replay_direct(frames, args):
+    if args.store_dir is not None:
+        config.ANNOTATION_STORE_DIR = args.store_dir
+    elif args.with_annotations:
+        with tempfile.TemporaryDirectory(prefix='replay-') as directory:
+            store_dir = os.path.join(directory, 'store')
+            if os.path.isdir(config.ANNOTATION_STORE_DIR):
+                logging.info(f"Copying {config.ANNOTATION_STORE_DIR} to "
+                             f"{store_dir}")
+                shutil.copytree(config.ANNOTATION_STORE_DIR, store_dir)
+            config.ANNOTATION_STORE_DIR = store_dir
+            return run_direct(frames, args)
+    return run_direct(frames, args)
+
+def run_direct(frames, args):
+    # Only needed here, it loads the engine's dependencies
+    import annotation_engine
+    image_db = annotation_engine.create_table()
+    engine = annotation_engine.ApertureServer(image_db)
+
+    outcomes = Counter()
+    start_time = None
+    for i, input_frame in enumerate(frames):
+        if i == args.warmup:
+            metrics.REGISTRY.reset()
+            start_time = time.time()
+        if start_time is not None:
+            delay = seconds_until_due(start_time, i - args.warmup, args.fps)
+            if delay > 0:
+                time.sleep(delay)
+        result_wrapper = engine.handle(input_frame)
+        if start_time is not None:
+            outcomes[match_outcome(result_wrapper)] += 1
+    elapsed = 0 if start_time is None else time.time() - start_time
+    if engine.annotation_queue is not None:
+        engine.annotation_queue.join()
+    # Stops the threads that write the store before a temporary one is
+    # removed
+    image_db.close()
+    if image_db.store is not None:
+        image_db.store.close()
+    if start_time is None:
+        return 0, 0, outcomes, {}, {}
+
+    dropped = {dict(labels)['reason']: value for labels, value
+               in metrics.REGISTRY.counts('frames_dropped').items()}
+    return len(frames) - args.warmup, elapsed, outcomes, \
+        metrics.REGISTRY.stage_summary(), dropped
+
+# Sends the frames through the Gabriel websocket client. Only the round trip
+# is timed here, the engine's own stages are scraped from its metrics
+# endpoint if it is on this host. Results are assumed to come back in the
+# order the frames were sent, which holds for a single engine.
+class GabrielReplay:
+    def __init__(self, frames, args):
+        self.frames = frames
+        self.args = args
+        self.num_sent = 0
+        self.num_received = 0
+        self.send_times = deque()
+        self.start_time = None
+        self.last_event_time = time.time()
+        self.round_trips = metrics.StageStats(max(1, len(frames)))
+        self.outcomes = Counter()
+
+    async def producer(self):
+        if self.num_sent == len(self.frames):
+            await asyncio.sleep(0.1)
+            if self.num_received >= self.num_sent or time.time() - \
+                    self.last_event_time > self.args.idle_timeout:
+                asyncio.get_event_loop().stop()
+            return None
+
+        if self.num_sent == self.args.warmup:
+            self.start_time = time.time()
+        if self.start_time is not None:
+            delay = seconds_until_due(self.start_time,
+                                      self.num_sent - self.args.warmup,
+                                      self.args.fps)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        input_frame = self.frames[self.num_sent]
+        self.num_sent += 1
+        self.send_times.append(time.time())
+        self.last_event_time = time.time()
+        return input_frame
+
+    def consumer(self, result_wrapper):
+        now = time.time()
+        self.last_event_time = now
+        send_time = self.send_times.popleft() if self.send_times else now
+        if self.num_received >= self.args.warmup:
+            self.round_trips.observe(now - send_time)
+            self.outcomes[match_outcome(result_wrapper)] += 1
+        self.num_received += 1
+
+    def run(self):
+        client = WebsocketClient(
+            self.args.server_host, self.args.port,
+            [ProducerWrapper(producer=self.producer,
+                             source_name=self.args.source_name)],
+            self.consumer)
+        try:
+            client.launch()
+        except RuntimeError:
+            # Raised when the producer stops the event loop once done
+            pass
+        num_frames = max(0, self.num_received - self.args.warmup)
+        elapsed = 0 if self.start_time is None else \
+            self.last_event_time - self.start_time
+        stages = {'round_trip': (self.round_trips.count, self.round_trips.total,
+                                 self.round_trips.quantiles())}
+        return num_frames, elapsed, self.outcomes, stages, {}
+
+# Returns the stage quantile lines of the engine's metrics endpoint, or None
+# if it cannot be reached
+def scrape_engine_stages(host):
+    if config.METRICS_PORT is None:
+        return None
+    url = f"http://{host}:{config.METRICS_PORT}/metrics"
+    try:
+        with urllib.request.urlopen(url, timeout = 2) as response:
+            text = response.read().decode('utf-8')
+    except OSError:
+        return None
+    return [line for line in text.splitlines()
+            if line.startswith('aperture_stage_seconds{')]
+
+def report(num_frames, elapsed, outcomes, stages, dropped):
+    if num_frames == 0 or elapsed <= 0:
+        print("No frames were replayed")
+        return
+    print(f"Replayed {num_frames} frames in {elapsed:.2f} s, "
+          f"{num_frames / elapsed:.1f} frames/s")
+    print(f"{'stage':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'mean ms':>10}")
+    for stage, (count, total, quantiles) in sorted(stages.items()):
+        if quantiles is None:
+            continue
+        p50, p95, p99 = (1000 * q for q in quantiles)
+        print(f"{stage:<14}{count:>8}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}"
+              f"{1000 * total / count:>10.2f}")
+
+    num_matched = sum(n for text, n in outcomes.items() if text is not None)
+    print(f"{num_matched} frames matched, {outcomes[None]} did not")
+    for text, n in outcomes.most_common():
+        if text is not None:
+            print(f"{n:>8}  {text!r}")
+    for reason, n in sorted(dropped.items()):
+        print(f"{n:>8}  dropped as {reason}")
+
+def main():
+    common.configure_logging()
+    args = parse_args()
+    frames = load_frames(args.path, args.with_annotations) * args.loops
+    logging.info(f"Replaying {len(frames)} frames from {args.path}")
+    if args.engine == 'direct':
+        report(*replay_direct(frames, args))
+    else:
+        report(*GabrielReplay(frames, args).run())
+        lines = scrape_engine_stages(args.server_host)
+        if lines is not None:
+            print("Engine stages (seconds):")
+            for line in lines:
+                print(f"  {line}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+import cv2
+import numpy as np
+import time
+from threading import Lock
+
+# Returns a 64 bit difference hash of a grayscale image: the frame is shrunk
+# to 9x8 and each bit says whether a pixel is brighter than its right
+# neighbour. Near-identical frames get hashes a few bits apart.
+def perceptual_hash(img):
+    small = cv2.resize(img, (9, 8), interpolation = cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hash_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+# A small LRU cache of match responses keyed by the perceptual hash of the
+# frame and the GPS cell it was taken in. A frame whose hash is within
+# max_distance bits of a cached one in the same cell gets the cached response.
+# Entries expire after ttl seconds, and the whole cache is dropped whenever
+# the table version changes, i.e. when an annotation is added.
+class ResultCache:
+    def __init__(self, max_size, ttl, max_distance):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries = OrderedDict()
+        self.table_version = None
+        self.lock = Lock()
+
+    def _validate(self, table_version):
+        if table_version != self.table_version:
+            self.entries.clear()
+            self.table_version = table_version
+
+    def get(self, frame_hash, cell, table_version):
+        now = time.time()
+        with self.lock:
+            self._validate(table_version)
+            best = None
+            best_distance = self.max_distance + 1
+            for entry_key, (response, timestamp) in list(self.entries.items()):
+                if now - timestamp > self.ttl:
+                    del self.entries[entry_key]
+                    continue
+                entry_hash, entry_cell = entry_key
+                if entry_cell != cell:
+                    continue
+                distance = hash_distance(frame_hash, entry_hash)
+                if distance < best_distance:
+                    best = entry_key
+                    best_distance = distance
+            if best is None:
+                return None
+            self.entries.move_to_end(best)
+            return dict(self.entries[best][0])
+
+    def put(self, frame_hash, cell, table_version, response):
+        with self.lock:
+            self._validate(table_version)
+            self.entries[(frame_hash, cell)] = (dict(response), time.time())
+            self.entries.move_to_end((frame_hash, cell))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,3 +1,5 @@
+import argparse
+
 import common
 from gabriel_server.network_engine import server_runner
 
@@ -6,9 +8,15 @@ ZMQ_ADDRESS_FORMAT = 'tcp://*:{}'
 
 def main():
     common.configure_logging()
+    parser = argparse.ArgumentParser()
+    # Frames that a client may have in flight. With several engines (see
+    # annotation_engine.py --workers) it should be at least the number of
+    # engines for all of them to be busy.
+    parser.add_argument('--num-tokens', type=int, default=2)
+    args = parser.parse_args()
     zmq_address = ZMQ_ADDRESS_FORMAT.format(common.ZMQ_PORT)
-    server_runner.run(common.WEBSOCKET_PORT, zmq_address, num_tokens=2,
-                      input_queue_maxsize=60)
+    server_runner.run(common.WEBSOCKET_PORT, zmq_address,
+                      num_tokens=args.num_tokens, input_queue_maxsize=60)
 
 
 if __name__ == '__main__':
@@ -1,62 +1,432 @@
 #!/usr/bin/env python
 
 from collections import namedtuple
+from contextlib import contextmanager
 import cv2
+import logging
+import os
+from threading import Event, RLock, Thread
 
-ImageData = namedtuple('ImageData', 'kp des hist img annotation_text latitude longitude')
+import config
+import feature_store
+from annotation_store import AnnotationRecord
+import features
+from descriptor_index import DescriptorIndex
+from geo_index import GeoIndex
+from image_cache import ImageCache
+from photometric_index import PhotometricIndex
+from vlad_index import VladIndex
+
+# kp holds the keypoints packed by features.pack_keypoints and
+# descriptor_slot identifies des in the descriptor index. hist is the clipped
+# histogram of the image and hist_median its median bin. They are computed
+# once on insertion so that matching never has to recompute (or modify) them.
+# The image itself and its DCT features are not kept here, see ImageCache and
+# PhotometricIndex.
+ImageData = namedtuple('ImageData', 'kp des descriptor_slot hist hist_median annotation_text latitude longitude')
+
+# An immutable view of the table at one version. Matching takes the current
+# snapshot once per frame and reads everything from it, so annotations that
+# are added or removed meanwhile never show up halfway through a frame.
+# Entries are looked up in changes, which holds the annotations changed since
+# the table was last compacted (None for a removed one), and then in base,
+# which is shared between snapshots and never modified.
+class TableSnapshot:
+    def __init__(self, version, base, changes, size, photometric, images):
+        self.version = version
+        self.base = base
+        self.changes = changes
+        self.size = size
+        self.photometric = photometric
+        self.images = images
+        self.keys = None
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return self.changes.get(key, self.base.get(key)) is not None
+
+    def get_keys(self):
+        if self.keys is None:
+            self.keys = tuple(
+                [key for key in self.base if key not in self.changes] +
+                [key for key, data in self.changes.items() if data is not None])
+        return self.keys
+
+    def get_annotation_text(self, key):
+        return self.get_all_data(key).annotation_text
+
+    # Images are read on demand and always the latest one of the key, None if
+    # it has been removed since the snapshot was taken
+    def get_image(self, key):
+        return self.images.get(key)
+
+    def get_all_data(self, key):
+        data = self.changes.get(key, self.base.get(key))
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    # Returns the histogram correlation, Mann-Whitney U p-value and DCT
+    # correlation between the query and each of the given annotations
+    def score_photometric(self, query, keys):
+        return self.photometric.score(query, keys, self.get_image)
 
 # TODO: Add in exception handling!
 class ImageDataTable:
-    def __init__(self, starting_data={}):
-        self.table = starting_data
+    # Changes are persisted to store (an annotation_store.AnnotationStore) if
+    # given, else to one file per annotation in db/. images is the ImageCache
+    # that annotation images are read back from, by default one over the
+    # same store or db/.
+    def __init__(self, store=None, images=None):
+        self.table = {}
+        self.store = store
+        # Bumped on every change to the set of annotations, so that cached
+        # match results can tell that they are out of date
+        self.version = 0
+        # Serializes writers. Readers never take it: writers build a new
+        # snapshot and swap it in with a single assignment.
+        self.lock = RLock()
+        self.batch_depth = 0
+        self.descriptor_index = DescriptorIndex()
+        self.geo_index = GeoIndex(config.GEO_CELL_DEGREES)
+        self.photometric_index = PhotometricIndex()
+        self.vlad_index = VladIndex()
+        self.images = images if images is not None else ImageCache(store)
+        # A geo_pager.GeoPager if only the regions around recent queries are
+        # loaded, see set_pager
+        self.pager = None
+
+        # Snapshots share base and only copy the changes made since
+        self.base = dict(self.table)
+        self.changes = {}
+        self.current = None
+        self._publish()
+
+        self.compaction_needed = Event()
+        self.closed = False
+        self._start_compaction()
+
+    # Swaps in a snapshot of the current table. Writers hold self.lock.
+    def _publish(self):
+        self.descriptor_index.refresh()
+        self.current = TableSnapshot(self.version, self.base, dict(self.changes),
+                                     len(self.table),
+                                     self.photometric_index.snapshot(),
+                                     self.images)
+
+    # Called by writers after every change
+    def _changed(self):
+        self.version += 1
+        if self.batch_depth > 0:
+            return
+        self._publish()
+        self._check_compaction()
+
+    # Wakes the compaction thread if the changes have piled up, or the
+    # shortlist vocabulary needs to be trained
+    def _check_compaction(self):
+        if self.pid != os.getpid():
+            self._start_compaction()
+        if len(self.changes) > config.delta_limit(len(self.base)) or \
+                self.descriptor_index.needs_compaction() or \
+                self.photometric_index.needs_compaction() or \
+                self.vlad_index.needs_training():
+            self.compaction_needed.set()
+
+    # Returns the current snapshot
+    def snapshot(self):
+        return self.current
+
+    # Within a batch, added annotations are only published once it ends, so
+    # that bulk loading does not build a snapshot per annotation. Other
+    # writers wait until the batch is over. The table is compacted when the
+    # batch ends, or with compact=False left to the compaction thread, for
+    # batches on the frame path that should not wait for it.
+    @contextmanager
+    def batch(self, compact = True):
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield
+            finally:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    if compact:
+                        self.compact()
+                    else:
+                        self._publish()
+                        self._check_compaction()
+
+    # Folds the changes since the last compaction into the bulk of the table
+    # and its indexes once there are enough of them, and drops the data of
+    # removed annotations
+    def compact(self):
+        # The descriptor index rebuilds without holding the table lock
+        moved = []
+        if self.descriptor_index.needs_compaction():
+            moved = self.descriptor_index.compact()
+        with self.lock:
+            # Annotations in a rebuilt segment share its descriptor matrix
+            # instead of holding copies of their own
+            for key in moved:
+                data = self.table.get(key)
+                des = self.descriptor_index.get_descriptors(key)
+                if data is not None and des is not None and des is not data.des:
+                    self.table[key] = data._replace(des = des)
+                    self.vlad_index.replace_descriptors(key, des)
+            if self.photometric_index.needs_compaction():
+                self.photometric_index.compact()
+            if len(self.changes) > config.delta_limit(len(self.base)):
+                self.base = dict(self.table)
+                self.changes = {}
+            self._publish()
+
+    # Threads do not survive a fork, so a table that was created before one
+    # starts its compaction thread again on the first change in the child
+    def _start_compaction(self):
+        self.pid = os.getpid()
+        Thread(target = self.compaction_loop, daemon = True).start()
+
+    def compaction_loop(self):
+        while True:
+            self.compaction_needed.wait()
+            self.compaction_needed.clear()
+            if self.closed:
+                return
+            self.compact()
+            # Matches keep using the old vocabulary until the new one is in
+            if self.vlad_index.needs_training():
+                self.vlad_index.train()
+
+    # Stops the compaction thread of a table that is no longer used. The
+    # table can still be read, by matches that were under way for instance.
+    def close(self):
+        self.closed = True
+        self.compaction_needed.set()
 
     def get_keys(self):
-        return self.table.keys()
+        return self.current.get_keys()
 
     ## Get operations
     def get_annotation_text(self, key):
-        response = self.table[key].annotation_text
+        response = self.current.get_annotation_text(key)
         return response
 
     def get_keypoints(self, key):
-        response = self.table[key].kp
+        response = self.current.get_all_data(key).kp
         return response
 
     def get_descriptors(self, key):
-        response = self.table[key].des
+        response = self.current.get_all_data(key).des
         return response
 
     def get_histogram(self, key):
-        response = self.table[key].hist
+        response = self.current.get_all_data(key).hist
         return response
 
     def get_image(self, key):
-        return self.table[key].img
+        return self.current.get_image(key)
 
     def get_all_data(self, key):
-        return self.table[key]
+        return self.current.get_all_data(key)
+
+    # Returns the histogram correlation, Mann-Whitney U p-value and DCT
+    # correlation between the query and each of the given annotations
+    def score_photometric(self, query, keys):
+        return self.current.score_photometric(query, keys)
+
+    # Returns the top_k of the given keys whose annotations look most like the
+    # query descriptors
+    def shortlist(self, query_des, keys, top_k):
+        return self.vlad_index.shortlist(query_des, keys, top_k)
+
+    # Only keeps the stored annotations of the regions that queries land in,
+    # which the pager loads on demand. Set on an empty table.
+    def set_pager(self, pager):
+        with self.lock:
+            self.pager = pager
+
+    # Makes sure that the annotations within radius_meters of coords are
+    # loaded when paging. Called before taking the snapshot to match against.
+    def page_in(self, coords, radius_meters):
+        if self.pager is not None:
+            self.pager.page_in(coords, radius_meters)
+
+    # Returns the estimated number of bytes that the table holds for data
+    def data_nbytes(self, data):
+        nbytes = data.kp.nbytes + data.hist.nbytes + \
+            self.photometric_index.row_nbytes()
+        if data.des is not None:
+            nbytes += data.des.nbytes
+        return nbytes
+
+    # Returns the keys of the annotations within radius_meters of coords.
+    # The spatial index may already know about annotations that are not in
+    # a given snapshot yet, callers keep only the keys of their snapshot.
+    def get_keys_near(self, coords, radius_meters):
+        return self.geo_index.query(coords, radius_meters)
 
     ## Add operations
     def add_annotation(self, key, kp, des, hist, img,
                        annotation_text,
                        latitude = 0,
                        longitude = 0,
-                       persist_to_disk = True):
-        data = ImageData(kp = kp, des = des, hist = hist, img = img,
+                       persist_to_disk = True,
+                       dct = None):
+        # Clipping is idempotent, so hist may already be clipped. dct may be
+        # passed in if the caller has already computed it for img. img may
+        # then be None for an annotation that the store already holds and
+        # that is not persisted again, its image is read from the store.
+        clipped_hist = features.clip_histogram(hist)
+        if dct is None:
+            dct = features.compute_dct_features(img)
+        data = ImageData(kp = features.pack_keypoints(kp), des = des,
+                         descriptor_slot = None, hist = clipped_hist,
+                         hist_median = features.hist_median(clipped_hist),
                          annotation_text = annotation_text,
                          latitude = latitude, longitude = longitude)
         print(f"Adding {key=} to the database, "
               f"{annotation_text=} {latitude=} {longitude=}")
-        self.table[key] = data
 
-        if (persist_to_disk):
-            cv2.imwrite('db/' + key + '.jpg', img)
-            with open('db/' + key + '.txt', 'w') as f:
-                f.write(annotation_text)
-                f.write('\n')
-                f.write(str(latitude))
-                f.write('\n')
-                f.write(str(longitude))
+        with self.lock:
+            if (persist_to_disk):
+                if self.store is not None:
+                    self.store.put(key, self.make_record(data, hist, img, dct))
+                else:
+                    cv2.imwrite('db/' + key + '.jpg', img)
+                    feature_store.save_features('db/' + key + '.jpg', kp, des,
+                                                hist, dct)
+                    self.write_annotation_text(key, annotation_text, latitude, longitude)
+
+            self.images.add(key, img)
+            self.photometric_index.add(key, data.hist, data.hist_median, dct)
+            self.vlad_index.add(key, des)
+            self.geo_index.add(key, latitude, longitude)
+            data = data._replace(
+                descriptor_slot = self.descriptor_index.add(key, des))
+            self.table[key] = data
+            self.changes[key] = data
+            if self.pager is not None:
+                self.pager.added(key, latitude, longitude, self.data_nbytes(data))
+            self._changed()
+
+    # Fills an empty table with annotations whose arrays are kept elsewhere,
+    # such as the memory-mapped files of a packed_db, without copying them.
+    # entries[i] is the ImageData of keys[i], whose descriptors are the next
+    # counts[i] rows of descriptors, and photometric holds the rows of the
+    # PhotometricIndex arrays in the same order.
+    def load_packed(self, keys, entries, descriptors, counts, photometric):
+        with self.lock:
+            slots = self.descriptor_index.load(keys, descriptors, counts)
+            self.photometric_index.load(keys, photometric)
+            for key, data, slot in zip(keys, entries, slots):
+                des = None
+                if slot is not None:
+                    des = self.descriptor_index.get_descriptors(key)
+                data = data._replace(des = des, descriptor_slot = slot)
+                self.vlad_index.add(key, des)
+                self.geo_index.add(key, data.latitude, data.longitude)
+                self.table[key] = data
+            self.base = dict(self.table)
+            self.changes = {}
+            self._changed()
+
+    ## Update operations
+    # Changes the text or location of an annotation, leaving its image and
+    # features as they are. Returns whether the annotation exists.
+    def update_annotation(self, key, annotation_text = None, latitude = None,
+                          longitude = None, persist_to_disk = True):
+        with self.lock:
+            if self.pager is not None:
+                self.pager.fetch(key)
+            data = self.table.get(key)
+            if data is None:
+                return False
+            if annotation_text is not None:
+                data = data._replace(annotation_text = annotation_text)
+            if latitude is not None:
+                data = data._replace(latitude = latitude)
+            if longitude is not None:
+                data = data._replace(longitude = longitude)
+
+            if (persist_to_disk):
+                if self.store is not None:
+                    self.store.put(key, self.make_record(
+                        data, data.hist, self.images.get(key),
+                        self.photometric_index.dct(key)))
+                else:
+                    self.write_annotation_text(key, data.annotation_text,
+                                               data.latitude, data.longitude)
+
+            self.geo_index.add(key, data.latitude, data.longitude)
+            self.table[key] = data
+            self.changes[key] = data
+            if self.pager is not None:
+                self.pager.added(key, data.latitude, data.longitude,
+                                 self.data_nbytes(data))
+            self._changed()
+            return True
+
+    ## Remove operations
+    # Removes an annotation, and its stored copy if persist_to_disk. Its rows
+    # in the indexes are tombstoned until the next compaction. Returns whether
+    # the annotation existed.
+    def remove_annotation(self, key, persist_to_disk = True):
+        with self.lock:
+            if self.pager is not None:
+                self.pager.fetch(key)
+            if key not in self.table:
+                return False
+            logging.info(f"Removing {key=} from the database")
+
+            if (persist_to_disk):
+                if self.store is not None:
+                    self.store.delete(key)
+                else:
+                    image_path = 'db/' + key + '.jpg'
+                    for path in (image_path, 'db/' + key + '.txt',
+                                 feature_store.feature_path(image_path)):
+                        if os.path.exists(path):
+                            os.remove(path)
+
+            self._remove(key)
+            if self.pager is not None:
+                self.pager.removed(key)
+            self._changed()
+            return True
+
+    # Drops annotations from memory when paging, leaving their stored copies
+    def evict(self, keys):
+        with self.lock:
+            for key in keys:
+                if key in self.table:
+                    self._remove(key)
+            self._changed()
+
+    def _remove(self, key):
+        self.descriptor_index.remove(key)
+        self.geo_index.remove(key)
+        self.photometric_index.remove(key)
+        self.vlad_index.remove(key)
+        self.images.remove(key)
+        del self.table[key]
+        self.changes[key] = None
 
-    # TODO: Add remove annotation
+    # hist may be the raw or the clipped histogram, clipping is idempotent
+    @staticmethod
+    def make_record(data, hist, img, dct):
+        return AnnotationRecord(
+            img = img, annotation_text = data.annotation_text,
+            latitude = data.latitude, longitude = data.longitude,
+            kp = data.kp, des = data.des, hist = hist, dct = dct)
 
+    @staticmethod
+    def write_annotation_text(key, annotation_text, latitude, longitude):
+        with open('db/' + key + '.txt', 'w') as f:
+            f.write(annotation_text)
+            f.write('\n')
+            f.write(str(latitude))
+            f.write('\n')
+            f.write(str(longitude))
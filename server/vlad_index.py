@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+import cv2
+import logging
+import numpy as np
+from threading import Lock
+
+import config
+import feature_backend
+
+VLOG1 = 15
+
+# Returns the VLAD vector of a set of descriptors: the residuals to their
+# nearest visual word summed per word, power and intra normalized, then L2
+# normalized as a whole
+def encode(centroids, des):
+    vlad = np.zeros(centroids.shape, dtype=np.float32)
+    if des is not None and len(des) > 0:
+        des = feature_backend.as_float(des)
+        dists = np.square(des).sum(axis=1)[:, np.newaxis] - \
+            2 * des @ centroids.T + np.square(centroids).sum(axis=1)
+        words = np.argmin(dists, axis=1)
+        np.add.at(vlad, words, des - centroids[words])
+
+    vlad = np.sign(vlad) * np.sqrt(np.abs(vlad))
+    norms = np.linalg.norm(vlad, axis=1, keepdims=True)
+    vlad /= np.maximum(norms, 1e-12)
+    vlad = vlad.ravel()
+    return vlad / max(np.linalg.norm(vlad), 1e-12)
+
+# Keeps one VLAD vector per annotation, aggregated from its descriptors over a
+# k-means vocabulary trained on the stored descriptors. The annotations whose
+# vectors are most similar to the query's form a shortlist, and only those go
+# through descriptor matching and the photometric tests.
+#
+# Training runs on the table's compaction thread, not on the match path: it
+# works on a copy of the descriptors without holding the lock, and swaps the
+# new vocabulary and vectors in when done. Until then queries keep using the
+# old ones.
+class VladIndex:
+    def __init__(self):
+        self.lock = Lock()
+        # Only one training at a time
+        self.train_lock = Lock()
+        self.descriptors = {}
+        self.centroids = None
+        self.trained_size = 0
+        # Keys added or removed since the training under way copied the
+        # descriptors, None if there is none
+        self.changed = None
+
+        self.rows = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.unencoded = set()
+
+    def add(self, key, des):
+        with self.lock:
+            if des is None or len(des) == 0:
+                self.descriptors.pop(key, None)
+            else:
+                self.descriptors[key] = des
+            self.unencoded.add(key)
+            if self.changed is not None:
+                self.changed.add(key)
+
+    # Points key at another array holding the same descriptors (such as a
+    # view into the descriptor index), without encoding it again
+    def replace_descriptors(self, key, des):
+        with self.lock:
+            if key in self.descriptors:
+                self.descriptors[key] = des
+
+    # The vector of a removed annotation stays behind until the vocabulary
+    # is retrained, but is no longer reachable from its key
+    def remove(self, key):
+        with self.lock:
+            self.descriptors.pop(key, None)
+            self.rows.pop(key, None)
+            self.unencoded.discard(key)
+            if self.changed is not None:
+                self.changed.add(key)
+
+    # Returns whether the shortlist needs a vocabulary that has not been
+    # trained yet, or has outgrown the one it was trained on
+    def needs_training(self):
+        if not config.USE_SHORTLIST or self.changed is not None:
+            return False
+        if self.centroids is None:
+            return len(self.descriptors) > self.trained_size
+        return len(self.descriptors) >= \
+            config.VOCABULARY_RETRAIN_GROWTH * self.trained_size
+
+    # Trains the vocabulary on a sample of the stored descriptors and encodes
+    # every annotation with it. Annotations that change meanwhile are encoded
+    # with the new vocabulary on the next query.
+    def train(self):
+        with self.train_lock:
+            with self.lock:
+                descriptors = dict(self.descriptors)
+                keys = list(self.rows.keys() | self.unencoded)
+                self.changed = set()
+            vectors = None
+            try:
+                centroids = self._train(descriptors)
+                if centroids is not None:
+                    vectors = np.zeros((len(keys), centroids.size),
+                                       dtype=np.float32)
+                    for row, key in enumerate(keys):
+                        vectors[row] = encode(centroids, descriptors.get(key))
+            finally:
+                with self.lock:
+                    changed = self.changed
+                    self.changed = None
+                    self.trained_size = len(descriptors)
+                    if vectors is not None:
+                        live = self.rows.keys() | self.unencoded
+                        self.centroids = centroids
+                        self.rows = {key: row for row, key in enumerate(keys)
+                                     if key in live and key not in changed}
+                        self.vectors = vectors
+                        self.unencoded = live - self.rows.keys()
+            if vectors is not None:
+                logging.info(f"Trained a vocabulary of "
+                             f"{config.VOCABULARY_SIZE} visual words on "
+                             f"descriptors from {len(descriptors)} annotations")
+
+    # Returns the centroids of a vocabulary trained on a sample of the
+    # descriptors, or None if there are too few of them
+    @staticmethod
+    def _train(descriptors):
+        if len(descriptors) == 0:
+            return None
+        data = feature_backend.as_float(np.vstack(list(descriptors.values())))
+        if len(data) < config.VOCABULARY_SIZE:
+            return None
+        if len(data) > config.VOCABULARY_SAMPLE_SIZE:
+            rng = np.random.default_rng(0)
+            data = data[rng.choice(len(data), config.VOCABULARY_SAMPLE_SIZE,
+                                   replace=False)]
+
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+        _, _, centroids = cv2.kmeans(data, config.VOCABULARY_SIZE, None,
+                                     criteria, 1, cv2.KMEANS_PP_CENTERS)
+        return centroids
+
+    # Encodes the annotations added since the last query. Returns False if
+    # there is no vocabulary yet.
+    def _update(self):
+        if self.centroids is None:
+            return False
+
+        if len(self.unencoded) > 0:
+            new_keys = [k for k in self.unencoded if k not in self.rows]
+            if len(new_keys) > 0:
+                for row, key in enumerate(new_keys, start = len(self.vectors)):
+                    self.rows[key] = row
+                self.vectors = np.vstack((
+                    self.vectors,
+                    np.zeros((len(new_keys), self.centroids.size), dtype=np.float32)))
+            for key in self.unencoded:
+                self.vectors[self.rows[key]] = encode(self.centroids,
+                                                      self.descriptors.get(key))
+            self.unencoded = set()
+        return True
+
+    # Returns the top_k of the given keys ranked by the similarity of their
+    # VLAD vectors to the query descriptors. If there is no vocabulary yet
+    # (too few descriptors stored) the keys are returned unchanged.
+    def shortlist(self, query_des, keys, top_k):
+        keys = list(keys)
+        if len(keys) <= top_k:
+            return keys
+
+        with self.lock:
+            if not self._update():
+                return keys
+            # Keys removed since the caller got them have no vector any more
+            keys = [key for key in keys if key in self.rows]
+            if len(keys) <= top_k:
+                return keys
+            rows = np.array([self.rows[key] for key in keys], dtype=np.int64)
+            vectors = self.vectors[rows]
+            query_vector = encode(self.centroids, query_des)
+
+        similarity = vectors @ query_vector
+        best = np.argpartition(-similarity, top_k - 1)[:top_k]
+        best = best[np.argsort(-similarity[best])]
+        logging.log(VLOG1, f"Shortlisted {top_k} of {len(keys)} annotations, "
+                           f"best similarity {similarity[best[0]]}")
+        return [keys[i] for i in best]
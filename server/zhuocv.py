@@ -1051,24 +1051,50 @@ def detect_colorful(img, on_surface = False):
     return mask
 
 def checkBlurByGradient(img, gradientPatchNBox = 5, gradientPatchWidth = 25, gradientPatchHeight = 25, threshold = 500):
-    bw = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.ndim == 3:
+        bw = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    else:
+        bw = img
     n_rows, n_cols = img.shape[:2]
-    max_gradients = 0
-    for i in xrange(gradientPatchNBox):
-        for j in xrange(gradientPatchNBox):
-            top = (n_rows / ( 2 * gradientPatchNBox + 1)) * (2 * i + 1);
-            left = (n_cols / ( 2 * gradientPatchNBox + 1)) * (2 * j + 1);
-            bw_window = bw[top : top + gradientPatchHeight, left : left + gradientPatchWidth]
-            gradients = np.absolute(cv2.Sobel(bw_window, cv2.CV_64F, 1, 1, ksize = 5))
-            sum_gradients = np.sum(gradients)
-            if sum_gradients > max_gradients:
-                max_gradients = sum_gradients
-    #print max_gradients
+
+    # Sum of absolute gradients in each of the gradientPatchNBox x
+    # gradientPatchNBox sample windows, read off an integral image
+    gradients = np.absolute(cv2.Sobel(bw, cv2.CV_64F, 1, 1, ksize = 5))
+    integral = cv2.integral(gradients)
+    steps = 2 * np.arange(gradientPatchNBox) + 1
+    tops = (n_rows // (2 * gradientPatchNBox + 1)) * steps
+    lefts = (n_cols // (2 * gradientPatchNBox + 1)) * steps
+    bottoms = np.minimum(tops + gradientPatchHeight, n_rows)
+    rights = np.minimum(lefts + gradientPatchWidth, n_cols)
+    sum_gradients = integral[np.ix_(bottoms, rights)] - integral[np.ix_(tops, rights)] \
+        - integral[np.ix_(bottoms, lefts)] + integral[np.ix_(tops, lefts)]
+    max_gradients = sum_gradients.max()
+
     if max_gradients > threshold:
         return False
     else:
         return True
 
+# Returns (is_ok, reason, sharpness) for a grayscale frame. A frame is rejected
+# as blurred if the variance of its Laplacian is below min_sharpness, and as
+# under- or overexposed if more than max_clipped_fraction of its pixels are
+# at most dark_level or at least bright_level.
+def check_frame_quality(img, min_sharpness = 3.0, dark_level = 10, bright_level = 245, max_clipped_fraction = 0.6):
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    hist = cv2.calcHist([img], [0], None, [256], [0, 256]).ravel()
+    n_pixels = hist.sum()
+    if hist[:dark_level + 1].sum() > max_clipped_fraction * n_pixels:
+        return False, "underexposed", None
+    if hist[bright_level:].sum() > max_clipped_fraction * n_pixels:
+        return False, "overexposed", None
+
+    sharpness = cv2.Laplacian(img, cv2.CV_64F).var()
+    if sharpness < min_sharpness:
+        return False, "blurred", sharpness
+    return True, None, sharpness
+
 ########################## OBJECT DETECTION ###################################
 ### http://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
 def non_max_suppression_fast(boxes, overlapThresh):